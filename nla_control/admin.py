@@ -36,7 +36,37 @@ admin.site.register(StorageDSlot, SlotAdmin)
 
 class RestoreDiskAdmin(admin.ModelAdmin):
     save_on_top = True
-    list_display = ('mountpoint', 'formatted_allocated', 'formatted_used')
+    list_display = ('mountpoint', 'formatted_allocated', 'formatted_used', 'last_allocated')
     search_fields = ('mountpoint',)
 #    readonly_fields = ('used_bytes',)
 admin.site.register(RestoreDisk, RestoreDiskAdmin)
+
+class ProcessLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'host', 'pid', 'acquired', 'heartbeat', 'expires')
+    search_fields = ('name', 'host')
+    readonly_fields = ('holder', 'host', 'pid', 'acquired', 'heartbeat', 'expires')
+admin.site.register(ProcessLease, ProcessLeaseAdmin)
+
+class RestoreDiskReservationAdmin(admin.ModelAdmin):
+    list_display = ('tape_request', 'restore_disk', 'reserved_bytes', 'created')
+    list_filter = ('restore_disk',)
+admin.site.register(RestoreDiskReservation, RestoreDiskReservationAdmin)
+
+class LocationUpdateAdmin(admin.ModelAdmin):
+    list_display = ('logical_path', 'location', 'created', 'sent', 'attempts', 'next_attempt')
+    list_filter = ('location',)
+    search_fields = ('logical_path',)
+    readonly_fields = ('created', 'last_error')
+admin.site.register(LocationUpdate, LocationUpdateAdmin)
+
+class RetrievalMetricAdmin(admin.ModelAdmin):
+    list_display = ('tape_request', 'slot', 'started', 'outcome', 'files_retrieved', 'bytes_retrieved',
+                    'queue_seconds', 'sd_get_seconds')
+    list_filter = ('outcome', 'slot')
+    readonly_fields = ('tape_request',)
+admin.site.register(RetrievalMetric, RetrievalMetricAdmin)
+
+class PhaseTimingAdmin(admin.ModelAdmin):
+    list_display = ('name', 'runs', 'failures', 'total_seconds', 'last_run', 'last_seconds')
+    readonly_fields = ('name', 'runs', 'failures', 'total_seconds', 'last_run', 'last_seconds')
+admin.site.register(PhaseTiming, PhaseTimingAdmin)
@@ -0,0 +1,290 @@
+#: Emulator of the StorageD tape system, for testing and load testing the NLA without tape.
+#
+# Used by the sd_get_emulator and sd_ls_emulator commands.  The "tape" is a directory of files (the fake tape,
+# see move_files_to_fake_tape), either flat or with a directory for each spot.  Each file is given a tape volume
+# and a position on the volume from a hash of its name, so sd_ls and sd_get agree on where the files are.
+#
+# Retrievals are modelled as:
+#   - the files are grouped by volume and read in position order, as StorageD does
+#   - each volume is mounted on one of SD_EMULATOR_DRIVES drives, which are shared by all of the sd_get
+#     processes on the host (through lock files in SD_EMULATOR_STATE_DIR), waiting for a drive if they are all busy
+#   - mounting a volume takes SD_EMULATOR_MOUNT_LATENCY seconds, and moving to a file that does not follow the
+#     last one read takes SD_EMULATOR_SEEK_TIME seconds
+#   - files are read at SD_EMULATOR_BANDWIDTH bytes per second per drive
+#   - each file fails with probability SD_EMULATOR_FAILURE_RATE, and the whole sd_get dies part way through with
+#     probability SD_EMULATOR_ABORT_RATE
+#
+# All the delays are multiplied by SD_EMULATOR_TIME_SCALE, so that a day of retrievals can be run in minutes.  The
+# settings are read from the environment, as the emulator is run with the command line of the real sd_get.
+
+import fcntl
+import getopt
+import logging
+import os
+import random
+import shutil
+import sys
+import time
+import zlib
+
+logFormat = '[%(asctime)s] %(levelname)s %(name)s: %(message)s'
+
+
+def env(name, default, convert=str):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return convert(value)
+
+
+class EmulatorSettings(object):
+    """Settings of the emulator, from the SD_EMULATOR_* environment variables."""
+
+    def __init__(self):
+        # directory holding the fake tape
+        self.tape_dir = env("SD_EMULATOR_TAPE_DIR", "/home/www/faketape")
+        # directory for the drive lock files, shared by the sd_get processes
+        self.state_dir = env("SD_EMULATOR_STATE_DIR", os.path.join(self.tape_dir, ".sd_emulator"))
+        self.drives = env("SD_EMULATOR_DRIVES", 4, int)
+        self.volumes = env("SD_EMULATOR_VOLUMES", 50, int)
+        # seconds
+        self.mount_latency = env("SD_EMULATOR_MOUNT_LATENCY", 60.0, float)
+        self.seek_time = env("SD_EMULATOR_SEEK_TIME", 10.0, float)
+        # bytes per second per drive
+        self.bandwidth = env("SD_EMULATOR_BANDWIDTH", 300 * 1024**2, float)
+        # probabilities
+        self.failure_rate = env("SD_EMULATOR_FAILURE_RATE", 0.0, float)
+        self.abort_rate = env("SD_EMULATOR_ABORT_RATE", 0.0, float)
+        self.time_scale = env("SD_EMULATOR_TIME_SCALE", 1.0, float)
+        # "copy" copies the files, "sparse" creates a sparse file of the same size, to restore at scale without data
+        self.copy_mode = env("SD_EMULATOR_COPY_MODE", "copy")
+        self.seed = env("SD_EMULATOR_SEED", None, int)
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+
+def tape_location(file_name, n_volumes):
+    """The volume and position on the volume of a file, from a hash of its name.
+
+       :return: (volume name, position)
+    """
+    base_name = os.path.basename(file_name)
+    volume = zlib.crc32(base_name.encode("utf-8")) % n_volumes
+    position = zlib.crc32(("position:" + base_name).encode("utf-8")) % 1000000
+    return "V%05d" % volume, position
+
+
+def tape_file_path(settings, file_name):
+    """The path of a file on the fake tape: by its path within the spot for files retrieved by /archive/<spot>/...
+       paths if the fake tape has a directory for the spot, otherwise by its base name."""
+    if file_name.startswith("/archive/"):
+        path = os.path.join(settings.tape_dir, file_name[len("/archive/"):])
+        if os.path.exists(path):
+            return path
+    return os.path.join(settings.tape_dir, os.path.basename(file_name))
+
+
+class Drive(object):
+    """A tape drive, held by locking its lock file, so that the drives are shared between processes."""
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.number = None
+        self.lock_file = None
+
+    def acquire(self):
+        os.makedirs(self.settings.state_dir, exist_ok=True)
+        waiting = False
+        while True:
+            for n in range(self.settings.drives):
+                fh = open(os.path.join(self.settings.state_dir, "drive-%d.lock" % n), "w")
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    fh.close()
+                    continue
+                self.number = n
+                self.lock_file = fh
+                return n
+            if not waiting:
+                self.logger.info("All %d drives busy, waiting for a free drive" % self.settings.drives)
+                waiting = True
+            time.sleep(0.1)
+
+    def release(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class Aborted(Exception):
+    pass
+
+
+def restore_file(settings, source, dest):
+    if settings.copy_mode == "sparse":
+        with open(dest, "wb") as fh:
+            fh.truncate(os.path.getsize(source))
+    else:
+        shutil.copyfile(source, dest)
+
+
+def get_files(settings, file_list, local_dir, logger, rng):
+    """Retrieve the files in the list to local_dir, one volume at a time.
+
+       :return: the files that could not be retrieved
+    """
+    bad_files = []
+    volumes = {}
+    for f in file_list:
+        volume, position = tape_location(f, settings.volumes)
+        volumes.setdefault(volume, []).append((position, f))
+    logger.info("Retrieving %d files from %d volumes" % (len(file_list), len(volumes)))
+
+    for volume in sorted(volumes):
+        files = sorted(volumes[volume])
+        drive = Drive(settings, logger)
+        drive.acquire()
+        try:
+            logger.info("Mounting volume %s on drive %d" % (volume, drive.number))
+            settings.sleep(settings.mount_latency)
+            last_position = None
+            for position, f in files:
+                if rng.random() < settings.abort_rate:
+                    logger.critical("Lost connection to StorageD while reading volume %s" % volume)
+                    raise Aborted()
+                if last_position is None or position != last_position + 1:
+                    logger.debug("Positioning volume %s to %d" % (volume, position))
+                    settings.sleep(settings.seek_time)
+                last_position = position
+                try:
+                    source = tape_file_path(settings, f)
+                    size = os.path.getsize(source)
+                    settings.sleep(size / settings.bandwidth)
+                    if rng.random() < settings.failure_rate:
+                        raise IOError("emulated tape read error")
+                    dest_name = os.path.join(local_dir, os.path.basename(f))
+                    restore_file(settings, source, dest_name)
+                    # output to the log so that retrieve_files can link the file as soon as it is restored
+                    logger.info("Copying file: " + f + " to " + dest_name)
+                except (IOError, OSError) as e:
+                    logger.error("Failed to retrieve %s from volume %s position %d: %s" % (f, volume, position, e))
+                    bad_files.append(f)
+            logger.info("Unmounting volume %s from drive %d" % (volume, drive.number))
+        finally:
+            drive.release()
+    return bad_files
+
+
+def sd_get_usage():
+    sys.stderr.write("""Usage:
+    sd_get_emulator [ -v ] [ -l logfile ] [ -h host ] [ -p port ] -f sourcefile -r restoredirectory
+""")
+
+
+def sd_get_main(argv):
+    """sd_get: retrieve the files listed in the source file to the restore directory."""
+    settings = EmulatorSettings()
+    logger = logging.getLogger("StorageD")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt=logFormat))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    source_file_list = None
+    local_dir = ""
+    try:
+        opts, args = getopt.getopt(argv, "vf:d:r:l:h:p:t:")
+    except getopt.GetoptError as err:
+        print(str(err))
+        sd_get_usage()
+        return 1
+
+    for o, a in opts:
+        if o == "-v":
+            logger.setLevel(logging.DEBUG)
+        elif o == "-f":
+            if not os.access(a, os.R_OK):
+                sys.stderr.write("Cannot read provided source file list\n")
+                sd_get_usage()
+                return 1
+            source_file_list = a
+        elif o == "-l":
+            if not os.access(os.path.dirname(a) or ".", os.W_OK):
+                sys.stderr.write("No permission to write to supplied logfile\n")
+                sd_get_usage()
+                return 1
+            log_handler = logging.FileHandler(a)
+            log_handler.setFormatter(logging.Formatter(fmt=logFormat))
+            logger.addHandler(log_handler)
+            logger.removeHandler(handler)
+        elif o == "-r":
+            local_dir = a
+
+    if source_file_list is None:
+        sys.stderr.write("Must provide a source file list\n")
+        sd_get_usage()
+        return 1
+
+    logger.info("Reading files from source list %s" % source_file_list)
+    with open(source_file_list) as fh:
+        file_list = [line.rstrip("\n") for line in fh if line.strip() != ""]
+
+    rng = random.Random(settings.seed)
+    try:
+        bad_files = get_files(settings, file_list, local_dir, logger, rng)
+    except Aborted:
+        return 2
+
+    if len(bad_files) > 0:
+        sys.stderr.write("Could not download the following files:\n")
+        for f in bad_files:
+            sys.stderr.write("%s\n" % f)
+    return 0
+
+
+def sd_ls_main(argv):
+    """sd_ls -s spot -L file: list the files in a spot, in 11 columns (date, time, status, size, volume, position,
+       copies, checksum type, checksum, owner, file name).  The status, size and file name are in the columns the
+       NLA reads from the real sd_ls.  The volume and position are only read if ``SD_LS_VOLUME_COLUMN`` and
+       ``SD_LS_POSITION_COLUMN`` are set to 4 and 5."""
+    settings = EmulatorSettings()
+    spot_name = None
+    try:
+        opts, args = getopt.getopt(argv, "s:L:h:p:")
+    except getopt.GetoptError as err:
+        sys.stderr.write("%s\nUsage:\n    sd_ls_emulator -s spot [ -L file ]\n" % err)
+        return 1
+    for o, a in opts:
+        if o == "-s":
+            spot_name = a
+    if spot_name is None:
+        sys.stderr.write("Must provide a spot name\n")
+        return 1
+
+    # a fake tape with a directory for each spot, or a flat one holding the files of all the spots
+    spot_dir = os.path.join(settings.tape_dir, spot_name)
+    if not os.path.isdir(spot_dir):
+        spot_dir = settings.tape_dir
+    if not os.path.isdir(spot_dir):
+        sys.stderr.write("No such spot: %s\n" % spot_name)
+        return 1
+
+    out = sys.stdout
+    for root, dirs, files in os.walk(spot_dir):
+        # the emulator's own state is not on tape
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            volume, position = tape_location(name, settings.volumes)
+            file_name = "/archive/%s/%s" % (spot_name, os.path.relpath(path, spot_dir))
+            out.write("%s TAPED %d %s %d 1 md5 - nla %s\n" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(st.st_mtime)),
+                st.st_size, volume, position, file_name
+            ))
+    return 0
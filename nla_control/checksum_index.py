@@ -0,0 +1,190 @@
+""" Index of the checksum logs in ``CHKSUMSDIR``, used by ``verify`` to find whether a file has been checksummed.
+
+ The checksum logs of a spot (``<spot>.chksums.*``) are ingested into an SQLite database for the spot, in
+ ``CHECKSUM_INDEX_DIR``, holding the file names in the logs.  The index records how far through each log it has
+ read, so each log is only read once: later runs only read the lines appended since, and a log that has been
+ rewritten or removed has its files removed from the index.  Finding a file is then a single indexed lookup, rather
+ than reading all of the logs of the spot for every file.
+
+ Usage::
+
+     index = ChecksumIndex(CHKSUMSDIR)
+     if index.update(spot_name) > 0 and index.contains(spot_name, file_name):
+         print("verified")
+     index.close()
+"""
+
+from django.conf import settings
+
+from collections import OrderedDict
+import glob
+import os
+import sqlite3
+
+# directory for the index databases, by default in the checksum log directory
+CHECKSUM_INDEX_DIR = getattr(settings, "CHECKSUM_INDEX_DIR", None)
+# number of lines of a log added to the index in each transaction
+CHECKSUM_INDEX_BATCH = getattr(settings, "CHECKSUM_INDEX_BATCH", 10000)
+# number of index databases kept open - the least recently used is closed when another is opened
+CHECKSUM_INDEX_MAX_CONNECTIONS = getattr(settings, "CHECKSUM_INDEX_MAX_CONNECTIONS", 16)
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    name TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    bad_lines INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT NOT NULL,
+    log TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    PRIMARY KEY (filename, log)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_log ON files (log);
+"""
+
+
+class ChecksumIndex(object):
+    """The index of the checksum logs of each spot.
+
+       :var string chksums_dir: directory holding the checksum logs
+       :var string index_dir: directory holding the index database of each spot
+       :var integer max_connections: number of index databases kept open
+    """
+
+    def __init__(self, chksums_dir, index_dir=CHECKSUM_INDEX_DIR, max_connections=CHECKSUM_INDEX_MAX_CONNECTIONS):
+        self.chksums_dir = chksums_dir
+        self.index_dir = index_dir or os.path.join(chksums_dir, ".index")
+        self.max_connections = max(1, max_connections)
+        # spot name: database connection, least recently used first
+        self._connections = OrderedDict()
+        # spot name: number of logs, for the spots updated by this index
+        self._updated = {}
+
+    def _connect(self, spot_name):
+        # a run can verify files in hundreds of spots, so only the recently used databases are kept open, rather
+        # than running out of file descriptors
+        if spot_name in self._connections:
+            self._connections.move_to_end(spot_name)
+            return self._connections[spot_name]
+        while len(self._connections) >= self.max_connections:
+            _, conn = self._connections.popitem(last=False)
+            conn.close()
+        os.makedirs(self.index_dir, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.index_dir, "{}.sqlite3".format(spot_name)), timeout=60)
+        conn.executescript(INDEX_SCHEMA)
+        self._connections[spot_name] = conn
+        return conn
+
+    def log_files(self, spot_name):
+        """The checksum logs of the spot.
+
+           :rtype: List[string]
+        """
+        return sorted(glob.glob(os.path.join(self.chksums_dir, "{}.chksums.*".format(spot_name))))
+
+    def update(self, spot_name):
+        """Add the lines of the checksum logs of the spot that have not been read yet to the index.  The spot is only
+           updated once by each ChecksumIndex, so this can be called for every file.
+
+           :param string spot_name: name of the spot
+           :return: the number of checksum logs of the spot
+           :rtype: integer
+        """
+        if spot_name in self._updated:
+            return self._updated[spot_name]
+        conn = self._connect(spot_name)
+        log_files = self.log_files(spot_name)
+        known = {name: (inode, offset) for name, inode, offset in conn.execute("SELECT name, inode, offset FROM logs")}
+
+        # remove the logs that have gone
+        for name in set(known) - set(log_files):
+            with conn:
+                conn.execute("DELETE FROM files WHERE log = ?", (name,))
+                conn.execute("DELETE FROM logs WHERE name = ?", (name,))
+
+        for name in log_files:
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            inode, offset = known.get(name, (st.st_ino, 0))
+            if inode != st.st_ino or st.st_size < offset:
+                # the log has been rewritten, so read it again from the start
+                with conn:
+                    conn.execute("DELETE FROM files WHERE log = ?", (name,))
+                    conn.execute("DELETE FROM logs WHERE name = ?", (name,))
+                del known[name]
+                inode, offset = st.st_ino, 0
+            if name not in known or st.st_size > offset:
+                self._ingest(conn, name, inode, offset)
+        self._updated[spot_name] = len(log_files)
+        return len(log_files)
+
+    def _ingest(self, conn, name, inode, offset):
+        # read the complete lines of the log after the offset - a partly written last line is read next time
+        with open(name, "rb") as fh:
+            fh.seek(offset)
+            batch = []
+            bad_lines = 0
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                fields = line.decode("utf-8", "replace").split()
+                if len(fields) < 2:
+                    bad_lines += 1
+                else:
+                    batch.append((fields[1], name, fields[0]))
+                if len(batch) >= CHECKSUM_INDEX_BATCH:
+                    self._save(conn, name, inode, offset, bad_lines, batch)
+                    batch = []
+                    bad_lines = 0
+            self._save(conn, name, inode, offset, bad_lines, batch)
+
+    def _save(self, conn, name, inode, offset, bad_lines, batch):
+        # the files and the offset they were read up to are saved together, so a run that dies part way through a
+        # log carries on from the last batch saved
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO files (filename, log, checksum) VALUES (?, ?, ?)", batch)
+            conn.execute(
+                "INSERT INTO logs (name, inode, offset, bad_lines) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET offset = excluded.offset, "
+                "bad_lines = logs.bad_lines + excluded.bad_lines",
+                (name, inode, offset, bad_lines)
+            )
+
+    def contains(self, spot_name, *file_names):
+        """Whether any of the file names are in the checksum logs of the spot.  ``update`` the spot first.
+
+           :param string spot_name: name of the spot
+           :param string file_names: the file names, as written in the checksum logs
+           :rtype: boolean
+        """
+        conn = self._connect(spot_name)
+        for file_name in file_names:
+            if conn.execute("SELECT 1 FROM files WHERE filename = ? LIMIT 1", (file_name,)).fetchone() is not None:
+                return True
+        return False
+
+    def spot_names(self):
+        """The spots updated by this index.
+
+           :rtype: List[string]
+        """
+        return sorted(self._updated)
+
+    def error_logs(self, spot_name):
+        """The checksum logs of the spot that have lines that could not be read.
+
+           :rtype: List[string]
+        """
+        conn = self._connect(spot_name)
+        return [name for name, in conn.execute("SELECT name FROM logs WHERE bad_lines > 0 ORDER BY name")]
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = OrderedDict()
+        self._updated = {}
@@ -0,0 +1,134 @@
+""" Database leases for the NLA scripts.
+
+ Replaces counting processes with ``ps`` to check whether a script is already running.  A ``Lease`` is acquired on
+ the name of the work to do, and is kept alive by a heartbeat thread until it is released.  As the leases are held in
+ the database they work across all of the hosts that run the NLA scripts.  If a process dies its lease expires after
+ ``LEASE_DURATION`` seconds and the work can be claimed by another process.
+
+ If the heartbeat cannot renew the lease, e.g. because the holder was stalled for longer than the duration and another
+ process has claimed the work, the lease is lost: ``held`` becomes False and ``lost`` is set.  Long running holders
+ call ``check`` between steps of their work, which raises ``LeaseLost`` so that they stop.
+
+ Usage::
+
+     with Lease("verify") as lease:
+         if not lease.held:
+             print("Process already running exiting")
+             sys.exit()
+         for chunk in chunks:
+             lease.check()
+             process(chunk)
+"""
+
+from nla_control.models import ProcessLease
+
+from django.conf import settings
+from django.db import connection
+
+import threading
+import time
+import uuid
+
+# number of seconds before a lease expires if it is not renewed
+LEASE_DURATION = getattr(settings, "LEASE_DURATION", 300)
+
+
+class LeaseLost(Exception):
+    """Raised by ``Lease.check`` when the lease has been lost."""
+    pass
+
+
+class Lease(object):
+    """A lease on a named piece of work, renewed by a heartbeat thread while it is held.
+
+       :var string name: the name of the lease
+       :var string holder: unique token for this holder of the lease
+       :var boolean held: whether the lease is held
+       :var threading.Event lost: set when the lease is found to have been lost while it was held
+       :var boolean heartbeat: whether to renew the lease in a heartbeat thread.  If False the holder must call
+           ``renew`` more often than ``duration``.
+    """
+
+    def __init__(self, name, duration=LEASE_DURATION, heartbeat=True):
+        self.name = name
+        self.duration = duration
+        self.heartbeat = heartbeat
+        self.holder = uuid.uuid4().hex
+        self.held = False
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        """Try to acquire the lease and, if it is acquired, start the heartbeat.
+
+           :return: whether the lease was acquired
+           :rtype: boolean
+        """
+        self.held = ProcessLease.acquire(self.name, self.holder, self.duration)
+        if self.held:
+            self.lost.clear()
+        if self.held and self.heartbeat:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+            self._heartbeat.start()
+        return self.held
+
+    def release(self):
+        """Stop the heartbeat and release the lease."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self.held:
+            ProcessLease.release(self.name, self.holder)
+            self.held = False
+
+    def renew(self):
+        """Renew the lease, for holders that do not use the heartbeat thread.
+
+           :return: whether the lease is still held
+           :rtype: boolean
+        """
+        if self.held and not ProcessLease.renew(self.name, self.holder, self.duration):
+            self._set_lost()
+        return self.held
+
+    def _set_lost(self):
+        print("Lost lease {}".format(self.name))
+        self.held = False
+        self.lost.set()
+
+    def check(self):
+        """Raise ``LeaseLost`` if the lease has been lost.  Called by long running holders between steps of their work,
+           so that they stop when another process may have claimed the work."""
+        if self.lost.is_set():
+            raise LeaseLost("Lost lease {}".format(self.name))
+
+    def _renew(self):
+        # renew the lease three times per duration so that it doesn't expire while the holder is running
+        renewed = time.time()
+        try:
+            while not self._stop.wait(self.duration / 3.0):
+                try:
+                    if not ProcessLease.renew(self.name, self.holder, self.duration):
+                        self._set_lost()
+                        break
+                    renewed = time.time()
+                except Exception as e:
+                    # try again at the next heartbeat, unless the lease has expired in the meantime
+                    print("Could not renew lease {}: {}".format(self.name, e))
+                    if time.time() - renewed > self.duration:
+                        self._set_lost()
+                        break
+        finally:
+            # the heartbeat thread has its own database connection
+            connection.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
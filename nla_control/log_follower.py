@@ -0,0 +1,240 @@
+""" Follow the log file written by sd_get, returning the lines as they are written.
+
+ The ``LogFollower`` keeps the log open, and its offset into the log, between reads, so each read only returns the
+ new lines.  Where inotify is available (Linux) the follower waits for the log to change rather than sleeping for a
+ fixed time, so a restored file can be linked into the archive as soon as sd_get reports it.  Otherwise it falls back to polling,
+ backing off from ``LOG_FOLLOWER_MIN_POLL`` to ``LOG_FOLLOWER_MAX_POLL`` seconds while the log is not changing.
+
+ Usage::
+
+     follower = LogFollower(log_file_name)
+     while p.poll() is None:
+         for line in follower.read_lines():
+             ...
+         follower.wait()
+     for line in follower.read_lines(final=True):
+         ...
+     follower.close()
+"""
+
+from django.conf import settings
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+# shortest and longest interval, in seconds, between polls of a log file when inotify is not available.  The longest
+# interval is also the longest wait for a change when inotify is used, so that the caller can check its process.
+LOG_FOLLOWER_MIN_POLL = getattr(settings, "LOG_FOLLOWER_MIN_POLL", 0.1)
+LOG_FOLLOWER_MAX_POLL = getattr(settings, "LOG_FOLLOWER_MAX_POLL", 2.0)
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_libc = None
+
+
+def _get_libc():
+    """Load the C library, if it has the inotify functions.
+
+       :return: the C library, or None if inotify is not available
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+
+class Inotify(object):
+    """A minimal wrapper around an inotify instance, watching a single path at a time.
+
+       :var integer fd: the inotify file descriptor
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        if libc is None:
+            raise OSError("inotify is not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wd = None
+
+    def watch(self, path, mask):
+        """Watch ``path`` for the events in ``mask``, replacing the path that was watched before."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(path))
+        if self.wd is not None and self.wd != wd:
+            self._libc.inotify_rm_watch(self.fd, self.wd)
+        self.wd = wd
+
+    def drain(self):
+        """Read, and discard, the pending events.  The follower only needs to know that something changed."""
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    break
+            except (BlockingIOError, InterruptedError):
+                break
+
+    def wait(self, timeout):
+        """Wait up to ``timeout`` seconds for an event.
+
+           :return: whether there was an event
+           :rtype: boolean
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        self.drain()
+        return len(readable) > 0
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFollower(object):
+    """Follow a log file, keeping the offset of the last complete line read.  The log is kept open between reads.
+
+       :var string path: the log file
+       :var integer offset: the offset in the log file of the first byte not yet returned
+       :var Inotify inotify: the inotify instance, or None if polling
+    """
+
+    def __init__(self, path, min_poll=LOG_FOLLOWER_MIN_POLL, max_poll=LOG_FOLLOWER_MAX_POLL, use_inotify=True):
+        self.path = path
+        self.offset = 0
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.poll_interval = min_poll
+        self.log_file = None
+        self.watching_file = False
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                print("Polling {}, inotify not available: {}".format(path, e))
+        self._open()
+
+    def _open(self):
+        # open the log, and watch it for changes, once it has been created.  Only the log itself is watched - its
+        # directory is the restore area, where every restored file would wake the follower - so the follower polls
+        # until the log is created.
+        try:
+            self.log_file = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        self.offset = 0
+        if self.inotify is not None:
+            try:
+                self.inotify.watch(self.path, IN_MODIFY)
+                self.watching_file = True
+            except OSError as e:
+                print("Polling {}, could not watch it: {}".format(self.path, e))
+        return True
+
+    def _close_log(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        self.watching_file = False
+
+    def _replaced(self):
+        # whether the log has been removed or replaced by a new file since it was opened
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.log_file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _read(self):
+        if os.fstat(self.log_file.fileno()).st_size < self.offset:
+            # the log has been truncated - start again from the beginning
+            self.offset = 0
+        self.log_file.seek(self.offset)
+        return self.log_file.read()
+
+    def fileno(self):
+        """The inotify file descriptor, which becomes readable when the log changes, or None if polling."""
+        if self.inotify is None or not self.watching_file:
+            return None
+        return self.inotify.fd
+
+    def read_lines(self, final=False):
+        """Read the complete lines written to the log since the last read.
+
+           :param boolean final: also return the last line if it is not terminated, as nothing more will be written
+           :return: the new lines, without line endings
+           :rtype: List[string]
+        """
+        if self.log_file is None and not self._open():
+            data = b""
+        else:
+            data = self._read()
+            if len(data) == 0 and self._replaced():
+                # the old log has been read to the end - follow the new one
+                self._close_log()
+                data = self._read() if self._open() else b""
+
+        if final:
+            end = len(data)
+        else:
+            # only return whole lines - a partial line is read again once the rest of it is written
+            end = data.rfind(b"\n") + 1
+        if end == 0:
+            self.poll_interval = min(self.poll_interval * 2, self.max_poll)
+            return []
+        self.offset += end
+        self.poll_interval = self.min_poll
+        return data[:end].decode("utf-8", errors="replace").splitlines()
+
+    def wait(self, timeout=None):
+        """Wait for the log to change, or until ``timeout`` seconds have passed.  When polling, wait for the current
+        poll interval instead, which grows while no new lines are read.
+
+           :param float timeout: longest time to wait, up to ``max_poll``
+        """
+        if timeout is None or timeout > self.max_poll:
+            timeout = self.max_poll
+        if self.fileno() is not None:
+            self.inotify.wait(timeout)
+        else:
+            time.sleep(min(self.poll_interval, timeout))
+
+    def close(self):
+        self._close_log()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def wait_any(followers, timeout=None):
+    """Wait for any of the logs being followed to change, or until ``timeout`` seconds have passed.
+
+       :param followers: the LogFollowers to wait on
+       :param float timeout: longest time to wait, up to the shortest ``max_poll`` of the followers
+    """
+    if len(followers) == 1:
+        followers[0].wait(timeout)
+        return
+    max_poll = min(f.max_poll for f in followers)
+    if timeout is None or timeout > max_poll:
+        timeout = max_poll
+    fds = [f.fileno() for f in followers]
+    if None in fds:
+        time.sleep(min(min(f.poll_interval for f in followers), timeout))
+        return
+    select.select(fds, [], [], timeout)
+    for f in followers:
+        f.inotify.drain()
@@ -0,0 +1,188 @@
+""" Metrics of the state of the NLA, in the Prometheus text exposition format, served by the ``/metrics`` endpoint.
+
+ The gauges (slot occupancy, queue depth per user, restore disk usage, file stage counts and the location update
+ outbox) are read from the database, and the phase counters from ``PhaseTiming``.  The rendered page is cached for
+ ``METRICS_CACHE_TTL`` seconds, and the file stage counts, which scan the TapeFile table, for
+ ``METRICS_STAGE_CACHE_TTL`` seconds, so a scrape every 15 seconds costs little more than a cache lookup.
+
+ The phases record their timings with ``phase_timer``::
+
+     with phase_timer("tidy_requests"):
+         tidy_requests()
+"""
+
+from nla_control.models import *
+from nla_control.profiling import profile_phase
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+
+from contextlib import contextmanager
+import time
+from pytz import utc
+
+# number of seconds the rendered metrics are cached for
+METRICS_CACHE_TTL = getattr(settings, "METRICS_CACHE_TTL", 15)
+# number of seconds the file stage counts are cached for - these scan the TapeFile table
+METRICS_STAGE_CACHE_TTL = getattr(settings, "METRICS_STAGE_CACHE_TTL", 300)
+
+STAGE_NAMES = {
+    TapeFile.UNVERIFIED: "unverified", TapeFile.ONTAPE: "on_tape", TapeFile.RESTORING: "restoring",
+    TapeFile.ONDISK: "on_disk", TapeFile.DELETED: "deleted", TapeFile.RESTORED: "restored",
+}
+
+
+@contextmanager
+def phase_timer(name):
+    """Time a run of a phase and add it to the ``PhaseTiming`` of the phase.  A run that raises an exception is
+       counted as a failure, and the exception is raised again.  The phase is also profiled when the script is run
+       with the ``profile`` argument (see ``nla_control.profiling``).
+
+       :param string name: the name of the phase
+    """
+    start = time.time()
+    failed = False
+    try:
+        with profile_phase(name):
+            yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        try:
+            PhaseTiming.record(name, time.time() - start, failed)
+        except Exception as e:
+            print("Could not record timing of phase {}: {}".format(name, e))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsPage(object):
+    """The metrics being rendered, in the text exposition format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        """Add a metric.
+
+           :param string name: the name of the metric
+           :param string metric_type: ``gauge`` or ``counter``
+           :param string help_text: the description of the metric
+           :param samples: list of (labels dictionary, value) for the metric
+        """
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples:
+            if labels:
+                label_text = ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in sorted(labels.items()))
+                self.lines.append("{}{{{}}} {}".format(name, label_text, value))
+            else:
+                self.lines.append("{} {}".format(name, value))
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def get_stage_counts():
+    """Get the number and size of the files in each stage, cached for ``METRICS_STAGE_CACHE_TTL`` seconds.
+
+       :return: list of (stage, number of files, bytes)
+    """
+    counts = cache.get("nla_metrics_stage_counts")
+    if counts is None:
+        counts = [
+            (row["stage"], row["n"], row["size"] or 0)
+            for row in TapeFile.objects.values("stage").annotate(n=Count("pk"), size=Sum("size")).order_by("stage")
+        ]
+        cache.set("nla_metrics_stage_counts", counts, METRICS_STAGE_CACHE_TTL)
+    return counts
+
+
+def collect_metrics():
+    """Read the metrics from the database and render them.
+
+       :return: the metrics in the text exposition format
+       :rtype: string
+    """
+    page = MetricsPage()
+    now = time.time()
+
+    # slots
+    slots = list(StorageDSlot.objects.all().select_related("tape_request").order_by("pk"))
+    page.add("nla_slots", "gauge", "Number of StorageD slots", [({}, len(slots))])
+    page.add("nla_slot_occupied", "gauge", "Whether the slot has a request",
+             [({"slot": s.pk}, int(s.tape_request_id is not None)) for s in slots])
+    page.add("nla_slot_running", "gauge", "Whether sd_get has been started for the request in the slot",
+             [({"slot": s.pk}, int(s.pid is not None)) for s in slots])
+    started = []
+    for s in slots:
+        if s.tape_request is not None and s.tape_request.storaged_request_start is not None:
+            start = s.tape_request.storaged_request_start
+            if start.tzinfo is None:
+                start = start.replace(tzinfo=utc)
+            started.append(({"slot": s.pk}, round(now - start.timestamp(), 3)))
+    page.add("nla_slot_request_age_seconds", "gauge",
+             "Time since the retrieval of the request in the slot started on StorageD", started)
+
+    # queue depth per user
+    queues = (
+        TapeRequest.objects.filter(active_request=True)
+        .values("quota__user")
+        .annotate(active=Count("pk"), queued=Count("pk", filter=Q(storagedslot__isnull=True)))
+        .order_by("quota__user")
+    )
+    queues = list(queues)
+    page.add("nla_requests_active", "gauge", "Number of active requests, by user",
+             [({"user": q["quota__user"]}, q["active"]) for q in queues])
+    page.add("nla_requests_queued", "gauge", "Number of active requests waiting for a slot, by user",
+             [({"user": q["quota__user"]}, q["queued"]) for q in queues])
+
+    # restore disks
+    disks = list(RestoreDisk.objects.annotate(reserved=Sum("reservations__reserved_bytes")).order_by("mountpoint"))
+    page.add("nla_restore_disk_allocated_bytes", "gauge", "Space allocated to the restore disk",
+             [({"mountpoint": d.mountpoint}, d.allocated_bytes) for d in disks])
+    page.add("nla_restore_disk_used_bytes", "gauge", "Space used on the restore disk",
+             [({"mountpoint": d.mountpoint}, d.used_bytes) for d in disks])
+    page.add("nla_restore_disk_reserved_bytes", "gauge", "Space reserved on the restore disk for running retrievals",
+             [({"mountpoint": d.mountpoint}, d.reserved or 0) for d in disks])
+
+    # file stages
+    stage_counts = get_stage_counts()
+    page.add("nla_files", "gauge", "Number of files in each stage",
+             [({"stage": STAGE_NAMES.get(stage, stage)}, n) for stage, n, size in stage_counts])
+    page.add("nla_files_bytes", "gauge", "Size of the files in each stage",
+             [({"stage": STAGE_NAMES.get(stage, stage)}, size) for stage, n, size in stage_counts])
+
+    # location updates waiting to be sent to Elastic Search
+    page.add("nla_location_updates_pending", "gauge", "Number of location updates not yet sent to Elastic Search",
+             [({}, LocationUpdate.objects.filter(sent__isnull=True).count())])
+
+    # phases
+    phases = list(PhaseTiming.objects.order_by("name"))
+    page.add("nla_phase_runs_total", "counter", "Number of runs of the phase",
+             [({"phase": p.name}, p.runs) for p in phases])
+    page.add("nla_phase_failures_total", "counter", "Number of runs of the phase that failed",
+             [({"phase": p.name}, p.failures) for p in phases])
+    page.add("nla_phase_seconds_total", "counter", "Total time taken by the runs of the phase",
+             [({"phase": p.name}, round(p.total_seconds, 3)) for p in phases])
+    page.add("nla_phase_last_duration_seconds", "gauge", "Time taken by the last run of the phase",
+             [({"phase": p.name}, round(p.last_seconds, 3)) for p in phases if p.last_seconds is not None])
+    page.add("nla_phase_last_run_timestamp_seconds", "gauge", "Time the last run of the phase finished",
+             [({"phase": p.name}, round(p.last_run.timestamp(), 3)) for p in phases if p.last_run is not None])
+    return page.render()
+
+
+def get_metrics():
+    """Get the rendered metrics, from the cache if they were collected in the last ``METRICS_CACHE_TTL`` seconds.
+
+       :rtype: string
+    """
+    text = cache.get("nla_metrics")
+    if text is None:
+        text = collect_metrics()
+        cache.set("nla_metrics", text, METRICS_CACHE_TTL)
+    return text
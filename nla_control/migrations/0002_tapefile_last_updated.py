@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tapefile',
+            name='last_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Time the file record was last saved', null=True),
+        ),
+        migrations.AddField(
+            model_name='taperequest',
+            name='files_updated',
+            field=models.DateTimeField(blank=True, help_text='When the files in the request were last matched against the NLA system', null=True),
+        ),
+        migrations.AlterField(
+            model_name='tapefile',
+            name='stage',
+            field=models.IntegerField(choices=[(1, 'On tape'), (2, 'Restoring'), (3, 'On Disk'), (0, 'Unverified'), (5, 'Restored'), (4, 'Deleted')], db_index=True),
+        ),
+    ]
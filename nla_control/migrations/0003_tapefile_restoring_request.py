@@ -0,0 +1,19 @@
+# Generated by Django 4.2 on 2026-10-18 19:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0002_tapefile_last_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tapefile',
+            name='restoring_request',
+            field=models.ForeignKey(blank=True, help_text='Request whose retrieval is restoring the file', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='restoring_files', to='nla_control.taperequest'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-19 00:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0003_tapefile_restoring_request'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Name of the work being leased', max_length=255, unique=True)),
+                ('holder', models.CharField(blank=True, help_text='Token of the current holder', max_length=64, null=True)),
+                ('host', models.CharField(blank=True, help_text='Host of the current holder', max_length=255, null=True)),
+                ('pid', models.IntegerField(blank=True, help_text='Process id of the current holder', null=True)),
+                ('acquired', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('expires', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
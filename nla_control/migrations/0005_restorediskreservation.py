@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-19 01:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import sizefield.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0004_processlease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restoredisk',
+            name='last_allocated',
+            field=models.DateTimeField(blank=True, help_text='When a retrieval was last placed on the restore area', null=True),
+        ),
+        migrations.CreateModel(
+            name='RestoreDiskReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reserved_bytes', sizefield.models.FileSizeField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('restore_disk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='nla_control.restoredisk')),
+                ('tape_request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='nla_control.taperequest')),
+            ],
+            options={
+                'unique_together': {('restore_disk', 'tape_request')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-19 01:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0005_restorediskreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taperequest',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, help_text='Do not retry the retrieval before this time', null=True),
+        ),
+        migrations.AddField(
+            model_name='taperequest',
+            name='retry_count',
+            field=models.IntegerField(default=0, help_text='Number of failed retrievals in a row'),
+        ),
+    ]
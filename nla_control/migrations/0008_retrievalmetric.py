@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-19 01:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import sizefield.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0007_locationupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetrievalMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.IntegerField()),
+                ('host', models.CharField(blank=True, default='', max_length=255)),
+                ('started', models.DateTimeField(db_index=True)),
+                ('ended', models.DateTimeField(blank=True, null=True)),
+                ('outcome', models.CharField(blank=True, default='', max_length=16)),
+                ('retry_count', models.IntegerField(default=0)),
+                ('sd_gets', models.IntegerField(default=0)),
+                ('files_requested', models.IntegerField(default=0)),
+                ('bytes_requested', sizefield.models.FileSizeField(default=0)),
+                ('files_retrieved', models.IntegerField(default=0)),
+                ('bytes_retrieved', sizefield.models.FileSizeField(default=0)),
+                ('queue_seconds', models.FloatField(blank=True, null=True)),
+                ('prepare_seconds', models.FloatField(blank=True, null=True)),
+                ('sd_get_seconds', models.FloatField(blank=True, null=True)),
+                ('first_file_seconds', models.FloatField(blank=True, null=True)),
+                ('finish_seconds', models.FloatField(blank=True, null=True)),
+                ('tape_request', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='retrieval_metrics', to='nla_control.taperequest')),
+            ],
+        ),
+    ]
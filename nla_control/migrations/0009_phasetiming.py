@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-19 01:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nla_control', '0008_retrievalmetric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhaseTiming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('runs', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+                ('last_seconds', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -1,14 +1,16 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, IntegrityError
 import fnmatch
-import requests
-from django.db.models import Sum
+import datetime
+import os
+import socket
+from django.db.models import F, Sum
 from django.db.models import Q
+from django.utils import timezone
 
 from sizefield.models import FileSizeField
 from sizefield.utils import filesizeformat
 
-from nla_site.settings import *
-
 class RestoreDisk(models.Model):
     """Allocated area(s) of disk(s) to hold restored files.  Restore will find a space on one
        of these RestoreDisks to write the files to.
@@ -16,12 +18,15 @@ class RestoreDisk(models.Model):
        :var models.CharField mountpoint: the path to the restore area
        :var FileSizeField allocated_bytes: the allocated size of the restore area (in bytes)
        :var FileSizeField used_bytes: the amount of space used of the restore area (in bytes).  Updated by ``update()`` method.
+       :var models.DateTimeField last_allocated: the date and time a retrieval was last placed on the restore area
        """
     mountpoint = models.CharField(blank=True, max_length=1024, help_text="E.g. /badc/restore_1", unique=True)
     allocated_bytes = FileSizeField(default=0,
                                     help_text="Maximum size on the disk that can be allocated to the restore area")
     used_bytes = FileSizeField(default=0,
                                help_text="Used value calculated by update method")
+    last_allocated = models.DateTimeField(blank=True, null=True,
+                                          help_text="When a retrieval was last placed on the restore area")
 
     def __str__(self):
         return self.__unicode__()
@@ -48,6 +53,23 @@ class RestoreDisk(models.Model):
             self.used_bytes += f.size
         self.save()
 
+    def add_used(self, delta):
+        """Add ``delta`` bytes to the number of bytes used on the RestoreDisk, in a single update.  Used when files
+           are restored, rather than rescanning all the restored files with ``update()``.
+
+           :param integer delta: the number of bytes to add
+        """
+        RestoreDisk.objects.filter(pk=self.pk).update(used_bytes=F("used_bytes") + delta)
+        self.used_bytes += delta
+
+    def reserved_bytes(self):
+        """The number of bytes reserved on the RestoreDisk by retrievals that have not finished."""
+        return self.reservations.aggregate(reserved=Sum("reserved_bytes"))["reserved"] or 0
+
+    def free_bytes(self):
+        """The number of bytes on the RestoreDisk that are neither used nor reserved."""
+        return self.allocated_bytes - self.used_bytes - self.reserved_bytes()
+
 class TapeFileException(Exception):
     pass
 
@@ -72,6 +94,8 @@ class TapeFile(models.Model):
           - **X**: DELETED (4)
 
        :var models.ForeignKey restore_disk: A reference to the RestoreDisk where the file has been restored to
+       :var models.ForeignKey restoring_request: A reference to the TapeRequest whose retrieval is restoring the file, while the file is RESTORING.  Other requests that contain the file wait for this retrieval rather than retrieving the file again
+       :var models.DateTimeField last_updated: The time and date the record was last saved.  Used by update_requests in process_requests.py to find files that have arrived or changed stage since its last run
     """
 
 
@@ -97,19 +121,32 @@ class TapeFile(models.Model):
     restore_disk = models.ForeignKey(RestoreDisk, blank=True, null=True,
                                      on_delete=models.SET_NULL)
 
+    # which request's retrieval is restoring the file?  Other requests containing the file wait for it
+    restoring_request = models.ForeignKey("TapeRequest", blank=True, null=True,
+                                          on_delete=models.SET_NULL, related_name="restoring_files",
+                                          help_text="Request whose retrieval is restoring the file")
+
+    # when was the record last saved - high-water mark for update_requests
+    last_updated = models.DateTimeField(blank=True, null=True, auto_now=True, db_index=True,
+                                        help_text="Time the file record was last saved")
+
     @staticmethod
     def load_storage_paths():
         """Load the fileset logical paths to spotname mappings by retrieving the spotnames from a URL,
            finding the corresponding logical path for the spot and reformatiing them into a dictionary"""
+        # imported here so that importing the models, e.g. by a script with nothing to do, does not load requests
+        import requests
 
-        response = requests.get(CEDA_DOWNLOAD_CONF)
+        response = requests.get(settings.CEDA_DOWNLOAD_CONF)
         if response.status_code != 200:
-            raise TapeFileException("Cannot find url: {}".format(CEDA_DOWNLOAD_CONF))
+            raise TapeFileException("Cannot find url: {}".format(settings.CEDA_DOWNLOAD_CONF))
         else:
             page = response.text.split("\n")
 
-        TapeFile.fileset_logical_path_map = {}
-        TapeFile.fileset_logical_paths = []
+        # the mappings are built in local variables and replaced at the end, so that other threads, e.g. the
+        # retrievals of the scheduler, never see an empty or partly loaded mapping
+        fileset_logical_path_map = {}
+        fileset_logical_paths = []
 
         # make a dictionary that maps logical paths to spot names
         for line in page:
@@ -117,19 +154,19 @@ class TapeFile(models.Model):
             if line == '':
                 continue
             spot_name, logical_path = line.split()
-            TapeFile.fileset_logical_path_map[logical_path] = spot_name
-            TapeFile.fileset_logical_paths.append(logical_path)
+            fileset_logical_path_map[logical_path] = spot_name
+            fileset_logical_paths.append(logical_path)
 
         # reverse sort the logical paths so that longer paths match first
-        TapeFile.fileset_logical_paths.sort(reverse=True)
+        fileset_logical_paths.sort(reverse=True)
 
-        response = requests.get(STORAGE_PATHS_URL)
+        response = requests.get(settings.STORAGE_PATHS_URL)
         if response.status_code != 200:
-            raise TapeFileException("Cannot find url: {}".format(STORAGE_PATHS_URL))
+            raise TapeFileException("Cannot find url: {}".format(settings.STORAGE_PATHS_URL))
         else:
             page = response.text.split("\n")
 
-        TapeFile.fileset_storage_path_map = {}
+        fileset_storage_path_map = {}
 
         # make a dictionary that maps spot names to storage paths
         for line in page:
@@ -137,7 +174,11 @@ class TapeFile(models.Model):
             if line == '':
                 continue
             storage_path, spot_name = line.split()
-            TapeFile.fileset_storage_path_map[spot_name] = storage_path
+            fileset_storage_path_map[spot_name] = storage_path
+
+        TapeFile.fileset_logical_path_map, TapeFile.fileset_logical_paths, TapeFile.fileset_storage_path_map = (
+            fileset_logical_path_map, fileset_logical_paths, fileset_storage_path_map
+        )
 
     def spotname(self):
         """Return portion of path that maps to spot name, and the spotname for a file.
@@ -253,11 +294,13 @@ class Quota(models.Model):
            :rtype: integer
 
         """
-        reqs = TapeRequest.objects.filter(quota=self, retention__gte=retention_date)
-        size = 0
-        for req in reqs:
-            size += req.size()
-        return size
+        # sum the sizes of the files of all the requests in one query - a file in two requests is counted twice
+        s = TapeRequest.files.through.objects.filter(
+            taperequest__quota=self, taperequest__retention__gte=retention_date
+        ).aggregate(tot_size=Sum("tapefile__size"))
+        if s["tot_size"] is None:
+            return 0
+        return s["tot_size"]
 
     def requests(self):
         """Get the requests associated with this quota
@@ -284,6 +327,9 @@ class TapeRequest(models.Model):
        :var models.DateTimeField first_files_on_disk: the date and time the first files arrived on the restore disk
        :var models.DateTimeField last_files_on_disk: the date and time the last files arrived on the restore disk
        :var models.ManyToManyField files: list of files in the request.  Modified by update_requests in process_requests.py
+       :var models.DateTimeField files_updated: the date and time update_requests last matched the request against the TapeFiles.  Only TapeFiles updated after this are matched on the next run
+       :var models.IntegerField retry_count: the number of times in a row the retrieval of the request has failed and been redone
+       :var models.DateTimeField retry_after: the date and time before which a failed request will not be put into a slot again
        :var models.TextField request_files: A list of files requested by the user
        :var models.CharField request_patterns: pattern to match against to retrieve files from tape
        :var models.CharField notify_on_first_file: email address to notify when first restored file is available in the restore area
@@ -302,6 +348,11 @@ class TapeRequest(models.Model):
     first_files_on_disk = models.DateTimeField(blank=True, null=True)
     last_files_on_disk = models.DateTimeField(blank=True, null=True)
     files = models.ManyToManyField(TapeFile, help_text="The subset of files in the request that currently exist in the NLA system")
+    files_updated = models.DateTimeField(blank=True, null=True,
+                                         help_text="When the files in the request were last matched against the NLA system")
+    retry_count = models.IntegerField(default=0, help_text="Number of failed retrievals in a row")
+    retry_after = models.DateTimeField(blank=True, null=True,
+                                       help_text="Do not retry the retrieval before this time")
     request_files = models.TextField(blank=True, help_text="Files selected for this request")
     request_patterns = models.CharField(blank=True, null=True, max_length=2024, default='',
                                         help_text="Original request patterns (first 2k)")
@@ -409,3 +460,257 @@ class StorageDSlot(models.Model):
 
     def __repr__(self):
         return "Slot %s" % self.pk
+
+
+class ProcessLease(models.Model):
+    """Leases on the work done by the NLA scripts, so that the work can be shared safely between processes on one or
+       more hosts.  A lease is held until it is released or it expires.  Holders keep their lease by renewing it
+       before it expires (a heartbeat).  If the holder dies the lease expires and the work can be claimed again.
+
+       :var models.CharField name: The name of the work being leased, e.g. ``process_requests`` or ``slot-3``
+       :var models.CharField holder: A unique token for the current holder of the lease
+       :var models.CharField host: The name of the host the holder is running on
+       :var models.IntegerField pid: The process id of the holder
+       :var models.DateTimeField acquired: The date and time the lease was acquired
+       :var models.DateTimeField heartbeat: The date and time the lease was last renewed
+       :var models.DateTimeField expires: The date and time the lease expires, if it is not renewed
+    """
+    name = models.CharField(max_length=255, unique=True, help_text="Name of the work being leased")
+    holder = models.CharField(blank=True, null=True, max_length=64, help_text="Token of the current holder")
+    host = models.CharField(blank=True, null=True, max_length=255, help_text="Host of the current holder")
+    pid = models.IntegerField(blank=True, null=True, help_text="Process id of the current holder")
+    acquired = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    expires = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return "%s (%s:%s)" % (self.name, self.host, self.pid)
+
+    @staticmethod
+    def acquire(name, holder, duration):
+        """Acquire the lease ``name`` if it is not held, or its holder has let it expire.  The lease is claimed with a
+           single conditional update so only one process can acquire it.
+
+           :param string name: the name of the lease
+           :param string holder: unique token for the process acquiring the lease
+           :param integer duration: number of seconds until the lease expires
+           :return: whether the lease was acquired
+           :rtype: boolean
+        """
+        try:
+            ProcessLease.objects.get_or_create(name=name)
+        except IntegrityError:
+            # created by another process at the same time
+            pass
+        now = timezone.now()
+        n_acquired = ProcessLease.objects.filter(
+            Q(name=name) & (Q(expires__isnull=True) | Q(expires__lt=now) | Q(holder=holder))
+        ).update(
+            holder=holder, host=socket.gethostname(), pid=os.getpid(),
+            acquired=now, heartbeat=now, expires=now + datetime.timedelta(seconds=duration)
+        )
+        return n_acquired == 1
+
+    @staticmethod
+    def renew(name, holder, duration):
+        """Renew the lease ``name``, if it is still held by ``holder``.
+
+           :return: whether the lease is still held
+           :rtype: boolean
+        """
+        now = timezone.now()
+        n_renewed = ProcessLease.objects.filter(name=name, holder=holder).update(
+            heartbeat=now, expires=now + datetime.timedelta(seconds=duration)
+        )
+        return n_renewed == 1
+
+    @staticmethod
+    def release(name, holder):
+        """Release the lease ``name``, if it is held by ``holder``."""
+        ProcessLease.objects.filter(name=name, holder=holder).update(
+            holder=None, host=None, pid=None, expires=None
+        )
+
+    @staticmethod
+    def is_held(name):
+        """Return whether the lease ``name`` is held by any process and has not expired."""
+        return ProcessLease.objects.filter(name=name, expires__gte=timezone.now()).exists()
+
+
+class RestoreDiskReservation(models.Model):
+    """Space reserved on a RestoreDisk for the files being retrieved for a TapeRequest.  The space is reserved when
+       the RestoreDisk is chosen for the retrieval, reduced as the files are restored (and so counted in the
+       ``used_bytes`` of the RestoreDisk) and released when the retrieval finishes or fails.
+
+       :var models.ForeignKey restore_disk: The RestoreDisk the space is reserved on
+       :var models.ForeignKey tape_request: The TapeRequest the space is reserved for
+       :var FileSizeField reserved_bytes: The number of bytes reserved
+       :var models.DateTimeField created: The date and time the space was reserved
+    """
+    restore_disk = models.ForeignKey(RestoreDisk, on_delete=models.CASCADE, related_name="reservations")
+    tape_request = models.ForeignKey(TapeRequest, on_delete=models.CASCADE, related_name="reservations")
+    reserved_bytes = FileSizeField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("restore_disk", "tape_request")
+
+    def __str__(self):
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return "%s on %s (%s)" % (self.tape_request_id, self.restore_disk, filesizeformat(self.reserved_bytes))
+
+
+class LocationUpdate(models.Model):
+    """Outbox of changes to the location of files, to be sent to the Elastic Search index.  The scripts that restore
+       and remove files add an update here, in the same database as the change to the TapeFile, rather than calling
+       Elastic Search themselves.  The updates are sent in batches, and retried if they fail, by the
+       ``flush_location_updates`` script.
+
+       :var models.CharField logical_path: The logical path of the file
+       :var models.CharField location: The new location of the file, ``on_disk`` or ``on_tape``
+       :var models.DateTimeField created: The date and time the update was added
+       :var models.DateTimeField sent: The date and time the update was sent to Elastic Search, None if not yet sent
+       :var models.IntegerField attempts: The number of failed attempts to send the update
+       :var models.DateTimeField next_attempt: The date and time before which a failed update is not retried
+       :var models.TextField last_error: The error from the last failed attempt
+    """
+    ON_DISK = "on_disk"
+    ON_TAPE = "on_tape"
+
+    logical_path = models.CharField(max_length=2024)
+    location = models.CharField(max_length=32)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(blank=True, null=True, db_index=True)
+    last_error = models.TextField(blank=True, default="")
+
+    def __str__(self):
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return "%s -> %s" % (self.logical_path, self.location)
+
+    @staticmethod
+    def enqueue(paths, location):
+        """Add updates of the location of the files to the outbox.  The updates of the files that have not been sent
+           yet are superseded: they are marked as sent, so that an old update that is being retried cannot overwrite
+           the new location, but can still be replayed in order.
+
+           :param paths: the logical paths of the files
+           :param string location: the new location of the files
+        """
+        paths = list(paths)
+        now = timezone.now()
+        for i in range(0, len(paths), 1000):
+            LocationUpdate.objects.filter(sent__isnull=True, logical_path__in=paths[i:i + 1000]).update(
+                sent=now, last_error="superseded"
+            )
+        LocationUpdate.objects.bulk_create(
+            [LocationUpdate(logical_path=p, location=location) for p in paths], batch_size=1000
+        )
+
+
+class RetrievalMetric(models.Model):
+    """Timings and throughput of one retrieval run of a TapeRequest in a StorageD slot, from choosing the restore
+       disks to finishing the request after the sd_get processes have ended.  The metrics are collected in memory
+       by ``retrieve_files`` while the retrieval runs and written in one insert when it finishes.
+
+       :var models.ForeignKey tape_request: The TapeRequest retrieved, None if it has since been removed
+       :var models.IntegerField slot: The number of the StorageDSlot the retrieval ran in
+       :var models.CharField host: The host the retrieval ran on
+       :var models.DateTimeField started: The date and time the retrieval started
+       :var models.DateTimeField ended: The date and time the retrieval finished
+       :var models.CharField outcome: How the retrieval finished: ``complete``, ``released`` or ``redo``
+       :var models.IntegerField retry_count: The number of failed retrievals of the request before this one
+       :var models.IntegerField sd_gets: The number of sd_get processes run, one for each restore disk
+       :var models.IntegerField files_requested: The number of files passed to sd_get
+       :var FileSizeField bytes_requested: The size of the files passed to sd_get
+       :var models.IntegerField files_retrieved: The number of files restored
+       :var FileSizeField bytes_retrieved: The size of the files restored
+       :var models.FloatField queue_seconds: Time the request waited for a slot: since it was made, or since the
+                                             last retrieval of it finished
+       :var models.FloatField prepare_seconds: Time taken choosing the restore disks and writing the listings
+       :var models.FloatField sd_get_seconds: Time from starting the sd_gets to the last of them ending
+       :var models.FloatField first_file_seconds: Time from starting the sd_gets to the first file being restored
+       :var models.FloatField finish_seconds: Time taken finishing the request after the sd_gets ended
+    """
+    COMPLETE = "complete"
+    RELEASED = "released"
+    REDO = "redo"
+
+    tape_request = models.ForeignKey(TapeRequest, blank=True, null=True, on_delete=models.SET_NULL,
+                                     related_name="retrieval_metrics")
+    slot = models.IntegerField()
+    host = models.CharField(blank=True, default="", max_length=255)
+    started = models.DateTimeField(db_index=True)
+    ended = models.DateTimeField(blank=True, null=True)
+    outcome = models.CharField(blank=True, default="", max_length=16)
+    retry_count = models.IntegerField(default=0)
+    sd_gets = models.IntegerField(default=0)
+    files_requested = models.IntegerField(default=0)
+    bytes_requested = FileSizeField(default=0)
+    files_retrieved = models.IntegerField(default=0)
+    bytes_retrieved = FileSizeField(default=0)
+    queue_seconds = models.FloatField(blank=True, null=True)
+    prepare_seconds = models.FloatField(blank=True, null=True)
+    sd_get_seconds = models.FloatField(blank=True, null=True)
+    first_file_seconds = models.FloatField(blank=True, null=True)
+    finish_seconds = models.FloatField(blank=True, null=True)
+
+    def __str__(self):
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return "%s on slot %s at %s" % (self.tape_request_id, self.slot, self.started)
+
+    def throughput(self):
+        """The rate the files were restored at, in bytes per second, or None if sd_get did not run."""
+        if not self.sd_get_seconds:
+            return None
+        return self.bytes_retrieved / self.sd_get_seconds
+
+
+class PhaseTiming(models.Model):
+    """Running totals of the time taken by each phase of the NLA (``process_requests``, ``retrieve_files``,
+       ``tidy_requests`` etc.), whether it is run from cron or by ``nla_scheduler``.  Exposed as counters by the
+       ``/metrics`` endpoint.
+
+       :var models.CharField name: The name of the phase
+       :var models.IntegerField runs: The number of times the phase has run
+       :var models.IntegerField failures: The number of runs of the phase that raised an exception
+       :var models.FloatField total_seconds: The total time taken by all the runs of the phase
+       :var models.DateTimeField last_run: The date and time the last run of the phase finished
+       :var models.FloatField last_seconds: The time taken by the last run of the phase
+    """
+    name = models.CharField(max_length=255, unique=True)
+    runs = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    last_run = models.DateTimeField(blank=True, null=True)
+    last_seconds = models.FloatField(blank=True, null=True)
+
+    def __str__(self):
+        return self.__unicode__()
+
+    def __unicode__(self):
+        return "%s (%s runs)" % (self.name, self.runs)
+
+    @staticmethod
+    def record(name, seconds, failed=False):
+        """Add a run of a phase to its totals.
+
+           :param string name: the name of the phase
+           :param float seconds: the time the run took
+           :param boolean failed: whether the run raised an exception
+        """
+        PhaseTiming.objects.get_or_create(name=name)
+        PhaseTiming.objects.filter(name=name).update(
+            runs=F("runs") + 1, failures=F("failures") + (1 if failed else 0),
+            total_seconds=F("total_seconds") + seconds, last_run=timezone.now(), last_seconds=seconds
+        )
@@ -0,0 +1,237 @@
+""" Profiling mode for the NLA scripts, to diagnose slow runs without changing the code.
+
+ The ``run`` function of each script is wrapped with ``profiled``, which adds these script arguments:
+
+ - *profile* -- time each phase of the script and its database queries, log the slow SQL statements with the line
+   of the NLA code that ran them, and print a summary of the phases at the end of the run
+ - *profile=cprofile* -- also run the script under cProfile, writing the stats to ``PROFILE_DIR`` and printing the
+   functions with the most cumulative time
+ - *slow_sql=<seconds>* -- log the SQL statements slower than this, rather than ``PROFILE_SLOW_SQL`` seconds
+
+ e.g. ``$ python manage.py runscript process_requests --script-args profile=cprofile slow_sql=0.1``
+
+ The phases timed by ``phase_timer`` are profiled, and the steps within them are marked with ``profile_phase``,
+ which does nothing unless profiling is on::
+
+     with profile_phase("update_requests"):
+         update_requests()
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from contextlib import contextmanager
+import cProfile
+import datetime
+import functools
+import os
+import pstats
+import tempfile
+import threading
+import time
+import traceback
+
+# directory the cProfile stats are written to
+PROFILE_DIR = getattr(settings, "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "nla_profiles"))
+# SQL statements slower than this, in seconds, are logged
+PROFILE_SLOW_SQL = getattr(settings, "PROFILE_SLOW_SQL", 0.5)
+# number of functions printed from the cProfile stats
+PROFILE_TOP_FUNCTIONS = getattr(settings, "PROFILE_TOP_FUNCTIONS", 25)
+
+# the profiler for the run, None if not profiling
+_profiler = None
+
+
+class PhaseStats(object):
+    """The time and queries of a phase, over all of the times it ran."""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.slow_queries = 0
+
+
+class Profiler(object):
+    """Collect the time and queries of each phase of a script, and the slow SQL statements.  The queries are
+       counted on the database connections of all threads.
+
+       :var string name: the name of the script
+       :var float slow_sql: SQL statements slower than this, in seconds, are logged
+       :var phases: the PhaseStats of each phase, in the order they first ran
+       :var total: the PhaseStats of the whole run, including the queries outside of the phases
+    """
+
+    def __init__(self, name, slow_sql=PROFILE_SLOW_SQL):
+        self.name = name
+        self.slow_sql = slow_sql
+        self.phases = {}
+        self.total = PhaseStats()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.wrapped = []
+
+    def current_phases(self):
+        # the phases running in this thread, outermost first
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def phase(self, name):
+        stack = self.current_phases()
+        # nested phases are named by their path, e.g. process_requests/update_requests
+        full_name = "/".join(stack + [name])
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                stats = self.phases.setdefault(full_name, PhaseStats())
+                stats.calls += 1
+                stats.seconds += seconds
+
+    def source_location(self):
+        """The innermost line of the NLA code in the current stack, outside this module."""
+        for frame in reversed(traceback.extract_stack()):
+            if "nla_control" in frame.filename and not frame.filename.endswith("profiling.py"):
+                return "{}:{} in {}".format(
+                    frame.filename[frame.filename.rfind("nla_control"):], frame.lineno, frame.name
+                )
+        return "unknown"
+
+    def __call__(self, execute, sql, params, many, context):
+        """Database execute wrapper: time the query and add it to the phases running in this thread."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            slow = seconds >= self.slow_sql
+            stack = self.current_phases()
+            with self.lock:
+                # the query counts towards the run and each of the phases it is nested in
+                for stats in [self.total] + [
+                    self.phases.setdefault("/".join(stack[:i + 1]), PhaseStats()) for i in range(len(stack))
+                ]:
+                    stats.queries += 1
+                    stats.sql_seconds += seconds
+                    if slow:
+                        stats.slow_queries += 1
+            if slow:
+                print("Slow SQL ({:.3f}s) at {}: {}".format(seconds, self.source_location(), sql[:500]))
+
+    def add_wrapper(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self.wrapped.append(connection)
+
+    def start(self):
+        # count the queries on the connections already open in this thread, and any opened later in any thread
+        for connection in connections.all():
+            self.add_wrapper(connection)
+        connection_created.connect(self.add_wrapper)
+
+    def stop(self):
+        connection_created.disconnect(self.add_wrapper)
+        for connection in self.wrapped:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        self.wrapped = []
+
+    def summary(self):
+        """Print the time and queries of each phase."""
+        print("Profile of {}:".format(self.name))
+        print("  {:<48} {:>6} {:>10} {:>8} {:>10} {:>5}".format("phase", "calls", "seconds", "queries", "sql secs",
+                                                                "slow"))
+        with self.lock:
+            for name, stats in list(self.phases.items()) + [("total", self.total)]:
+                print("  {:<48} {:>6} {:>10.3f} {:>8} {:>10.3f} {:>5}".format(
+                    name, stats.calls, stats.seconds, stats.queries, stats.sql_seconds, stats.slow_queries
+                ))
+
+
+@contextmanager
+def profile_phase(name):
+    """Mark a phase of a script, so that it is timed when profiling.  Does nothing when not profiling.
+
+       :param string name: the name of the phase
+    """
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.phase(name):
+            yield
+
+
+def parse_profile_args(args):
+    """Take the profiling arguments from the script arguments.
+
+       :return: whether to profile, whether to use cProfile, the slow SQL threshold and the other arguments
+       :rtype: Tuple(boolean, boolean, float, List[string])
+    """
+    profile = False
+    use_cprofile = False
+    slow_sql = PROFILE_SLOW_SQL
+    other_args = []
+    for arg in args:
+        if arg == "profile":
+            profile = True
+        elif arg == "profile=cprofile":
+            profile = True
+            use_cprofile = True
+        elif arg.startswith("slow_sql="):
+            profile = True
+            slow_sql = float(arg[len("slow_sql="):])
+        else:
+            other_args.append(arg)
+    return profile, use_cprofile, slow_sql, other_args
+
+
+def profiled(name):
+    """Decorator for the ``run`` function of a script, adding the profiling arguments (see above).
+
+       :param string name: the name of the script
+    """
+    def decorator(run):
+        @functools.wraps(run)
+        def wrapper(*args):
+            global _profiler
+            profile, use_cprofile, slow_sql, args = parse_profile_args(args)
+            if not profile:
+                return run(*args)
+
+            _profiler = Profiler(name, slow_sql)
+            _profiler.start()
+            cprofiler = cProfile.Profile() if use_cprofile else None
+            start = time.perf_counter()
+            try:
+                if cprofiler is not None:
+                    return cprofiler.runcall(run, *args)
+                return run(*args)
+            finally:
+                _profiler.total.calls = 1
+                _profiler.total.seconds = time.perf_counter() - start
+                _profiler.stop()
+                _profiler.summary()
+                _profiler = None
+                if cprofiler is not None:
+                    write_cprofile(name, cprofiler)
+        return wrapper
+    return decorator
+
+
+def write_cprofile(name, cprofiler):
+    """Write the cProfile stats to ``PROFILE_DIR`` and print the functions with the most cumulative time."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stats_file = os.path.join(PROFILE_DIR, "{}-{}-{}.pstats".format(
+        name, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid()
+    ))
+    cprofiler.dump_stats(stats_file)
+    print("cProfile stats written to {}".format(stats_file))
+    pstats.Stats(cprofiler).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
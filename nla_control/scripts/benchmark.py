@@ -0,0 +1,411 @@
+""" Benchmark the NLA pipeline against a synthetic catalogue, and keep the results to compare between commits.
+
+ A test database is created (using the database engine in ``settings.py``, e.g. SQLite or PostgreSQL), and filled
+ with a synthetic catalogue of TapeFiles spread over a number of spots, quotas, pattern and listing requests and
+ restore disks.  The files are created in a temporary archive, with a fake tape for the StorageD emulator
+ (``nla_control/bin/sd_get_emulator``) and checksum logs for ``verify``.  Each phase of the pipeline is then run in
+ turn, recording its time, the number of database queries and the peak memory allocated (``tracemalloc``):
+
+ - ``update_requests``, ``load_slots``, ``prepare_retrieval`` (``create_retrieve_listing`` for each slot)
+ - ``wait_sd_get``: run sd_get for each slot with the emulator and process the logs, then ``finish_retrieval``.
+   This is only run with ``TEST_VERSION``, as the emulator restores the files to the test layout.
+ - ``verify``, the API views and ``/metrics``
+ - ``tidy_requests``, after expiring all of the requests
+
+ The results are written as JSON to ``BENCHMARK_RESULTS_DIR``, named by the time and the git commit, and compared
+ with the last results for the same catalogue size (or the file given by ``compare=``).  Phases that have become
+ slower (by at least ``BENCHMARK_MIN_SECONDS``), or make more queries, by more than ``BENCHMARK_REGRESSION`` times
+ are reported.
+
+ This is designed to be used via the django-extensions runscript command:
+
+ ``$ python manage.py runscript benchmark --script-args files=100000 spots=50``
+"""
+
+from nla_control.models import *
+from nla_site.settings import *
+from nla_control.scripts import process_requests, retrieve_files, tidy_requests, verify
+from nla_control.spot_listing import spot_listings, SpotFile
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+import datetime
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# directory the results are written to
+BENCHMARK_RESULTS_DIR = getattr(settings, "BENCHMARK_RESULTS_DIR", "benchmark_results")
+# factor by which a phase has to be slower, or make more queries, than the last results to be reported
+BENCHMARK_REGRESSION = getattr(settings, "BENCHMARK_REGRESSION", 1.2)
+# phases must also be this many seconds slower to be reported, so that the timing noise of quick phases is ignored
+BENCHMARK_MIN_SECONDS = getattr(settings, "BENCHMARK_MIN_SECONDS", 0.5)
+
+# size of the catalogue generated by default, overridden by the script arguments
+DEFAULT_CATALOGUE = {
+    "files": 10000,
+    "spots": 10,
+    "quotas": 10,
+    "pattern_requests": 20,
+    "listing_requests": 20,
+    "files_per_listing": 100,
+    "disks": 2,
+    "unverified": 1000,
+    "seed": 1,
+}
+
+
+class QueryCounter(object):
+    """Database execute wrapper that counts the queries run."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Benchmark(object):
+    """Run and time the phases of the pipeline.
+
+       :var dict results: the time, number of queries and peak memory of each phase
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        """Run a phase, recording its time, number of queries and peak memory.
+
+           :param string name: the name of the phase
+           :param func: the function to run
+           :return: the return value of ``func``
+        """
+        counter = QueryCounter()
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - start_memory
+        self.results[name] = {"seconds": round(seconds, 4), "queries": counter.count, "peak_memory": peak}
+        print("  {:<24} {:>10.3f}s {:>8} queries {:>12} bytes".format(name, seconds, counter.count, peak))
+        return value
+
+
+def write_file(path, size):
+    """Create a sparse file of the given size."""
+    with open(path, "wb") as fh:
+        fh.truncate(size)
+
+
+def generate_catalogue(root, files, spots, quotas, pattern_requests, listing_requests, files_per_listing, disks,
+                       unverified, seed):
+    """Generate a synthetic catalogue in the database, with its files on disk under ``root``.
+
+       The files are spread evenly over the spots.  The ``unverified`` files are in the archive, with checksum logs
+       for ``verify``, and the rest are on the fake tape.  Each pattern request matches a directory of a spot and
+       each listing request lists ``files_per_listing`` random files.
+
+       :param string root: the directory to create the archive, fake tape, restore disks and checksum logs in
+       :return: the fake tape directory and the checksum log directory
+    """
+    rng = random.Random(seed)
+    archive = os.path.join(root, "archive")
+    tape_dir = os.path.join(root, "tape")
+    chksums_dir = os.path.join(root, "chksums")
+    for d in (archive, tape_dir, chksums_dir):
+        os.makedirs(d)
+
+    # spots, and their storage paths
+    TapeFile.fileset_logical_paths = []
+    TapeFile.fileset_logical_path_map = {}
+    spot_paths = []
+    for s in range(spots):
+        spot_name = "spot-{}-bench".format(s)
+        logical_path = os.path.join(archive, "spot{}".format(s))
+        os.makedirs(logical_path)
+        TapeFile.fileset_logical_paths.append(logical_path)
+        TapeFile.fileset_logical_path_map[logical_path] = spot_name
+        spot_paths.append((spot_name, logical_path))
+
+    # files - the size is recorded, but the files are sparse so take no space
+    tape_files = []
+    listings = {}
+    checksums = {}
+    for i in range(files):
+        spot_name, logical_path = spot_paths[i % spots]
+        path = os.path.join(logical_path, "d{}".format(i % 10), "file{:08d}.dat".format(i))
+        size = rng.randint(1024, 100 * 1024**2)
+        if i < unverified:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file(path, size)
+            checksums.setdefault(spot_name, []).append(path)
+            stage = TapeFile.UNVERIFIED
+        else:
+            write_file(os.path.join(tape_dir, os.path.basename(path)), size)
+            stage = TapeFile.ONTAPE
+        tape_files.append(TapeFile(logical_path=path, size=size, stage=stage))
+        volume = "V{:05d}".format(i // 1000)
+        listings.setdefault(spot_name, {})[os.path.basename(path)] = SpotFile(
+            "/archive/{}/{}".format(spot_name, os.path.basename(path)), size, "TAPED", volume, str(i % 1000)
+        )
+    TapeFile.objects.bulk_create(tape_files, batch_size=5000)
+
+    # the spot listings, so that sd_ls is not needed
+    for spot_name, contents in listings.items():
+        spot_listings.put(spot_name, contents)
+
+    # checksum logs for verify
+    for spot_name, paths in checksums.items():
+        with open(os.path.join(chksums_dir, "{}.chksums.1".format(spot_name)), "w") as fh:
+            for path in paths:
+                fh.write("{:032x} {}\n".format(rng.getrandbits(128), path))
+
+    # quotas and requests
+    quota_objects = [Quota.objects.create(user="bench{}".format(q), size=100 * 1024**4,
+                                          email_address="") for q in range(quotas)]
+    retention = timezone.now() + datetime.timedelta(days=20)
+    on_tape = [f.logical_path for f in tape_files[unverified:]]
+    requests = []
+    for r in range(pattern_requests):
+        spot_name, logical_path = spot_paths[r % spots]
+        requests.append(TapeRequest(quota=quota_objects[r % quotas], retention=retention,
+                                    request_patterns=os.path.join(logical_path, "d{}".format(r % 10)) + "/",
+                                    label="pattern {}".format(r)))
+    for r in range(listing_requests):
+        listed = rng.sample(on_tape, min(files_per_listing, len(on_tape)))
+        requests.append(TapeRequest(quota=quota_objects[r % quotas], retention=retention,
+                                    request_files="\n".join(listed), label="listing {}".format(r)))
+    TapeRequest.objects.bulk_create(requests)
+
+    # restore disks, big enough for all the files
+    total_size = sum(f.size for f in tape_files)
+    for d in range(disks):
+        mountpoint = os.path.join(root, "restore{}".format(d))
+        os.makedirs(mountpoint)
+        RestoreDisk.objects.create(mountpoint=mountpoint, allocated_bytes=total_size, used_bytes=0)
+
+    return tape_dir, chksums_dir
+
+
+def retrieve_slots(slots):
+    """Prepare the retrievals for the slots, then run the sd_gets for all of the slots at once."""
+    retrievals = {}
+    for slot in slots:
+        slot_retrievals = retrieve_files.prepare_retrieval(slot)
+        if slot_retrievals is not None:
+            retrievals[slot.pk] = (slot, slot_retrievals)
+    return retrievals
+
+
+def run_sd_gets(retrievals):
+    """Run sd_get for each of the prepared slots, process the logs and finish the retrievals."""
+    n_files = 0
+    running = []
+    for slot, slot_retrievals in retrievals.values():
+        sd_gets = []
+        for target_disk, file_listing_filename, retrieved_to_file_map in slot_retrievals:
+            p, log_file_name = retrieve_files.start_sd_get(slot, file_listing_filename, target_disk)
+            sd_gets.append((p, log_file_name, target_disk, retrieved_to_file_map))
+        running.append((slot, sd_gets))
+    for slot, sd_gets in running:
+        n_files += retrieve_files.wait_sd_gets(slot, sd_gets)
+        retrieve_files.finish_retrieval(slot)
+    return n_files
+
+
+def call_views(client, paths):
+    for path in paths:
+        response = client.get(path)
+        if response.status_code != 200:
+            print("    {} returned {}".format(path, response.status_code))
+
+
+def git_commit():
+    """The current git commit of the NLA, or None if it is not in a git repository."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def run_benchmark(catalogue):
+    """Generate the catalogue and run the phases of the pipeline against it.
+
+       :param dict catalogue: the size of the catalogue, see ``DEFAULT_CATALOGUE``
+       :return: the results of each phase
+       :rtype: Dictionary
+    """
+    bench = Benchmark()
+    root = tempfile.mkdtemp(prefix="nla_benchmark_")
+    old_environ = dict(os.environ)
+    old_chksumsdir = verify.CHKSUMSDIR
+    try:
+        print("Generating catalogue in {}: {}".format(root, catalogue))
+        tape_dir, chksums_dir = bench.measure("generate_catalogue", generate_catalogue, root, **catalogue)
+
+        bench.measure("update_requests", process_requests.update_requests)
+        process_requests.adjust_slots()
+        bench.measure("load_slots", process_requests.load_slots)
+
+        slots = list(StorageDSlot.objects.filter(tape_request__isnull=False).select_related("tape_request"))
+        retrievals = bench.measure("prepare_retrieval", retrieve_slots, slots)
+
+        if TEST_VERSION:
+            # restore sparse files from the fake tape with no tape delays
+            os.environ.update({
+                "SD_EMULATOR_TAPE_DIR": tape_dir,
+                "SD_EMULATOR_TIME_SCALE": "0",
+                "SD_EMULATOR_COPY_MODE": "sparse",
+            })
+            bench.measure("wait_sd_get", run_sd_gets, retrievals)
+        else:
+            print("  wait_sd_get skipped: the StorageD emulator needs TEST_VERSION")
+            for slot, slot_retrievals in retrievals.values():
+                retrieve_files.redo_request(slot)
+
+        # verify reads the checksum logs in CHKSUMSDIR
+        verify.CHKSUMSDIR = chksums_dir
+        bench.measure("verify", verify.verify_files)
+
+        client = Client()
+        request_ids = list(TapeRequest.objects.values_list("pk", flat=True)[:20])
+        users = list(Quota.objects.values_list("user", flat=True)[:20])
+        bench.measure("api_requests", call_views, client, ["/nla_control/api/v1/requests"])
+        bench.measure("api_request", call_views, client,
+                      ["/nla_control/api/v1/requests/{}".format(r) for r in request_ids])
+        bench.measure("api_quota", call_views, client, ["/nla_control/api/v1/quota/{}".format(u) for u in users])
+        bench.measure("api_files", call_views, client, ["/nla_control/api/v1/files?match=spot0/d1&stages=TAR"])
+        bench.measure("metrics", call_views, client, ["/metrics"])
+
+        # expire all of the requests, so that tidy_requests removes them
+        TapeRequest.objects.update(retention=timezone.now() - datetime.timedelta(days=1))
+        bench.measure("tidy_requests", tidy_requests.tidy_requests)
+    finally:
+        verify.CHKSUMSDIR = old_chksumsdir
+        os.environ.clear()
+        os.environ.update(old_environ)
+        shutil.rmtree(root, ignore_errors=True)
+    return bench.results
+
+
+def previous_results(results_dir, catalogue):
+    """The most recent results for the same catalogue, or None."""
+    for path in sorted(glob.glob(os.path.join(results_dir, "*.json")), reverse=True):
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if data.get("catalogue") == catalogue and data.get("database") == connection.vendor:
+            return path, data
+    return None
+
+
+def compare_results(results, baseline, threshold=BENCHMARK_REGRESSION, min_seconds=BENCHMARK_MIN_SECONDS):
+    """Print the change in each phase from the baseline results, marking the regressions.
+
+       :return: the names of the phases that have regressed
+       :rtype: List[string]
+    """
+    regressions = []
+    print("{:<24} {:>10} {:>10} {:>8} {:>8}".format("phase", "seconds", "baseline", "queries", "baseline"))
+    for name, result in results["phases"].items():
+        base = baseline["phases"].get(name)
+        if base is None:
+            continue
+        slower = (result["seconds"] > base["seconds"] * threshold
+                  and result["seconds"] - base["seconds"] > min_seconds)
+        more_queries = result["queries"] > base["queries"] * threshold
+        flag = " REGRESSION" if slower or more_queries else ""
+        if flag:
+            regressions.append(name)
+        print("{:<24} {:>10.3f} {:>10.3f} {:>8} {:>8}{}".format(
+            name, result["seconds"], base["seconds"], result["queries"], base["queries"], flag
+        ))
+    return regressions
+
+
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+
+       :Script arguments:
+           * *<name>=<value>* -- the size of the catalogue, for each of the names in ``DEFAULT_CATALOGUE``
+           * *compare=<file>* -- compare with these results, rather than the last results for the same catalogue
+           * *output=<dir>* -- directory to write the results to, default ``BENCHMARK_RESULTS_DIR``
+
+       Exits with status 1 if any phase has regressed from the baseline results.
+    """
+    catalogue = dict(DEFAULT_CATALOGUE)
+    compare = None
+    results_dir = BENCHMARK_RESULTS_DIR
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name in catalogue:
+            catalogue[name] = int(value)
+        elif name == "compare":
+            compare = value
+        elif name == "output":
+            results_dir = value
+        else:
+            print("Unknown argument {}".format(arg))
+            return
+
+    # run against a test database, so the real NLA is never touched
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    tracemalloc.start()
+    try:
+        phases = run_benchmark(catalogue)
+    finally:
+        tracemalloc.stop()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.utcnow().isoformat(),
+        "database": connection.vendor,
+        "test_version": TEST_VERSION,
+        "catalogue": catalogue,
+        "phases": phases,
+    }
+
+    if compare is not None:
+        with open(compare) as fh:
+            baseline = (compare, json.load(fh))
+    else:
+        baseline = previous_results(results_dir, catalogue)
+
+    os.makedirs(results_dir, exist_ok=True)
+    results_file = os.path.join(results_dir, "{}-{}.json".format(
+        datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"), results["commit"] or "nocommit"
+    ))
+    with open(results_file, "w") as fh:
+        json.dump(results, fh, indent=2)
+    print("Results written to {}".format(results_file))
+
+    if baseline is not None:
+        print("Compared with {} (commit {})".format(baseline[0], baseline[1].get("commit")))
+        regressions = compare_results(results, baseline[1])
+        if regressions:
+            # exit non-zero, so the benchmark can fail a CI job
+            print("Regressions in {}".format(", ".join(regressions)))
+            sys.exit(1)
@@ -11,6 +11,7 @@ from django.db.models import Count
 from nla_control.models import *
 from nla_site.settings import *
 from nla_control.scripts.tidy_requests import in_other_request
+from nla_control.spot_listing import spot_listings
 import os
 import re
 import datetime
@@ -19,29 +20,15 @@ import sys
 from pytz import utc
 from django.db.models import Q
 import requests
-import subprocess
 from sizefield.utils import filesizeformat
 
 global pk
 pk=None
 
 def get_spot_contents(spot_name):
-    """Get a list of the files in the spot `spot_name`"""
-
-    sd_cmd = ["/usr/bin/python3", "/usr/bin/sd_ls", "-s", spot_name, "-L", "file"]
-    try:
-        output = subprocess.check_output(sd_cmd).decode("utf-8")
-    except subprocess.CalledProcessError:
-        return []
-
-    out_lines = output.split("\n")
-    spot_files = []
-    for out_item in out_lines:
-        out_file = out_item.split()
-        if len(out_file) == 11:
-            file_name = out_file[10]
-            spot_files.append(os.path.basename(file_name))
-    return spot_files
+    """Get the files in the spot `spot_name`, from the shared spot listing cache, as a dictionary of the basename of
+    each file to its SpotFile"""
+    return spot_listings.get(spot_name) or {}
 
 def clear_slots():
     """Remove all tasks from the slots directory"""
@@ -430,70 +417,56 @@ def reset_removed_files():
 
     stages = get_tape_stages()
 
-    # for each spot run sd_ls on the spot name to get the list of files in the spot back
+    # list all of the spots at once, then get the list of files in each spot back
+    spot_listings.prefetch(spot_files.keys())
     for spot_name in spot_files:
         print("Working on spot: ", spot_name, )
-        # should be able to replace this with get_spot_contents
-        sd_cmd = ["/usr/bin/python3", "/usr/bin/sd_ls", "-s", spot_name, "-L", "file"]
-        print("... sd_ls completed")
-        output = subprocess.check_output(sd_cmd).decode("utf-8")
-        out_lines = output.split("\n")
-        for out_item in out_lines:
-            out_file = out_item.split()
-            if len(out_file) == 11:
-                file_name = os.path.basename(out_file[10])
-                size = out_file[3]
-                for f in spot_files[spot_name]:
-                    if file_name in f:
-                        # see if this record exists as a TapeFile
-                        try:
-                            tf = TapeFile.objects.filter(logical_path = f).order_by('pk')
-                            if tf.count() > 1:
-                                # more than one TapeFile with logical path due to earlier coding error
-                                # delete the others
-                                print("Removing duplicate file for: ", f)
-                                for df in tf[1:]:
-                                    df.delete()
-
-                            tf = tf[0]
-                            status = stages[tf.stage]
-                        except Exception as e:
-                            print(e)
-                            status = "UNKNOWN"
-
-                        # recreate the TapeFile record if its status is UNKNOWN
-                        if status == "UNKNOWN":
-                            tf = TapeFile(logical_path=f, size=int(size), stage=TapeFile.ONTAPE)
-                            tf.save()
-                            print("Re-added file: ", f)
+        for file_name, spot_file in get_spot_contents(spot_name).items():
+            size = spot_file.size
+            for f in spot_files[spot_name]:
+                if file_name in f:
+                    # see if this record exists as a TapeFile
+                    try:
+                        tf = TapeFile.objects.filter(logical_path = f).order_by('pk')
+                        if tf.count() > 1:
+                            # more than one TapeFile with logical path due to earlier coding error
+                            # delete the others
+                            print("Removing duplicate file for: ", f)
+                            for df in tf[1:]:
+                                df.delete()
+
+                        tf = tf[0]
+                        status = stages[tf.stage]
+                    except Exception as e:
+                        print(e)
+                        status = "UNKNOWN"
+
+                    # recreate the TapeFile record if its status is UNKNOWN
+                    if status == "UNKNOWN":
+                        tf = TapeFile(logical_path=f, size=int(size), stage=TapeFile.ONTAPE)
+                        tf.save()
+                        print("Re-added file: ", f)
 
     fh.close()
 
 
 def get_spot_list(spot_name, spot_path, logical_path):
     print("Checking: ", spot_name)
-    try:
-        sd_cmd = ["/usr/bin/python3", "/usr/bin/sd_ls", "-s", spot_name, "-L", "file"]
-        output = subprocess.check_output(sd_cmd).decode("utf-8")
-    except KeyboardInterrupt:
-        raise
-    except Exception as e:
-        print ("Failed", str(e))
-        output = ""
-    out_lines = output.split("\n")
+    spot_contents = spot_listings.get(spot_name)
+    if spot_contents is None:
+        print ("Failed")
+        spot_contents = {}
     file_list = []
     size_list = []
-    for out_item in out_lines:
-        out_file = out_item.split()
-        if len(out_file) == 11:
-            spot_file_name = out_file[10]
-            spot_path_cmpts = spot_path.split("/")
-            local_spot_path = "/" + spot_path_cmpts[-2] + "/" + spot_path_cmpts[-1]
-            logical_file_name = spot_file_name.replace(local_spot_path, logical_path)
-            size = int(out_file[3])
-            if size > MIN_FILE_SIZE:
-                file_list.append(logical_file_name)
-                size_list.append(size)
+    for spot_file in spot_contents.values():
+        spot_file_name = spot_file.file_name
+        spot_path_cmpts = spot_path.split("/")
+        local_spot_path = "/" + spot_path_cmpts[-2] + "/" + spot_path_cmpts[-1]
+        logical_file_name = spot_file_name.replace(local_spot_path, logical_path)
+        size = spot_file.size
+        if size > MIN_FILE_SIZE:
+            file_list.append(logical_file_name)
+            size_list.append(size)
     return file_list, size_list
 
 
@@ -507,6 +480,8 @@ def reset_all_removed_files():
 
     print("Number of spots: {}".format(len(page)))
     stages = get_tape_stages()
+    # list all of the spots at once
+    spot_listings.prefetch([line.split()[0] for line in page if line.strip() != ''])
 
     for line in page:
         line = line.strip()
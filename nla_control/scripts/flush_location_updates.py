@@ -0,0 +1,153 @@
+""" Send the changes to the location of files from the ``LocationUpdate`` outbox to the Elastic Search index.
+
+ ``retrieve_files`` and ``tidy_requests`` add the location changes of the files they restore and remove to the
+ outbox, rather than calling Elastic Search themselves, so they are not slowed down by Elastic Search and no
+ updates are lost if it is unavailable.  This script sends the pending updates in batches of
+ ``LOCATION_UPDATE_BATCH_SIZE``, one call per location.  If a batch fails the updates in it are retried later,
+ backing off from ``LOCATION_UPDATE_BACKOFF_BASE`` up to ``LOCATION_UPDATE_BACKOFF_MAX`` seconds.  A new update of a
+ file supersedes the updates of the file that have not been sent (see ``LocationUpdate.enqueue``), so an old update
+ being retried cannot overwrite the newer location.  Sent updates are
+ kept for ``LOCATION_UPDATE_RETENTION`` days, so that they can be replayed if the index has to be reconciled.
+
+ This is designed to be used via the django-extensions runscript command:
+
+ ``$ python manage.py runscript flush_location_updates``
+
+ To replay the updates sent since a date, e.g. after restoring the index from a backup:
+
+ ``$ python manage.py runscript flush_location_updates --script-args replay=2026-10-01``
+"""
+
+from nla_control.models import LocationUpdate
+from nla_control.leases import Lease
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profile_phase, profiled
+
+from django.conf import settings
+from django.utils import timezone
+
+import datetime
+import sys
+from pytz import utc
+
+# number of updates sent to Elastic Search at once
+LOCATION_UPDATE_BATCH_SIZE = getattr(settings, "LOCATION_UPDATE_BATCH_SIZE", 5000)
+# delay, in seconds, before retrying failed updates.  This doubles with each failure, up to the maximum.
+LOCATION_UPDATE_BACKOFF_BASE = getattr(settings, "LOCATION_UPDATE_BACKOFF_BASE", 30)
+LOCATION_UPDATE_BACKOFF_MAX = getattr(settings, "LOCATION_UPDATE_BACKOFF_MAX", 3600)
+# number of days to keep the sent updates for
+LOCATION_UPDATE_RETENTION = getattr(settings, "LOCATION_UPDATE_RETENTION", 30)
+
+
+def get_due_updates(now, batch_size):
+    """Get the oldest updates that have not been sent and are not waiting to be retried."""
+    return list(
+        LocationUpdate.objects.filter(sent__isnull=True)
+        .exclude(next_attempt__gt=now)
+        .order_by("pk")[:batch_size]
+    )
+
+
+def send_updates(updates, now):
+    """Send a batch of updates to Elastic Search, with one call for each location.  Only the latest update of each
+    file is sent, the earlier ones are marked as sent with it.
+
+    :param updates: the LocationUpdates to send, oldest first
+    :param datetime now: the time to record the updates as sent
+    :return: the number of updates sent
+    :rtype: integer
+    """
+    # imported here so that the Elastic Search client is only loaded when there are updates to send
+    from fbi_core import update_file_location
+
+    # the latest location of each file, and the updates that set it
+    latest = {}
+    for u in updates:
+        latest[u.logical_path] = u.location
+    by_location = {}
+    for u in updates:
+        by_location.setdefault(latest[u.logical_path], []).append(u)
+
+    n_sent = 0
+    for location, location_updates in by_location.items():
+        path_list = list(set(u.logical_path for u in location_updates))
+        try:
+            update_file_location(path_list=path_list, location=location)
+        except Exception as e:
+            print("Failed updating Elastic Search Index for {} files {}: {}".format(len(path_list), location, e))
+            for u in location_updates:
+                u.attempts += 1
+                delay = min(LOCATION_UPDATE_BACKOFF_BASE * 2 ** (u.attempts - 1), LOCATION_UPDATE_BACKOFF_MAX)
+                u.next_attempt = now + datetime.timedelta(seconds=delay)
+                u.last_error = str(e)
+            LocationUpdate.objects.bulk_update(location_updates, ["attempts", "next_attempt", "last_error"])
+        else:
+            LocationUpdate.objects.filter(pk__in=[u.pk for u in location_updates]).update(sent=now)
+            n_sent += len(location_updates)
+    return n_sent
+
+
+def flush_location_updates(batch_size=LOCATION_UPDATE_BATCH_SIZE, lease=None):
+    """Send all of the pending updates that are due, in batches, and remove the old sent updates.
+
+    :param integer batch_size: the number of updates to send at once
+    :param Lease lease: the flush_location_updates lease - no more updates are sent if it is lost
+    :return: the number of updates sent
+    :rtype: integer
+    """
+    now = timezone.now()
+    n_sent = 0
+    seen = set()
+    while True:
+        if lease is not None:
+            lease.check()
+        updates = [u for u in get_due_updates(now, batch_size) if u.pk not in seen]
+        if len(updates) == 0:
+            break
+        # don't pick up the updates that failed in this run again
+        seen.update(u.pk for u in updates)
+        n_sent += send_updates(updates, now)
+    print("Sent {} location updates".format(n_sent))
+
+    # remove the old sent updates
+    LocationUpdate.objects.filter(
+        sent__lt=now - datetime.timedelta(days=LOCATION_UPDATE_RETENTION)
+    ).delete()
+    return n_sent
+
+
+def replay_location_updates(since):
+    """Mark the updates sent since a time as pending again, so that they are sent by the next flush.  Used to
+    reconcile the Elastic Search index with the NLA.
+
+    :param datetime since: replay the updates sent at or after this time
+    :return: the number of updates to replay
+    :rtype: integer
+    """
+    n_replay = LocationUpdate.objects.filter(sent__gte=since).update(
+        sent=None, attempts=0, next_attempt=None, last_error=""
+    )
+    print("Replaying {} location updates sent since {}".format(n_replay, since))
+    return n_replay
+
+
+@profiled("flush_location_updates")
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+
+       :Script arguments:
+           * *replay=YYYY-MM-DD* -- send the updates that were sent since the date again
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+    """
+    with Lease("flush_location_updates") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit()
+
+        for arg in args:
+            if arg.startswith("replay="):
+                since = datetime.datetime.strptime(arg[len("replay="):], "%Y-%m-%d").replace(tzinfo=utc)
+                with profile_phase("replay"):
+                    replay_location_updates(since)
+        with phase_timer("flush_location_updates"):
+            flush_location_updates(lease=lease)
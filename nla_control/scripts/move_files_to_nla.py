@@ -18,7 +18,8 @@ from nla_control.models import TapeFile
 import os, sys
 import requests
 from nla_site.settings import *
-import subprocess
+from nla_control.leases import Lease
+from nla_control.profiling import profile_phase, profiled
 
 __author__ = 'sjp23'
 
@@ -46,28 +47,25 @@ def get_filesets():
 
     return fileset_list
 
-def run():
+@profiled("move_files_to_nla")
+def run(*args):
     """Function picked up by django-extensions. Runs the scan for matching filesets.
 
-       :param: None
+       :param \*args: additional arguments to the script, see below
        :return: None
+
+       :Script arguments:
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
     """
 
     # First of all check if the process is running - if it is then don't start running again
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "move_files_to_nla" in l and not "/bin/sh" in l:
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:
-        print("Process already running, exiting")
-        sys.exit()
-    else:
-        filesets = get_filesets()
+    with Lease("move_files_to_nla") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit()
+
+        with profile_phase("get_filesets"):
+            filesets = get_filesets()
         for fs in filesets:
             for directory, dirs, files in os.walk(fs):
                 for f in files:
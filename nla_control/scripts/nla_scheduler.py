@@ -0,0 +1,234 @@
+""" Long running scheduler for the NLA, replacing the separate cron runs of process_requests, retrieve_files,
+ tidy_requests, verify and flush_location_updates.
+
+ Each of these is run as a phase of the scheduler, on the interval (in seconds) given for it in
+ ``NLA_SCHEDULER_INTERVALS`` in ``settings.py``.  Because the scheduler stays running it only pays the Django
+ startup once, and keeps the storage path mappings loaded between phases, refreshing them every
+ ``NLA_SCHEDULER_CACHE_REFRESH`` seconds.  The spot listings are kept in memory between phases too, until they
+ expire (see ``nla_control.spot_listing``).
+
+ Retrievals are run in threads, so that a long running sd_get does not hold up the other phases.  Each thread
+ holds one of the per-host retrieval leases of ``retrieve_files``, so there are at most ``MAX_RETRIEVALS``
+ retrievals on a host between the scheduler and any cron runs of ``retrieve_files``.
+
+ The quotas and the slot states are not cached: they are changed by the web views and by the schedulers on other
+ hosts, and the phases decide what to do from them, so they are read fresh in each phase.  Each phase reads them
+ in a bounded number of queries.
+
+ Only one scheduler can run on a host - this is enforced with a lock on ``NLA_SCHEDULER_LOCK_FILE``.  Schedulers
+ on different hosts share the work through database leases (see ``nla_control.leases``).  Sending
+ SIGTERM or SIGINT stops the scheduler after the current phase has finished.  sd_get processes that are still
+ running are left to finish and are picked up by ``check_happy`` when the scheduler is restarted.
+
+ This is designed to be used via the django-extensions runscript command, instead of the cron entries for the
+ scripts above:
+
+ ``$ python manage.py runscript nla_scheduler``
+"""
+
+from nla_control.models import *
+from nla_site.settings import *
+from nla_control.leases import Lease, LeaseLost
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profiled
+
+from nla_control.scripts.process_requests import process_requests
+from nla_control.scripts import retrieve_files
+from nla_control.scripts.tidy_requests import tidy_requests
+from nla_control.scripts.verify import verify_files
+from nla_control.scripts.flush_location_updates import flush_location_updates
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+import fcntl
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# interval, in seconds, between runs of each phase
+NLA_SCHEDULER_INTERVALS = getattr(settings, "NLA_SCHEDULER_INTERVALS", {
+    "process_requests": 60,
+    "retrieve_files": 10,
+    "tidy_requests": 3600,
+    "verify": 3600,
+    "flush_location_updates": 30,
+})
+# interval, in seconds, between reloading the storage paths
+NLA_SCHEDULER_CACHE_REFRESH = getattr(settings, "NLA_SCHEDULER_CACHE_REFRESH", 3600)
+# lock file to stop more than one scheduler running on a host
+NLA_SCHEDULER_LOCK_FILE = getattr(settings, "NLA_SCHEDULER_LOCK_FILE", "/tmp/nla_scheduler.lock")
+# seconds to wait for running retrieval threads when shutting down
+NLA_SCHEDULER_SHUTDOWN_TIMEOUT = getattr(settings, "NLA_SCHEDULER_SHUTDOWN_TIMEOUT", 30)
+
+
+class Scheduler(object):
+    """Run the NLA phases on their intervals until stopped.
+
+       :var threading.Event stop_event: set to stop the scheduler
+       :var dict last_run: time each phase was last run
+       :var dict retrievals: the retrieval thread running for each slot, keyed by slot pk
+    """
+
+    def __init__(self, intervals=None):
+        if intervals is None:
+            intervals = NLA_SCHEDULER_INTERVALS
+        self.intervals = intervals
+        self.stop_event = threading.Event()
+        self.last_run = {}
+        self.caches_loaded = None
+        self.retrievals = {}
+        self.phases = {
+            "process_requests": self.process_requests,
+            "retrieve_files": self.retrieve_files,
+            "tidy_requests": self.tidy_requests,
+            "verify": self.verify,
+            "flush_location_updates": self.flush_location_updates,
+        }
+
+    def stop(self, signum=None, frame=None):
+        """Stop the scheduler after the current phase.  Used as the signal handler for SIGTERM and SIGINT."""
+        print("Stopping scheduler")
+        self.stop_event.set()
+
+    def refresh_caches(self):
+        """Load the storage paths if they are older than ``NLA_SCHEDULER_CACHE_REFRESH``.  The spot listings expire
+           on their own (see ``nla_control.spot_listing``)."""
+        now = time.time()
+        if self.caches_loaded is None or now - self.caches_loaded > NLA_SCHEDULER_CACHE_REFRESH:
+            print("Load storage paths")
+            try:
+                TapeFile.load_storage_paths()
+            except Exception as e:
+                # keep the old mappings, if there are any, and try again next time round
+                print("Could not load storage paths: {}".format(e))
+                return
+            self.caches_loaded = now
+
+    def process_requests(self, lease):
+        process_requests()
+
+    def retrieve_files(self, lease=None):
+        """Check the slots, and start a retrieval thread for each slot with a request that has not started, while
+           one of the retrieval leases of this host is free."""
+        # forget the finished retrievals
+        for slot_pk in list(self.retrievals.keys()):
+            if not self.retrievals[slot_pk].is_alive():
+                del self.retrievals[slot_pk]
+
+        for slot in StorageDSlot.objects.all().select_related("tape_request"):
+            if slot.tape_request is None or slot.pk in self.retrievals:
+                continue
+            elif slot.pid is not None:
+                retrieve_files.check_happy(slot)
+            else:
+                retrieval_lease = retrieve_files.acquire_retrieval_lease()
+                if retrieval_lease is None:
+                    print("  Already running {} transfers on this host".format(MAX_RETRIEVALS))
+                    break
+                print("  Process slot %s" % slot.pk)
+                t = threading.Thread(target=self.retrieve_slot, args=(slot, retrieval_lease), daemon=True)
+                self.retrievals[slot.pk] = t
+                t.start()
+
+    def retrieve_slot(self, slot, retrieval_lease):
+        """Run the retrieval for a slot, then release the retrieval lease.  This is the target of the retrieval
+           threads.
+
+           :param StorageDSlot slot: the slot to run the retrieval for
+           :param Lease retrieval_lease: the retrieval lease of this host taken for the retrieval
+        """
+        try:
+            retrieve_files.retrieve_slot(slot)
+        except Exception:
+            print("Retrieval failed for slot {}".format(slot.pk))
+            traceback.print_exc()
+        finally:
+            retrieval_lease.release()
+            # each thread has its own database connection
+            connection.close()
+
+    def tidy_requests(self, lease):
+        tidy_requests()
+
+    def verify(self, lease):
+        verify_files(lease=lease)
+
+    def flush_location_updates(self, lease):
+        flush_location_updates(lease=lease)
+
+    def run_phase(self, name):
+        """Run a single phase, timing it and catching any errors so that the scheduler keeps running.  Phases other
+           than retrieve_files are run while holding the lease of the same name, so that they do not run at the
+           same time as the phase on another host, or the cron script.  The phases are passed the lease, so that the
+           long running phases can stop if it is lost."""
+        print("Start phase {}".format(name))
+        start = time.time()
+        close_old_connections()
+        try:
+            if name == "retrieve_files":
+                # retrievals hold a retrieval lease of this host, and a lease on each slot, instead
+                with phase_timer(name):
+                    self.phases[name]()
+            else:
+                with Lease(name) as lease:
+                    if lease.held:
+                        with phase_timer(name):
+                            self.phases[name](lease)
+                    else:
+                        print("Phase {} already running elsewhere".format(name))
+        except LeaseLost:
+            print("Phase {} stopped: lease lost".format(name))
+        except Exception:
+            print("Phase {} failed".format(name))
+            traceback.print_exc()
+        self.last_run[name] = time.time()
+        print("End phase {} in {:.2f}s".format(name, self.last_run[name] - start))
+
+    def run(self):
+        """Run the phases that are due, then sleep until the next phase is due or the scheduler is stopped."""
+        while not self.stop_event.is_set():
+            self.refresh_caches()
+            now = time.time()
+            for name in self.phases:
+                if name not in self.intervals or self.stop_event.is_set():
+                    continue
+                if now - self.last_run.get(name, 0) >= self.intervals[name]:
+                    self.run_phase(name)
+            # time until the next phase is due
+            now = time.time()
+            wait = min(
+                [self.last_run.get(name, 0) + self.intervals[name] - now for name in self.intervals]
+            )
+            self.stop_event.wait(max(wait, 1))
+
+        # give the retrieval threads a chance to finish
+        deadline = time.time() + NLA_SCHEDULER_SHUTDOWN_TIMEOUT
+        for t in self.retrievals.values():
+            t.join(max(deadline - time.time(), 0))
+        print("Scheduler stopped")
+
+
+@profiled("nla_scheduler")
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+
+       :Script arguments:
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+             The summary is printed when the scheduler is stopped.
+    """
+    lock_file = open(NLA_SCHEDULER_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("Scheduler already running, exiting")
+        sys.exit()
+
+    scheduler = Scheduler()
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    print("Starting scheduler")
+    scheduler.run()
+    lock_file.close()
@@ -19,13 +19,149 @@
 # import nla objects
 from nla_control.models import *
 from nla_site.settings import *
+from nla_control.leases import Lease
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profile_phase, profiled
 
+from django.conf import settings
 from django.core.mail import send_mail
-from django.db.models import Q
+from django.db.models import Q, Sum, Count
+from django.utils import timezone
 
-import subprocess
+import datetime
 import sys
-import random
+
+
+# Overlap (in seconds) between the high-water mark recorded by one run of update_requests and the
+# TapeFiles considered on the next run.  This catches TapeFiles that were saved while update_requests
+# was running.  Re-adding a file already in a request does nothing.
+UPDATE_REQUESTS_OVERLAP = getattr(settings, "UPDATE_REQUESTS_OVERLAP", 60)
+
+# Scales for the fair-share scheduling of requests in load_slots.  A request that has been waiting for
+# SCHEDULER_AGE_SCALE hours has double the priority of a new one, and a request with SCHEDULER_SIZE_SCALE bytes
+# left to retrieve has half the priority of an empty one.
+SCHEDULER_AGE_SCALE = getattr(settings, "SCHEDULER_AGE_SCALE", 24)
+SCHEDULER_SIZE_SCALE = getattr(settings, "SCHEDULER_SIZE_SCALE", 1024**4)
+
+
+# Number of logical paths to put in each ``logical_path__in`` query, and number of rows to insert in each
+# ``bulk_create`` when adding files to requests
+MATCH_BATCH_SIZE = getattr(settings, "MATCH_BATCH_SIZE", 10000)
+
+# stages of the files that can be added to requests - UNVERIFIED is only used for the _VERIFY requests
+REQUEST_STAGES = [TapeFile.ONTAPE, TapeFile.RESTORING]
+VERIFY_STAGES = [TapeFile.UNVERIFIED]
+
+
+def get_updated_tape_files(since):
+    """Get the TapeFiles that have been saved since the high-water mark ``since`` and are in a stage
+    that update_requests is interested in.  Only the id, logical path, stage and time of the last update
+    are returned, as a list of tuples.
+
+    :param DateTime since: the earliest high-water mark of the requests to be updated
+    :return: list of (id, logical_path, stage, last_updated)
+    :rtype: List[Tuple(integer, string, integer, DateTime)]
+    """
+    updated_files = TapeFile.objects.filter(
+        Q(last_updated__gte=since)
+        & Q(stage__in=VERIFY_STAGES + REQUEST_STAGES)
+    ).values_list("id", "logical_path", "stage", "last_updated")
+    return list(updated_files)
+
+
+def get_listed_tape_files(request_files):
+    """Get the TapeFiles whose logical paths are in ``request_files``, in batches of ``MATCH_BATCH_SIZE``.
+
+    :param request_files: the logical paths to find
+    :return: dictionary mapping logical path to (id, stage)
+    :rtype: Dictionary[string:Tuple(integer, integer)]
+    """
+    request_files = list(request_files)
+    listed_files = {}
+    for i in range(0, len(request_files), MATCH_BATCH_SIZE):
+        batch_files = request_files[i:i + MATCH_BATCH_SIZE]
+        for f_id, f_path, f_stage in TapeFile.objects.filter(
+            Q(stage__in=VERIFY_STAGES + REQUEST_STAGES) & Q(logical_path__in=batch_files)
+        ).values_list("id", "logical_path", "stage"):
+            listed_files[f_path] = (f_id, f_stage)
+    return listed_files
+
+
+def get_pattern_tape_files(patterns):
+    """Get the TapeFiles whose logical paths contain any of ``patterns``, in a single query.
+
+    :param patterns: the patterns to match
+    :return: list of (id, logical_path, stage)
+    :rtype: List[Tuple(integer, string, integer)]
+    """
+    if len(patterns) == 0:
+        return []
+    query = Q()
+    for pattern in patterns:
+        query = query | Q(logical_path__contains=pattern)
+    pattern_files = TapeFile.objects.filter(
+        Q(stage__in=REQUEST_STAGES) & query
+    ).values_list("id", "logical_path", "stage")
+    return list(pattern_files)
+
+
+def match_updated_tape_files(r, updated_files, stages):
+    """Match the TapeFiles that have been updated since the request was last updated against the
+    ``request_files`` or ``request_patterns`` of the request.
+
+    :param TapeRequest r: the request to match the files against
+    :param updated_files: the updated TapeFiles, as returned by ``get_updated_tape_files``
+    :param stages: the stages that the matched files must be in
+    :return: ids of the TapeFiles that match the request
+    :rtype: List[integer]
+    """
+    mark = r.files_updated - datetime.timedelta(seconds=UPDATE_REQUESTS_OVERLAP)
+    candidates = [
+        (f_id, f_path) for f_id, f_path, f_stage, f_updated in updated_files
+        if f_stage in stages and f_updated is not None and f_updated >= mark
+    ]
+    if len(candidates) == 0:
+        return []
+    if r.request_files != "":
+        request_files = set(r.request_files.split())
+        return [f_id for f_id, f_path in candidates if f_path in request_files]
+    elif r.request_patterns:
+        return [f_id for f_id, f_path in candidates if r.request_patterns in f_path]
+    return []
+
+
+def add_request_files(request_file_pairs):
+    """Add files to requests by inserting the (request id, TapeFile id) pairs directly into the
+    ``TapeRequest.files`` through table.  Pairs that are already present are ignored.
+
+    :param request_file_pairs: list of (TapeRequest id, TapeFile id)
+    :type request_file_pairs: List[Tuple(integer, integer)]
+    """
+    through = TapeRequest.files.through
+    through.objects.bulk_create(
+        [through(taperequest_id=r_id, tapefile_id=f_id) for r_id, f_id in request_file_pairs],
+        batch_size=MATCH_BATCH_SIZE,
+        ignore_conflicts=True
+    )
+
+
+def get_linked_files(request_file_pairs):
+    """Get the (request id, TapeFile id) pairs that are already in the ``TapeRequest.files`` through table, in
+    batches of ``MATCH_BATCH_SIZE`` files.  The files updated in the overlap window (``UPDATE_REQUESTS_OVERLAP``)
+    are matched again on the next run, so many of the matched pairs may already be present.
+
+    :param request_file_pairs: list of (TapeRequest id, TapeFile id)
+    :return: the pairs that are already present
+    :rtype: Set[Tuple(integer, integer)]
+    """
+    request_ids = list(set(r_id for r_id, f_id in request_file_pairs))
+    file_ids = list(set(f_id for r_id, f_id in request_file_pairs))
+    linked = set()
+    for i in range(0, len(file_ids), MATCH_BATCH_SIZE):
+        linked.update(TapeRequest.files.through.objects.filter(
+            taperequest_id__in=request_ids, tapefile_id__in=file_ids[i:i + MATCH_BATCH_SIZE]
+        ).values_list("taperequest_id", "tapefile_id"))
+    return linked
 
 
 def update_requests():
@@ -41,68 +177,101 @@ def update_requests():
     available in the future.  This in turn allows users to request files that they know will be appearing
     (for example Sentinel data) without having to submit further requests.
 
-    """
-    requests = TapeRequest.objects.all().order_by("request_date")
+    Requests that have not been matched before (``files_updated`` is not set) are matched against all of the
+    TapeFiles.  Requests that have been matched before are only matched against the TapeFiles that have been
+    saved since the request was last matched (``TapeFile.last_updated``), so the cost of each run scales
+    with the number of newly arrived files rather than the size of the NLA system.
 
+    The matching is done for all of the requests at once: the candidate files are fetched in a few queries,
+    matched in memory, and the (request, file) pairs that are not already present are inserted into the ``files``
+    through table in bulk.  Only the requests that were active, had files matched or have not been matched before
+    can change whether they are active, so only these are checked for files still to be retrieved.
+    """
+    now = timezone.now()
+    requests = list(TapeRequest.objects.all().select_related("quota").order_by("request_date"))
+
+    # get the files updated since the earliest high-water mark, once for all of the requests
+    marks = [r.files_updated for r in requests if r.files_updated is not None]
+    if len(marks) != 0:
+        since = min(marks) - datetime.timedelta(seconds=UPDATE_REQUESTS_OVERLAP)
+        updated_files = get_updated_tape_files(since)
+    else:
+        updated_files = []
+
+    # get the files for the requests that have not been matched before, once for all of those requests
+    new_requests = [r for r in requests if r.files_updated is None]
+    listed_files = get_listed_tape_files(
+        set(f for r in new_requests for f in r.request_files.split())
+    )
+    pattern_files = get_pattern_tape_files(
+        set(r.request_patterns for r in new_requests if r.request_files == "" and r.request_patterns)
+    )
+
+    # ids of the files matched by each request
+    matched = {}
     for r in requests:
-        new_files = []
-        present_tape_files = []
-        print(
-            "    Request ID " + str(r.id) + " user " + r.quota.user,
-        )
-        # check whether the number of files downloaded is the same number as requested and continue if it is
-        nfiles = r.files.filter(Q(stage=TapeFile.ONDISK) | Q(stage=TapeFile.RESTORED))
-        nreq_files = len(r.request_files.split())
-        if nfiles == nreq_files:
-            print("        deactivating as completed")
-            r.active_request = False
-            r.save()
-            continue
         if r.quota.user == "_VERIFY":
             # Special case for verify to speed up process_requests
-            request_files = r.request_files.split()
-            present_tape_files = TapeFile.objects.filter(
-                Q(stage=TapeFile.UNVERIFIED) & Q(logical_path__in=request_files)
-            )
-            if len(present_tape_files) != 0:
-                r.active_request = True
-                r.files.set(present_tape_files.all())
-                r.save()
-                print(
-                    "       making active with "
-                    + str(present_tape_files.count())
-                    + " new files"
-                )
+            stages = VERIFY_STAGES
+        else:
+            stages = REQUEST_STAGES
+
+        if r.files_updated is None:
+            # first time the request has been seen - match against all of the files in the NLA system
+            if r.request_files != "":
+                # if the request is a file request
+                new_files = []
+                for f_path in r.request_files.split():
+                    if f_path in listed_files and listed_files[f_path][1] in stages:
+                        new_files.append(listed_files[f_path][0])
+            elif r.request_patterns and r.quota.user != "_VERIFY":
+                # if the request is a pattern request
+                new_files = [f_id for f_id, f_path, f_stage in pattern_files if r.request_patterns in f_path]
             else:
-                print()
-            continue
-
-        elif r.request_files != "":
-            # if the request is a file request
-            # get the files in the request
-            request_files = r.request_files.split()
-            # get the TapeFile QuerySet for the files that are in the request and present on tape in the NLA system
-            new_files = TapeFile.objects.filter(
-                (Q(stage=TapeFile.ONTAPE) | Q(stage=TapeFile.RESTORING))
-                & Q(logical_path__in=request_files)
-            )
-
-        elif r.request_patterns != "":
-            # if the request is a pattern request
-            new_files = TapeFile.objects.filter(
-                (Q(stage=TapeFile.ONTAPE) | Q(stage=TapeFile.RESTORING))
-                & Q(logical_path__contains=r.request_patterns)
-            )
-
-        if new_files.count() != 0:
-            r.files.add(*(list(new_files.all())))
-            r.active_request = True
-            print("	  making active with " + str(new_files.count()) + " new files")
-            r.save()
+                new_files = []
         else:
-            print("	  making inactive as no new files")
-            r.active_request = False
-            r.save()
+            # only match the files that have arrived or changed stage since the last run
+            new_files = match_updated_tape_files(r, updated_files, stages)
+
+        if len(new_files) != 0:
+            matched[r.id] = new_files
+
+    # only add the files that are not already in the requests
+    linked = get_linked_files([(r_id, f_id) for r_id, f_ids in matched.items() for f_id in f_ids])
+    request_file_pairs = []
+    verify_matched = []
+    for r in requests:
+        new_files = [f_id for f_id in matched.get(r.id, []) if (r.id, f_id) not in linked]
+        if len(new_files) != 0:
+            print("    Request ID {} user {} adding {} new files".format(r.id, r.quota.user, len(new_files)))
+            request_file_pairs.extend((r.id, f_id) for f_id in new_files)
+            if r.quota.user == "_VERIFY":
+                verify_matched.append(r.id)
+
+    add_request_files(request_file_pairs)
+
+    # the request is active if any of its files are still to be retrieved.  An inactive request with no files
+    # matched on this run has no files that have gone back on tape, so stays inactive - only the other requests
+    # are checked, in one query.
+    request_ids = [r.id for r in requests if r.quota.user != "_VERIFY"]
+    to_check = [
+        r.id for r in requests
+        if r.quota.user != "_VERIFY" and (r.active_request or r.files_updated is None or r.id in matched)
+    ]
+    active_ids = set(
+        TapeRequest.files.through.objects.filter(
+            taperequest_id__in=to_check, tapefile__stage__in=REQUEST_STAGES
+        ).values_list("taperequest_id", flat=True).distinct()
+    )
+    # _VERIFY requests are only made active when they have new files, and are otherwise left alone
+    verify_ids = [r.id for r in requests if r.quota.user == "_VERIFY"]
+    make_active = [r_id for r_id in request_ids if r_id in active_ids] + verify_matched
+    make_inactive = [r_id for r_id in request_ids if r_id not in active_ids]
+
+    print("    Making {} requests active and {} requests inactive".format(len(make_active), len(make_inactive)))
+    TapeRequest.objects.filter(pk__in=make_active).update(active_request=True, files_updated=now)
+    TapeRequest.objects.filter(pk__in=make_inactive).update(active_request=False, files_updated=now)
+    TapeRequest.objects.filter(pk__in=verify_ids).exclude(pk__in=verify_matched).update(files_updated=now)
 
 
 def adjust_slots():
@@ -121,84 +290,106 @@ def adjust_slots():
             slot.delete()
 
 
+def request_priority(request, user_slots, now):
+    """Calculate the fair-share priority of a request for the next free slot.  The priority is the product of:
+
+      - a user term, ``1 / (1 + slots already used by the user)``, so that users share the slots evenly
+
+      - an age term, ``1 + hours waiting / SCHEDULER_AGE_SCALE``, so that old requests are not starved
+
+      - a size term, ``1 / (1 + remaining bytes / SCHEDULER_SIZE_SCALE)``, so that small requests are not
+        held up behind large ones
+
+    :param TapeRequest request: the request, annotated with ``remaining_bytes``
+    :param user_slots: dictionary of user to number of slots currently used by that user
+    :param DateTime now: the current time
+    :return: the priority - higher values are scheduled first
+    :rtype: float
+    """
+    user_term = 1.0 / (1 + user_slots.get(request.quota.user, 0))
+    if request.request_date is not None:
+        waiting = max((now - request.request_date).total_seconds(), 0) / 3600.0
+    else:
+        waiting = 0.0
+    age_term = 1.0 + waiting / SCHEDULER_AGE_SCALE
+    size_term = 1.0 / (1 + (request.remaining_bytes or 0) / float(SCHEDULER_SIZE_SCALE))
+    return user_term * age_term * size_term
+
+
 def load_slots():
     """Fill the slots with currently active requests.
     The algorithm runs until no slots or no requests are left, thereby maximising the utilisation of the slots.
     Users are only allowed to use a certain number of slots concurrently - this value is set in ``MAX_SLOTS_PER_USER``
     in ``settings.py``.
+
+    The slots, the active requests (with the number of bytes still on tape) and their quotas are loaded once,
+    and the requests are assigned to the free slots in memory.  Each free slot is given the waiting request with
+    the highest priority, as calculated by ``request_priority``, which weights the share of the slots each user
+    already has, how long the request has been waiting and how many bytes it has left to retrieve.  Requests
+    whose retrieval has failed are not loaded until their ``retry_after`` time (see ``redo_request``).
     """
-    # first come first served
-    # change the order to a random order until a better solution can be found
-    requests = TapeRequest.objects.filter(active_request=True).order_by("-request_date")
-    request_order = list(range(0, requests.count()))
-    random.shuffle(request_order)
-    irequest = 0
-
-    # loop over all the slots, look for a request to add to it
-    slots = StorageDSlot.objects.all()
-    for s in range(0, slots.count()):
-        # if the slot is not None, then it is occupied
-        if slots[s].tape_request is not None:
-            # if the slot continues a non-active (completed) request then reset the slot
-            if not slots[s].tape_request.active_request:
-                slot = slots[s]
+    now = timezone.now()
+    slots = list(StorageDSlot.objects.all().select_related("tape_request__quota").order_by("pk"))
+    requests = list(
+        TapeRequest.objects.filter(active_request=True)
+        .exclude(quota__user="_VERIFY")
+        .exclude(retry_after__gt=now)
+        .select_related("quota")
+        .annotate(remaining_bytes=Sum("files__size", filter=Q(files__stage=TapeFile.ONTAPE)),
+                  remaining_files=Count("files", filter=Q(files__stage=TapeFile.ONTAPE)))
+        .order_by("request_date", "pk")
+    )
+
+    changed_slots = []
+    free_slots = []
+    user_slots = {}
+    slotted_requests = set()
+
+    # reset slots containing non-active (completed) requests and count the slots each user has
+    for slot in slots:
+        if slot.tape_request is not None:
+            if not slot.tape_request.active_request:
                 print(
                     "Removing request {} from slot {} as request is no longer active".format(
                         slot.tape_request.pk, slot.pk
                     )
                 )
                 slot.tape_request = None
-                slot.save()
+                changed_slots.append(slot)
             else:
+                quota_user = slot.tape_request.quota.user
+                user_slots[quota_user] = user_slots.get(quota_user, 0) + 1
+                slotted_requests.add(slot.tape_request.pk)
                 continue
-
-        # find the next request
-        while irequest < len(request_order):
-            # check whether this request is already in a slot
-            c_request = request_order[irequest]  # map from random list
-            if (
-                StorageDSlot.objects.filter(tape_request=requests[c_request]).count()
-                != 0
-            ):
-                # on to the next one
-                irequest += 1
-                continue
-
-            # get the user from the request
-            quota_user = requests[c_request].quota.user
-
-            # don't process requests from the "_VERIFY" user
-            if quota_user == "_VERIFY":
-                irequest += 1
-                continue
-
-            # get the number of requests the user already has in the slots
-            user_slots = 0
-            for ts in slots:
-                if ts.tape_request != None:
-                    if ts.tape_request.quota.user == quota_user:
-                        user_slots += 1
-
-            # don't allow the user to add another request if they have gone over their quota
-            if user_slots + 1 > MAX_SLOTS_PER_USER:
-                # need to go onto the next request
-                irequest += 1
-            else:
-                break
-
-        # check if any requests left to add - end loop if not
-        if irequest >= requests.count():
+        free_slots.append(slot)
+
+    # requests that are waiting for a slot - requests with no files left on tape are only waiting for files
+    # being restored by other requests, so do not need a slot
+    waiting = [r for r in requests if r.pk not in slotted_requests and r.remaining_files != 0]
+
+    for slot in free_slots:
+        # don't allow the user to add another request if they have gone over their quota
+        candidates = [
+            r for r in waiting if user_slots.get(r.quota.user, 0) < MAX_SLOTS_PER_USER
+        ]
+        if len(candidates) == 0:
             break
+        # max returns the first of equal priorities, i.e. the oldest request
+        request = max(candidates, key=lambda r: request_priority(r, user_slots, now))
+        waiting.remove(request)
+        user_slots[request.quota.user] = user_slots.get(request.quota.user, 0) + 1
 
         # assign the request to the slot
-        slot = slots[s]
-        slot.tape_request = requests[c_request]
-        print("Assigning request {} to slot {}".format(slot.tape_request.pk, slot.pk))
-        slot.save()
-        irequest += 1
+        slot.tape_request = request
+        print("Assigning request {} to slot {}".format(request.pk, slot.pk))
+        changed_slots.append(slot)
 
+    if len(changed_slots) != 0:
+        StorageDSlot.objects.bulk_update(changed_slots, ["tape_request"])
 
-def run():
+
+@profiled("process_requests")
+def run(*args):
     """Entry point for the Django script run via ``./manage.py runscript``
 
     The algorithm / order to run the above functions is
@@ -208,34 +399,36 @@ def run():
 
       - ``load slots``
 
+    :Script arguments:
+        * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+
     """
 
     # First of all check if the process is running - if it is then don't start running again
-    try:
-        lines = (
-            subprocess.check_output(["ps", "-f", "-u", "badc"])
-            .decode("utf-8")
-            .split("\n")
-        )
-        n_processes = 0
-        for l in lines:
-            if "process_requests" in l and not "/bin/sh" in l:
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:  # this process counts as one process_requests processx
-        print("Process already running exiting")
-        sys.exit()
+    with Lease("process_requests") as lease:
+        if not lease.held:
+            print("Process already running exiting")
+            sys.exit()
+
+        with phase_timer("process_requests"):
+            process_requests()
 
+
+def process_requests():
+    """Update the requests, adjust the number of slots and fill the slots with requests.  This is called by
+    ``run`` and by the ``nla_scheduler`` daemon."""
     # update the requests to active / not active
     print("Update requests")
-    update_requests()
+    with profile_phase("update_requests"):
+        update_requests()
 
     # make right number of slots
     print("Adjust slots")
-    adjust_slots()
+    with profile_phase("adjust_slots"):
+        adjust_slots()
 
     # fill queue slots with requests
     print("Load slots")
-    load_slots()
+    with profile_phase("load_slots"):
+        load_slots()
+
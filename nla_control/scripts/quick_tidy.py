@@ -15,7 +15,9 @@ import datetime
 import sys
 from pytz import utc
 from nla_site.settings import *
-import subprocess
+from nla_control.scripts.process_requests import add_request_files
+from nla_control.leases import Lease
+from nla_control.profiling import profile_phase, profiled
 
 __author__ = 'sjp23'
 
@@ -67,11 +69,8 @@ def update_expired_requests():
         for i in range(0, int(n_rf/n_per_batch+1)):
             batch_files = request_files[i*n_per_batch:(i+1)*n_per_batch]
             print("Processing {}/{}".format(i*len(batch_files), n_rf))
-            present_tape_files = TapeFile.objects.filter(logical_path__in=batch_files)
-            if len(present_tape_files) != 0:
-                pf = list(present_tape_files.all())
-                tr.files.add(*pf)
-                tr.save()
+            present_tape_files = TapeFile.objects.filter(logical_path__in=batch_files).values_list("id", flat=True)
+            add_request_files([(tr.id, f_id) for f_id in present_tape_files])
 
 def files_in_other_request():
     now = datetime.datetime.now(utc)
@@ -82,26 +81,25 @@ def files_in_other_request():
             if in_other_request(tr, f):
                 print("File in another request: ".format(f))
 
-def run():
-    """Entry point for the Django script run via ``./manage.py runscript``"""
+@profiled("quick_tidy")
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+
+       :Script arguments:
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+    """
     # First of all check if the process is running - if it is then don't start running again
     print("Starting quick_tidy")
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "quick_tidy" in l and not "/bin/sh" in l:
-                print(l)
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:
-        print("Process already running, exiting")
-        sys.exit()
-
-    # otherwise run
-    remove_expired_empty_requests()
-    update_expired_requests()
-    files_in_other_request()
+    with Lease("quick_tidy") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit()
+
+        # otherwise run
+        with profile_phase("remove_expired_empty_requests"):
+            remove_expired_empty_requests()
+        with profile_phase("update_expired_requests"):
+            update_expired_requests()
+        with profile_phase("files_in_other_request"):
+            files_in_other_request()
     print("Finished quick_tidy")
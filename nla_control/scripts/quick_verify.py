@@ -6,17 +6,20 @@ import glob
 import pytz
 import os
 import datetime
-import subprocess
 import sys
 import json
 
 from django.db.models import Q
 
-from nla_control.models import TapeFile, TapeRequest, Quota
+from nla_control.models import TapeFile, TapeRequest, Quota, TapeFileException
 from nla_site.settings import *
 
-from nla_control.scripts.retrieve_files import get_spot_contents
+from nla_control.leases import Lease
+from nla_control.spot_listing import spot_listings
+from nla_control.scripts.verify import VerifiedFiles, file_chunks, make_verify_request
+from nla_control.profiling import profiled
 
+@profiled("quick_verify")
 def run(*args):
 
     """Entry point for the Django script run via ./manage.py in the Django project directory
@@ -27,6 +30,7 @@ def run(*args):
        :Script arguments:
            * *verify_now* -- set the retention time to be now
            * *start* -- number to start on
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
 
        **Purpose**:
                     Script to check from a list of files which files have associated check
@@ -39,114 +43,91 @@ def run(*args):
         """
 
     # First of all check if the process is running - if it is then don't start running again
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "quick_verify" in l and not "/bin/sh" in l:
-                print(l)
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:
-        print("Process already running, exiting")
-        sys.exit(0)
-
-    if "verify_now" in args:
-        verify_now = True
-    else:
-        verify_now = False
-   
-    start = 0
-    for a in args:
-        if "start_record" in a:
-            start = int(a.split("=")[-1])
-
-    # open the JSON file containing the directories to match against
-    with open("/usr/local/NLA/src/nla_control/nla_control/scripts/quick_verify_files.json") as fh:
-        lpath_json = json.load(fh)
+    with Lease("quick_verify") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit(0)
 
+        if "verify_now" in args:
+            verify_now = True
+        else:
+            verify_now = False
+
+        start = 0
+        for a in args:
+            if "start_record" in a:
+                start = int(a.split("=")[-1])
+
+        # open the JSON file containing the directories to match against
+        with open("/usr/local/NLA/src/nla_control/nla_control/scripts/quick_verify_files.json") as fh:
+            lpath_json = json.load(fh)
+
+        # load storage paths to do path translation to from logical to storage paths.
+        print("Loading storage paths...")
+        TapeFile.load_storage_paths()
+        print("...done")
+
+        quick_verify_files(lpath_json["match_logical_path"], verify_now, lease)
+
+
+def quick_verify_files(match_logical_paths, verify_now=False, lease=None):
+    """Verify the UNVERIFIED files with any of the logical paths that are on tape, as described in ``run``.
+
+       :param match_logical_paths: the logical paths of the files to quick verify
+       :param boolean verify_now: set the retention time of the verify request to be now
+       :param Lease lease: the quick_verify lease - the files are not verified any further if it is lost
+    """
     # build a Q query with each logical path mapping
     unverified_query = Q(stage=TapeFile.UNVERIFIED)
     # add the lpaths
     query = Q()
-    for lpath in lpath_json["match_logical_path"]:
+    for lpath in match_logical_paths:
         query = query | (unverified_query & Q(logical_path__contains=lpath))
 
-
-    # load storage paths to do path translation to from logical to storage paths.
-    print("Loading storage paths...")
-    TapeFile.load_storage_paths()
-    print("...done")
-
     # limit each batch to 100,000 files to remove
 #    LIMIT = 100000
 #    files = TapeFile.objects.filter(query)[start:start+LIMIT]
     files = TapeFile.objects.filter(query)
     print("Number of UNVERIFIED files that can be quick verified: {} ".format(files.count()))
 
-    # make a tape file request so all verified files belong to a request. This request
-    # belongs to the _VERIFY quota.
-    quota = Quota.objects.filter(user="_VERIFY")
-    if len(quota) == 0:
-        quota = Quota(user="_VERIFY", size=10000000000000, notes="System quota for requests from tidying.")
-        quota.save()
-    else:
-        quota = quota[0]
-
-    now = datetime.datetime.now(pytz.utc)
-    if verify_now:
-        retention = now
-    else:
-        retention = now + datetime.timedelta(days=20)
-
-    tape_request = TapeRequest(quota=quota, retention=retention,
-                               storaged_request_start=now,
-                               storaged_request_end=now,
-                               first_files_on_disk=now, last_files_on_disk=now,
-                               label="FROM QUICK_VERIFY PROCESS")
-    tape_request.save()
-
-    # Now check to see if the files exist on the tape, using sd_ls
-    num_verified_files = 0
-    # spot lists
-    spot_lists = {}
-
-    for f in files:
-        try:
-            spot_logical_path, spot_name = f.spotname()
-        except:
-            print("Spotname name not found for file: {}".format(f))
-            continue
-
-        # if the spot_name is not in the spot_lists then do a sd_ls
-        if spot_name not in spot_lists:
-            sl = get_spot_contents(spot_name)
-            spot_lists[spot_name] = {}
-            # convert this to a true dictionary, rather than a list of dictionaries
-            for s in sl:
-                key = list(s)[0]
-                value = s[key]
-                spot_lists[spot_name][key] = value
-                    
-        file_path = f.logical_path
-        if TEST_VERSION:
-            to_find = file_path     # test version verification is just
-                                    # calculate insitu
-        else:
-            to_find = os.path.basename(file_path).strip("'")
-
-        if to_find in spot_lists[spot_name]:
-            # spot_lists[spot_name] is a dictionary with to_find as the key, then a tuple is the value (file_name, size, status)
-            stage = spot_lists[spot_name][to_find][2]
-            if stage in ["TAPED", "SYNCED"]:
-                tape_request.request_files += file_path + "\n"
-                num_verified_files += 1
-
+    # make a tape file request so all verified files belong to a request
+    verified = VerifiedFiles(make_verify_request("FROM QUICK_VERIFY PROCESS", verify_now))
+
+    # Now check to see if the files exist on the tape, using the sd_ls listings of their spots.  The listings are
+    # held by spot_listings for SPOT_LISTING_TTL seconds, so a long run lists a spot again once its listing expires.
+
+    # read the files a chunk at a time, committing the files verified in each chunk
+    for chunk in file_chunks(files):
+        if lease is not None:
+            lease.check()
+        file_spots = []
+        for f in chunk:
+            try:
+                spot_logical_path, spot_name = f.spotname()
+            except TapeFileException:
+                print("Spotname name not found for file: {}".format(f))
+                continue
+            file_spots.append((f, spot_name))
+
+        # list the spots of the chunk that are not cached, running the sd_ls in parallel
+        spot_listings.prefetch(spot_name for f, spot_name in file_spots)
+
+        for f, spot_name in file_spots:
+            file_path = f.logical_path
+            if TEST_VERSION:
+                to_find = file_path     # test version verification is just
+                                        # calculate insitu
+            else:
+                to_find = os.path.basename(file_path).strip("'")
+
+            # the listing is a dictionary with to_find as the key, then a SpotFile is the value
+            spot_file = (spot_listings.get(spot_name) or {}).get(to_find)
+            if spot_file is not None and spot_file.status in ["TAPED", "SYNCED"]:
+                # set stage to ONDISK, set verification date and add to the tape request, at the checkpoint
+                verified.add(f)
+
+        verified.checkpoint()
+        print("Verified {} files".format(verified.n_verified))
 
     # if no files don't keep the tape request
-    if num_verified_files == 0:
-        tape_request.delete()
-    else:
-        tape_request.save()
+    verified.finish()
@@ -19,9 +19,18 @@
 from nla_control.models import *
 from nla_site.settings import *
 import nla_control
+from nla_control.leases import Lease, LeaseLost
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profile_phase, profiled
+from nla_control.log_follower import LogFollower, wait_any
+from nla_control.spot_listing import spot_listings
 
+from django.conf import settings
 from django.core.mail import send_mail
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
 
 import subprocess
 import datetime
@@ -32,47 +41,203 @@ import socket
 from pytz import utc
 import sys, os
 
-from fbi_core import update_file_location
+
+# Retrieve one spot / tape volume group of a request on each run of sd_get, in on-tape order
+RETRIEVE_BY_LOCALITY = getattr(settings, "RETRIEVE_BY_LOCALITY", True)
+# Check that the files are in the sd_ls listing of their spot before asking sd_get for them
+CHECK_SPOT_LISTING = getattr(settings, "CHECK_SPOT_LISTING", True)
+# Largest number of files, and of bytes, retrieved by one run of sd_get.  Larger requests are retrieved in chunks,
+# each a separate run in a slot.
+RETRIEVE_CHUNK_FILES = getattr(settings, "RETRIEVE_CHUNK_FILES", 5000)
+RETRIEVE_CHUNK_BYTES = getattr(settings, "RETRIEVE_CHUNK_BYTES", 2 * 1024**4)
+# Policy for choosing the restore disk for a retrieval, from the disks with enough free space - one of
+# "best_fit", "least_loaded" or "round_robin" (see ``RESTORE_DISK_POLICIES``), or a function
+RESTORE_DISK_POLICY = getattr(settings, "RESTORE_DISK_POLICY", "best_fit")
+# Split the files being retrieved across more than one restore disk if no single disk has room for them
+RESTORE_SPLIT_REQUESTS = getattr(settings, "RESTORE_SPLIT_REQUESTS", True)
+# Delay, in seconds, before retrying a failed retrieval.  This doubles with each failure in a row, up to the maximum.
+RETRY_BACKOFF_BASE = getattr(settings, "RETRY_BACKOFF_BASE", 60)
+RETRY_BACKOFF_MAX = getattr(settings, "RETRY_BACKOFF_MAX", 3600)
+# Restored files are committed to the database and Elastic Search in batches of up to RESTORE_BATCH_SIZE files, at
+# most RESTORE_BATCH_INTERVAL seconds after the first file in the batch was restored
+RESTORE_BATCH_SIZE = getattr(settings, "RESTORE_BATCH_SIZE", 1000)
+RESTORE_BATCH_INTERVAL = getattr(settings, "RESTORE_BATCH_INTERVAL", 5)
+
+# Pattern of the lines in the sd_get log that report a restored file - (archive file path, local restored path)
+if TEST_VERSION:
+    RESTORED_PATTERN = re.compile("Copying file: (.*) to (.*)")
+else:
+    RESTORED_PATTERN = re.compile("Saving (.*) into local file (.*)")
+
+
+def best_fit(disks, size):
+    """Placement policy: the restore disk with the least free space that will still hold the retrieval, keeping the
+    larger free spaces for larger retrievals."""
+    return min(disks, key=lambda d: (d.free, d.pk))
+
+
+def least_loaded(disks, size):
+    """Placement policy: the restore disk with the most free space."""
+    return max(disks, key=lambda d: (d.free, -d.pk))
+
+
+def round_robin(disks, size):
+    """Placement policy: the restore disk that a retrieval was placed on longest ago, spreading the retrievals across
+    the disks for I/O parallelism."""
+    return min(disks, key=lambda d: (d.last_allocated is not None, d.last_allocated, d.pk))
+
+
+RESTORE_DISK_POLICIES = {
+    "best_fit": best_fit,
+    "least_loaded": least_loaded,
+    "round_robin": round_robin,
+}
+
+
+def get_restore_disk_policy():
+    """Get the placement policy named by ``RESTORE_DISK_POLICY``.  The setting can also be a function taking the
+    candidate disks, each with its ``free`` bytes, and the size of the retrieval, and returning one of the disks."""
+    if callable(RESTORE_DISK_POLICY):
+        return RESTORE_DISK_POLICY
+    return RESTORE_DISK_POLICIES[RESTORE_DISK_POLICY]
+
+
+def get_free_restore_disks():
+    """Get the restore disks, locked for update, with the number of bytes that are neither used nor reserved on each
+    in ``free``.  Must be called inside a transaction.
+
+       :return: the restore disks
+       :rtype: List[RestoreDisk]
+    """
+    restore_disks = list(RestoreDisk.objects.select_for_update().order_by("pk"))
+    reserved = dict(
+        RestoreDiskReservation.objects.values_list("restore_disk").annotate(Sum("reserved_bytes"))
+    )
+    for td in restore_disks:
+        td.free = td.allocated_bytes - td.used_bytes - reserved.get(td.pk, 0)
+    return restore_disks
+
+
+def allocate_restore_disk(tape_request, target_disk, size):
+    """Reserve space on the restore disk for the request and record when it was allocated."""
+    reserve_space(tape_request, target_disk, size)
+    target_disk.last_allocated = timezone.now()
+    target_disk.save(update_fields=["last_allocated"])
+
+
+def make_restore_dir(target_disk):
+    # create the directory if it doesn't exist
+    if not os.path.exists(target_disk.mountpoint):
+        os.makedirs(target_disk.mountpoint)
 
 
-def get_restore_disk(slot):
-    """Get the next restore disk with enough free space to store all the files in the request.
+def get_restore_disk(slot, size=None):
+    """Get a restore disk with enough free space to store all the files in the request, and reserve the space on it
+    for the request.  Free space is the allocated space less the space used and the space reserved by other
+    retrievals.  The disk is chosen from those with enough free space by the ``RESTORE_DISK_POLICY``.  The disks are
+    locked while the space is reserved, so that concurrent retrievals cannot overcommit a disk.
 
        :param integer slot: slot number
-       :return: the mountpoint of the first restore disk with enough space to store the request
-       :rtype: string
+       :param integer size: the number of bytes to store, defaults to the size of the files in the request that are
+           ONTAPE
+       :return: the restore disk chosen to store the request
+       :rtype: RestoreDisk
        """
 
-    restore_disks = RestoreDisk.objects.all()
-
     # get the size of the files in the request
-    files = slot.tape_request.files.filter(stage=TapeFile.ONTAPE)
-    # if no files then just return
-    if len(files) == 0:
-        return restore_disks[0]
-    # add up the filesize
-    total_request_size = 0
-    for f in files:
-        # have to go via the TapeFile
-        total_request_size += TapeFile.objects.filter(logical_path=f.logical_path)[0].size
+    if size is None:
+        size = slot.tape_request.files.filter(
+            stage=TapeFile.ONTAPE
+        ).aggregate(size=Sum("size"))["size"] or 0
+
+    with transaction.atomic():
+        # find the disks with enough free space - a request with no files still needs a disk that is not full
+        candidates = [td for td in get_free_restore_disks() if td.free > size]
+        # if a disk not found then return None
+        if len(candidates) == 0:
+            return None
+        target_disk = get_restore_disk_policy()(candidates, size)
+        # there is no space to reserve if there are no files
+        if size > 0:
+            allocate_restore_disk(slot.tape_request, target_disk, size)
+
+    make_restore_dir(target_disk)
+    return target_disk
 
-    # loop over the restore_disks
-    target_disk = None
-    for td in restore_disks:
-        # find a disk with enough free space
-        if td.allocated_bytes - td.used_bytes > total_request_size:
-            target_disk = td
-            break
 
-    # if a disk not found then print an error and return None
-    if type(target_disk) == type(None):
-        return None
+def get_restore_partitions(slot, files):
+    """Get the restore disk(s) to store the files to retrieve for the request in the slot, reserving the space on
+    them.  If one restore disk has enough free space for all of the files then it is chosen by ``get_restore_disk``.
+    Otherwise, if ``RESTORE_SPLIT_REQUESTS`` is set, the files are split into partitions across the restore disks,
+    filling the disks with the most free space first.  The files are kept in order, so each partition is a
+    contiguous run of the (on-tape ordered) files.  Files that do not fit on any disk are left for a later run.
 
-    # create the directory if it doesn't exist
-    if not os.path.exists(target_disk.mountpoint):
-        os.makedirs(target_disk.mountpoint)
+       :param integer slot: slot number
+       :param files: the TapeFiles to retrieve
+       :return: list of (restore disk, TapeFiles to restore to it)
+       :rtype: List[Tuple(RestoreDisk, List[TapeFile])]
+    """
+    target_disk = get_restore_disk(slot, sum(f.size for f in files))
+    if target_disk is not None:
+        return [(target_disk, files)]
+    if not RESTORE_SPLIT_REQUESTS:
+        return []
 
-    return target_disk
+    partitions = []
+    with transaction.atomic():
+        restore_disks = sorted(get_free_restore_disks(), key=lambda d: (-d.free, d.pk))
+        i = 0
+        part_files = []
+        part_size = 0
+        for f in files:
+            # move on to the next disk when this one is full
+            while i < len(restore_disks) and part_size + f.size >= restore_disks[i].free:
+                if len(part_files) > 0:
+                    partitions.append((restore_disks[i], part_files))
+                part_files = []
+                part_size = 0
+                i += 1
+            if i == len(restore_disks):
+                break
+            part_files.append(f)
+            part_size += f.size
+        if len(part_files) > 0:
+            partitions.append((restore_disks[i], part_files))
+
+        for target_disk, part_files in partitions:
+            allocate_restore_disk(slot.tape_request, target_disk, sum(f.size for f in part_files))
+
+    for target_disk, part_files in partitions:
+        make_restore_dir(target_disk)
+    return partitions
+
+
+def reserve_space(tape_request, target_disk, size):
+    """Set the space reserved on the restore disk for the request.
+
+       :param TapeRequest tape_request: the request the space is reserved for
+       :param RestoreDisk target_disk: the restore disk the space is reserved on
+       :param integer size: the number of bytes to reserve
+    """
+    RestoreDiskReservation.objects.update_or_create(
+        restore_disk=target_disk, tape_request=tape_request, defaults={"reserved_bytes": size}
+    )
+
+
+def release_space(tape_request, target_disk=None, size=None):
+    """Release space reserved for the request, when files have been restored or the retrieval has finished or failed.
+
+       :param TapeRequest tape_request: the request the space is reserved for
+       :param RestoreDisk target_disk: only release the space on this restore disk
+       :param integer size: the number of bytes to release, or None to release all of the reserved space
+    """
+    reservations = RestoreDiskReservation.objects.filter(tape_request=tape_request)
+    if target_disk is not None:
+        reservations = reservations.filter(restore_disk=target_disk)
+    if size is None:
+        reservations.delete()
+    else:
+        reservations.update(reserved_bytes=Greatest(F("reserved_bytes") - size, 0))
 
 
 def send_start_email(slot):
@@ -81,18 +246,26 @@ def send_start_email(slot):
 
        :param integer slot: slot number
     """
-    if not slot.tape_request.notify_on_first_file:
+    send_request_start_email(slot.tape_request)
+
+
+def send_request_start_email(tape_request):
+    """Send the email to notify that the request has started, for a *TapeRequest* rather than a slot.
+
+       :param TapeRequest tape_request: the request that has started
+    """
+    if not tape_request.notify_on_first_file:
         return
 
     # to address is notify_on_first
-    toaddrs = [slot.tape_request.notify_on_first_file]
+    toaddrs = [tape_request.notify_on_first_file]
     # from address is just a dummy address
     fromaddr = "support@ceda.ac.uk"
 
     # subject
-    subject = "[NLA] - Tape request %i has started" % slot.tape_request.id
+    subject = "[NLA] - Tape request %i has started" % tape_request.id
     msg = "Request contains files: "
-    for f in slot.tape_request.files.all():
+    for f in tape_request.files.all():
         msg += "\n" + f.logical_path
 
     send_mail(subject, msg, fromaddr, toaddrs, fail_silently=False)
@@ -104,44 +277,195 @@ def send_end_email(slot):
 
        :param integer slot: slot number
     """
-    if not slot.tape_request.notify_on_last_file:
+    send_request_end_email(slot.tape_request)
+
+
+def send_request_end_email(tape_request):
+    """Send the email to notify that the request has finished, for a *TapeRequest* rather than a slot.
+
+       :param TapeRequest tape_request: the request that has finished
+    """
+    if not tape_request.notify_on_last_file:
         return
 
     # to address is notify_on_last
-    toaddrs = [slot.tape_request.notify_on_last_file]
+    toaddrs = [tape_request.notify_on_last_file]
     # from address is just a dummy address
     fromaddr = "support@ceda.ac.uk"
 
     # subject
-    subject = "[NLA] - Tape request %i has finished" % slot.tape_request.id
+    subject = "[NLA] - Tape request %i has finished" % tape_request.id
     msg = "Request contains files: "
-    for f in slot.tape_request.files.all():
+    for f in tape_request.files.all():
         msg += "\n" + f.logical_path
 
     send_mail(subject, msg, fromaddr, toaddrs, fail_silently=False)
 
 
-def get_spot_contents(spot_name):
-    """Get a list of the files in the spot `spot_name`"""
-    sd_cmd = ["/usr/bin/python3", "/usr/bin/sd_ls", "-s", spot_name, "-L", "file"]
+def get_cached_spot_contents(spot_name):
+    """Get the contents of the spot `spot_name` as a dictionary, keyed by the basename of the file, from the shared
+       spot listing cache (``nla_control.spot_listing``).
+
+       :param string spot_name: name of the spot
+       :return: dictionary of basename to SpotFile (file_name, size, status, volume, position).  Empty if the spot
+           could not be listed.
+       :rtype: Dictionary[string:SpotFile]
+    """
+    return spot_listings.get(spot_name) or {}
+
+
+def tape_position(position):
+    """Convert the position of a file on a tape from the sd_ls listing to something that can be sorted."""
     try:
-        output = subprocess.check_output(sd_cmd).decode("utf-8")
-    except subprocess.CalledProcessError:
-        return []
+        return int(position)
+    except (TypeError, ValueError):
+        return 0
 
-    out_lines = output.split("\n")
+
+def get_locality_groups(files):
+    """Group files by the spot and tape volume they are stored on, using the sd_ls listing of each spot.  The
+       files in each group are sorted into the order they are on the tape, so that a single sd_get of a group
+       needs one tape mount and reads forward along the tape.  Files whose volume is not in the listing, or all of
+       the files if the volume is not listed (see ``SD_LS_VOLUME_COLUMN``), are grouped by their spot alone.
+
+       :param files: the TapeFiles to group
+       :return: list of groups, each a list of TapeFiles in on-tape order.  The groups are sorted with the
+           largest number of bytes first.
+       :rtype: List[List[TapeFile]]
+    """
     spot_files = []
-    for out_item in out_lines:
-        out_file = out_item.split()
-        if len(out_file) == 11:
-            file_name = out_file[10]
-            size = out_file[1]
-            status = out_file[2]
-            spot_files.append({os.path.basename(file_name) : (file_name, size, status,)})
-    return spot_files
+    for f in files:
+        try:
+            spot_logical_path, spot_name = f.spotname()
+        except TapeFileException:
+            print("Spotname name not found for file: {}".format(f))
+            continue
+        spot_files.append((spot_name, f))
+    # list all of the spots at once
+    spot_listings.prefetch([spot_name for spot_name, f in spot_files])
+
+    groups = {}
+    for spot_name, f in spot_files:
+        volume = None
+        position = 0
+        spot_contents = get_cached_spot_contents(spot_name)
+        basename = os.path.basename(f.logical_path)
+        if basename in spot_contents:
+            volume = spot_contents[basename].volume
+            position = tape_position(spot_contents[basename].position)
+        groups.setdefault((spot_name, volume), []).append((position, f.logical_path, f))
+
+    locality_groups = []
+    for key in groups:
+        groups[key].sort(key=lambda g: (g[0], g[1]))
+        locality_groups.append([g[2] for g in groups[key]])
+    locality_groups.sort(key=lambda g: sum(f.size for f in g), reverse=True)
+    return locality_groups
+
+
+def get_retrieve_chunk(files):
+    """Limit the files retrieved by one run of sd_get to a chunk of at most ``RETRIEVE_CHUNK_FILES`` files and
+       ``RETRIEVE_CHUNK_BYTES`` bytes, taken from the start of ``files``.  A chunk always has at least one file, so a
+       file bigger than ``RETRIEVE_CHUNK_BYTES`` is retrieved on its own.  A limit of None or 0 is not applied.
+
+       :param files: TapeFiles in the order they should be retrieved
+       :return: TapeFiles in the chunk
+       :rtype: List[TapeFile]
+    """
+    chunk = []
+    chunk_size = 0
+    for f in files:
+        if len(chunk) > 0:
+            if RETRIEVE_CHUNK_FILES and len(chunk) >= RETRIEVE_CHUNK_FILES:
+                break
+            if RETRIEVE_CHUNK_BYTES and chunk_size + f.size > RETRIEVE_CHUNK_BYTES:
+                break
+        chunk.append(f)
+        chunk_size += f.size
+    return chunk
+
+
+def get_retrieve_batch(slot):
+    """Get the files to retrieve for the request in the slot on this run of sd_get.  If ``RETRIEVE_BY_LOCALITY``
+       is set then this is the locality group (spot and tape volume, as found by ``get_locality_groups``) with the
+       most bytes, in on-tape order.  Otherwise it is the files in the request that are ONTAPE.  Only the files that
+       are in the listing of their spot (``listed_in_spot``) are retrieved, so if none of the files of the largest
+       group are listed then the next group is taken.  Either way the batch is limited to one chunk
+       (``get_retrieve_chunk``), so that only the chunk is marked as RESTORING, a failure only costs one chunk and
+       the slot is given up to other requests between chunks.  The rest of the request is retrieved by later runs.
+
+       :param integer slot: slot number
+       :return: TapeFiles to retrieve, empty if none of the files can be retrieved
+       :rtype: List[TapeFile]
+    """
+    files = slot.tape_request.files.filter(stage=TapeFile.ONTAPE)
+    if not RETRIEVE_BY_LOCALITY:
+        return get_retrieve_chunk(f for f in files.order_by("logical_path").iterator() if can_retrieve(f))
+    for group in get_locality_groups(files):
+        group = [f for f in group if can_retrieve(f)]
+        if len(group) > 0:
+            return get_retrieve_chunk(group)
+    return []
+
+
+def can_retrieve(f):
+    """Whether the file can be retrieved: its spot is known and it is in the listing of the spot.
+
+    :param TapeFile f: the file
+    :rtype: boolean
+    """
+    try:
+        to_retrieve, spot_name = retrieve_path(f)
+    except TapeFileException:
+        return False
+    return listed_in_spot(spot_name, os.path.basename(to_retrieve))
+
+
+def retrieve_path(f):
+    """Get the path that a file is retrieved by from StorageD, as written in the retrieve listing.
+
+    :param TapeFile f: the file
+    :return: the path to retrieve, the name of the spot the file is in
+    :rtype: Tuple(string, string)
+    """
+    spot_logical_path, spot_name = f.spotname()
+    if TEST_VERSION:
+        to_retrieve = f.logical_path
+    else:
+        to_retrieve = f.logical_path.replace(spot_logical_path, "/archive/%s" % spot_name)
+    return to_retrieve, spot_name
+
 
+def restored_file_path(target_disk, to_retrieve):
+    """Get the path on the restore disk that ``sd_get`` restores a file to.
 
-def create_retrieve_listing(slot, target_disk):
+    :param RestoreDisk target_disk: the restore disk the file is restored to
+    :param string to_retrieve: the path the file was retrieved by (see ``retrieve_path``)
+    :return: the path of the restored file
+    :rtype: string
+    """
+    if TEST_VERSION:
+        # the sd_get emulator restores the files to the top of the restore disk
+        return os.path.join(target_disk.mountpoint, os.path.basename(to_retrieve))
+    return target_disk.mountpoint + to_retrieve
+
+
+def listed_in_spot(spot_name, basename):
+    """Check that a file is in the sd_ls listing of its spot, if ``CHECK_SPOT_LISTING`` is set.  A file missing from
+    an older cached listing may have been added to the spot since it was listed, so the spot is listed again before
+    the file is skipped.
+
+    :param string spot_name: name of the spot
+    :param string basename: basename of the file to retrieve
+    :return: whether to retrieve the file - True if the spot could not be listed, so that it is tried anyway
+    :rtype: boolean
+    """
+    if not CHECK_SPOT_LISTING:
+        return True
+    return spot_listings.contains(spot_name, basename, relist=True) is not False
+
+
+def create_retrieve_listing(slot, target_disk, files=None):
     """Create a text file (``file_listing_filename``) containing the names of the files to retrieve from StorageD.
     This text file is saved to the mountpoint of the restore disk that has been allocated for this retrieval by
     ``get_restore_disk``. The function also builds a mapping (``retrieved_to_file_map``) between a files spot name
@@ -150,72 +474,153 @@ def create_retrieve_listing(slot, target_disk):
 
     :param integer slot: slot number
     :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
+    :param files: the TapeFiles to retrieve, defaults to the next batch of the request (``get_retrieve_batch``)
     :return: file_listing_filename, retrieved_to_file_map
     :rtype: Tuple(string, Dictionary[string:TapeFile])
     """
 
     # files to retrieve
-    files = slot.tape_request.files.filter(stage=TapeFile.ONTAPE)
+    if files is None:
+        files = get_retrieve_batch(slot)
 
     # make files to retrieve in a listing file and mark files as restoring.
     file_listing_filename = os.path.join(target_disk.mountpoint, "retrieve_listing_%s.txt" % slot.tape_request.id)
     file_listing = open(file_listing_filename, "w")
 
     retrieved_to_file_map = {}
-    spot_list = {}
 
     for f in files:
         try:
-            spot_logical_path, spot_name = f.spotname()
+            to_retrieve, spot_name = retrieve_path(f)
         except:
             print("Spotname name not found for file: {}".format(f))
             continue
 
-        if TEST_VERSION:
-            to_retrieve = f.logical_path
-        else:
-            to_retrieve = f.logical_path.replace(spot_logical_path, "/archive/%s" % spot_name)
-
         to_check = os.path.basename(to_retrieve)
 
-        check_spot = False
-        if check_spot:
-            # get a list of files in the spot if not already got
-            if spot_name not in spot_list:
-                spot_list[spot_name] = get_spot_contents(spot_name)
-
-            # check it's in the spot on sd
-            # spot list is now a list of dictionaries with the file name to check as the key
-            spot_list_keys = [list(s.keys())[0] for s in spot_list[spot_name]]
-            in_spot = to_check in spot_list_keys
-        else:
-            in_spot = True
-
-        if in_spot:
+        if listed_in_spot(spot_name, to_check):
             retrieved_to_file_map[to_retrieve] = f
+        else:
+            print("File {} not found in the listing of spot {}".format(f.logical_path, spot_name))
+
+    # claim the files for this request.  Only files that are still ONTAPE are claimed, so a file that is in
+    # more than one request is only retrieved once - the other requests wait for it to be restored.
+    claimed_ids = claim_files(slot.tape_request, target_disk, [f.pk for f in retrieved_to_file_map.values()])
+    for to_retrieve in list(retrieved_to_file_map.keys()):
+        f = retrieved_to_file_map[to_retrieve]
+        if f.pk in claimed_ids:
             file_listing.write(to_retrieve + "\n")
             f.stage = TapeFile.RESTORING
             f.restore_disk = target_disk
-            f.save()
+            f.restoring_request = slot.tape_request
+        else:
+            del retrieved_to_file_map[to_retrieve]
     file_listing.close()
     return file_listing_filename, retrieved_to_file_map
 
 
-def start_sd_get(slot, file_listing_filename, target_disk):
+def claim_files(tape_request, target_disk, file_ids):
+    """Mark the files as RESTORING by the tape request, to the target disk.  The files are claimed with a single
+    conditional update, so that only the files that are still ONTAPE are claimed.  Files that have already been
+    claimed by the retrieval of another request are left with that request.
+
+    :param TapeRequest tape_request: the request that the files are being retrieved for
+    :param RestoreDisk target_disk: *RestoreDisk* the files will be restored to
+    :param file_ids: the ids of the TapeFiles to claim
+    :return: the ids of the TapeFiles claimed by this request
+    :rtype: Set[integer]
     """
-    Start the process of retrieving files from StorageD by calling (the command line program) sd_get, with the
-    list of files created by ``create_retrieve_listing`` as input, for a single slot.  The process id of the instance
-    of sd_get running for the slot is returned.  A logfile is also created, with output from sd_get being appended to
-    the logfile.
+    TapeFile.objects.filter(pk__in=file_ids, stage=TapeFile.ONTAPE).update(
+        stage=TapeFile.RESTORING, restore_disk=target_disk, restoring_request=tape_request,
+        last_updated=timezone.now()
+    )
+    return set(
+        TapeFile.objects.filter(
+            pk__in=file_ids, stage=TapeFile.RESTORING, restoring_request=tape_request
+        ).values_list("id", flat=True)
+    )
+
+
+def own_restoring_files(tape_request):
+    """Get the files in the request that are RESTORING by the retrieval for this request.  Files that were marked
+    RESTORING before the restoring request was recorded are counted as belonging to the request.
+
+    :param TapeRequest tape_request: the request
+    :return: the files being restored by this request
+    :rtype: QuerySet[TapeFile]
+    """
+    return tape_request.files.filter(
+        Q(stage=TapeFile.RESTORING)
+        & (Q(restoring_request=tape_request) | Q(restoring_request__isnull=True))
+    )
+
+
+def credit_waiting_requests(tape_request, restored_ids):
+    """Credit the other requests that contain files which have just been restored by the retrieval for
+    ``tape_request``.  These requests did not retrieve the files themselves, as the files were already being
+    restored, so they are notified here:
+
+      - the first files on disk time is set and the start email sent, if this is the first file for the request
+
+      - if no files are left ONTAPE or RESTORING then the last files on disk time is set, the end email is sent and
+        the request is made inactive
+
+    The waiting requests that need one of these changes are found in a single query, and updated together, so a
+    batch that only restores more files for requests that have already started costs one query.
+
+    :param TapeRequest tape_request: the request whose retrieval restored the files
+    :param restored_ids: ids of the TapeFiles that have just been restored
+    """
+    if len(restored_ids) == 0:
+        return
+    through = TapeRequest.files.through
+    waiting_requests = list(
+        TapeRequest.objects.filter(
+            pk__in=through.objects.filter(tapefile_id__in=restored_ids).values("taperequest_id")
+        ).exclude(
+            pk=tape_request.pk
+        ).annotate(
+            remaining_files=Count("files", filter=Q(files__stage__in=[TapeFile.ONTAPE, TapeFile.RESTORING]))
+        ).filter(
+            Q(first_files_on_disk__isnull=True) | Q(remaining_files=0, active_request=True)
+        )
+    )
+    if len(waiting_requests) == 0:
+        return
+
+    now = datetime.datetime.utcnow()
+    started = [wr for wr in waiting_requests if wr.first_files_on_disk is None]
+    completed = [wr for wr in waiting_requests if wr.remaining_files == 0 and wr.active_request]
+    if len(started) != 0:
+        TapeRequest.objects.filter(pk__in=[wr.pk for wr in started]).update(first_files_on_disk=now)
+    if len(completed) != 0:
+        completed_ids = [wr.pk for wr in completed]
+        TapeRequest.objects.filter(pk__in=completed_ids, storaged_request_end__isnull=True).update(
+            storaged_request_end=now
+        )
+        TapeRequest.objects.filter(pk__in=completed_ids).update(last_files_on_disk=now, active_request=False)
+
+    # the emails are only sent when the request starts or completes, not for every batch
+    for wr in started:
+        print("  Crediting request {} with files restored by request {}".format(wr.pk, tape_request.pk))
+        send_request_start_email(wr)
+    for wr in completed:
+        print("  Request {} completed by files restored by request {}".format(wr.pk, tape_request.pk))
+        send_request_end_email(wr)
+
+
+def sd_get_command(slot, file_listing_filename, target_disk):
+    """
+    Build the ``sd_get`` command to retrieve the files in the file listing created by ``create_retrieve_listing``
+    for a single slot, and mark the request in the slot as started.  Any old log file for the request is removed.
 
     :param integer slot: slot number
     :param string file_listing_filename: the name of the text file containing the names of the files to retrieve from
-        StorageD.  This file listing is created by ``create_retrieve_listing``.
+        StorageD.
     :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
-    :return: process id of the instance of ``sd_get``, the name of the output log file
-    :rtype: Tuple(integer, string)
+    :return: the ``sd_get`` command, the name of the output log file
+    :rtype: Tuple(List[string], string)
     """
-
     # start an sd_get to retrieval cache
     log_file_name = os.path.join(target_disk.mountpoint, "retrieve_log_%s.txt" % slot.tape_request.id)
     if os.path.exists(log_file_name):  # make sure old log is removed as this may get picked up by current request
@@ -226,122 +631,338 @@ def start_sd_get(slot, file_listing_filename, target_disk):
 
     if TEST_VERSION:
         # get the current python running via sys.executable and the sd_get_emulator command from
-        # the current PROJECT_DIR / BASE_DIR
+        # the nla_control package.  The emulator is configured by the SD_EMULATOR_* environment variables.
         pth = os.path.dirname(nla_control.__file__)
-        sd_get_cmd = [sys.executable, pth, "/bin/sd_get_emulator"]
+        sd_get_cmd = [sys.executable, os.path.join(pth, "bin", "sd_get_emulator")]
         sd_get_cmd.extend(sd_get_args)
     else:
         # this is a bit hacky but sd_get uses the system python3, rather than the venv one
         sd_get_cmd = ["/usr/bin/python3", "/usr/bin/sd_get"]
         sd_get_cmd.extend(sd_get_args)
 
-    # mark request as started
-    slot.tape_request.storaged_request_start = datetime.datetime.utcnow()
-    slot.tape_request.save()
+    # mark request as started - if it is not already started by an earlier batch of files
+    if slot.tape_request.storaged_request_start is None:
+        slot.tape_request.storaged_request_start = datetime.datetime.utcnow()
+        slot.tape_request.save()
+
+    return sd_get_cmd, log_file_name
+
+
+class RetrievalMetrics(object):
+    """Timings and counts for the retrieval running in a slot, collected in memory and written as one
+    ``RetrievalMetric`` when the retrieval finishes (``save``), so that recording them adds no queries while the
+    files are being restored.  The metrics for each slot are kept in ``retrieval_metrics``, keyed by the slot pk.
+
+    :var RetrievalMetric metric: the metric being recorded
+    """
+
+    def __init__(self, slot, prepare_started, retrievals):
+        now = time.time()
+        tape_request = slot.tape_request
+        self.metric = RetrievalMetric(
+            tape_request=tape_request, slot=slot.pk, host=socket.gethostname(),
+            started=timezone.now() - datetime.timedelta(seconds=now - prepare_started),
+            retry_count=tape_request.retry_count, sd_gets=len(retrievals),
+            files_requested=sum(len(r[2]) for r in retrievals),
+            bytes_requested=sum(f.size for r in retrievals for f in r[2].values()),
+            prepare_seconds=now - prepare_started,
+        )
+        # the request has been waiting for a slot since its last retrieval finished, or since it was made
+        queued_since = RetrievalMetric.objects.filter(tape_request=tape_request).order_by(
+            "-started").values_list("ended", flat=True).first() or tape_request.request_date
+        if queued_since is not None:
+            self.metric.queue_seconds = max((self.metric.started - queued_since).total_seconds(), 0)
+        self.sd_get_started = None
+        self.sd_get_ended = None
+
+    def start_sd_get(self):
+        """Record the start of the first sd_get."""
+        if self.sd_get_started is None:
+            self.sd_get_started = time.time()
+
+    def file_restored(self):
+        """Record that a file has been restored, to time the first file."""
+        if self.metric.first_file_seconds is None and self.sd_get_started is not None:
+            self.metric.first_file_seconds = time.time() - self.sd_get_started
+
+    def add_restored(self, n_files, n_bytes):
+        """Add a batch of restored files to the counts."""
+        self.metric.files_retrieved += n_files
+        self.metric.bytes_retrieved += n_bytes
+
+    def end_sd_gets(self):
+        """Record that all of the sd_gets have ended."""
+        self.sd_get_ended = time.time()
+        if self.sd_get_started is not None:
+            self.metric.sd_get_seconds = self.sd_get_ended - self.sd_get_started
+
+    def save(self, outcome):
+        """Write the metric for the retrieval.
+
+        :param string outcome: how the retrieval finished, one of the ``RetrievalMetric`` outcomes
+        """
+        if self.sd_get_ended is not None:
+            self.metric.finish_seconds = time.time() - self.sd_get_ended
+        self.metric.ended = timezone.now()
+        self.metric.outcome = outcome
+        try:
+            self.metric.save()
+        except Exception as e:
+            print("Could not save retrieval metrics for slot {}: {}".format(self.metric.slot, e))
+
+
+# the metrics of the retrieval running in each slot in this process, keyed by slot pk
+retrieval_metrics = {}
+
+
+def record_sd_get(slot, pid):
+    """Record the process id and host of the ``sd_get`` running for the slot, so that ``check_happy`` can find it.
+
+    :param integer slot: slot number
+    :param integer pid: process id of the instance of ``sd_get``
+    """
+    slot.host_ip = socket.gethostbyname(socket.gethostname())
+    slot.pid = pid
+    slot.save()
+    if slot.pk in retrieval_metrics:
+        retrieval_metrics[slot.pk].start_sd_get()
+
+
+def start_sd_get(slot, file_listing_filename, target_disk):
+    """
+    Start the process of retrieving files from StorageD by calling (the command line program) sd_get, with the
+    list of files created by ``create_retrieve_listing`` as input, for a single slot.  The process id of the instance
+    of sd_get running for the slot is returned.  A logfile is also created, with output from sd_get being appended to
+    the logfile.
+
+    :param integer slot: slot number
+    :param string file_listing_filename: the name of the text file containing the names of the files to retrieve from
+        StorageD.  This file listing is created by ``create_retrieve_listing``.
+    :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
+    :return: process id of the instance of ``sd_get``, the name of the output log file
+    :rtype: Tuple(integer, string)
+    """
+    sd_get_cmd, log_file_name = sd_get_command(slot, file_listing_filename, target_disk)
 
     # start storage-D process and record pid and host
     p = subprocess.Popen(sd_get_cmd)
     print("Starting retrieval of file listing : {}".format(
         file_listing_filename)
     )
-    slot.host_ip = socket.gethostbyname(socket.gethostname())
-    slot.pid = p.pid
-    slot.save()
+    record_sd_get(slot, p.pid)
     return p, log_file_name
 
 
+class RestoredFileBatch(object):
+    """Buffer of the files restored by the ``sd_get`` for a slot, which are committed together by ``flush``.  The
+    batch should be flushed when it is ``due``: when it holds ``RESTORE_BATCH_SIZE`` files or its oldest file was
+    added ``RESTORE_BATCH_INTERVAL`` seconds ago.
+
+    :var integer slot: slot number
+    :var RestoreDisk target_disk: *RestoreDisk* the files have been restored to
+    :var files: the restored TapeFiles that have not yet been committed
+    """
+
+    def __init__(self, slot, target_disk, max_files=None, max_wait=None):
+        self.slot = slot
+        self.target_disk = target_disk
+        self.max_files = RESTORE_BATCH_SIZE if max_files is None else max_files
+        self.max_wait = RESTORE_BATCH_INTERVAL if max_wait is None else max_wait
+        self.files = []
+        self.started = None
+
+    def add(self, f):
+        """Add a restored TapeFile to the batch."""
+        if len(self.files) == 0:
+            self.started = time.time()
+        self.files.append(f)
+        if self.slot.pk in retrieval_metrics:
+            retrieval_metrics[self.slot.pk].file_restored()
+
+    def time_to_flush(self):
+        """Seconds until the batch is due to be flushed, or None if the batch is empty."""
+        if len(self.files) == 0:
+            return None
+        if len(self.files) >= self.max_files:
+            return 0
+        return max(self.started + self.max_wait - time.time(), 0)
+
+    def due(self):
+        return self.time_to_flush() == 0
+
+    def flush(self):
+        """Commit the restored files: mark them all as RESTORED in one ``bulk_update``, add their sizes to the
+        restore disk in one update, credit the other requests waiting for them and add the change of their location
+        to the outbox for Elastic Search (``LocationUpdate``).
+
+        :return: the number of files committed
+        :rtype: integer
+        """
+        if len(self.files) == 0:
+            return 0
+        files = self.files
+        self.files = []
+        self.started = None
+
+        now = timezone.now()
+        for f in files:
+            f.stage = TapeFile.RESTORED
+            f.restoring_request = None
+            # bulk_update does not set auto_now fields
+            f.last_updated = now
+        TapeFile.objects.bulk_update(files, ["stage", "restoring_request", "last_updated"], batch_size=1000)
+
+        # set the first files on disk if not already set
+        tape_request = self.slot.tape_request
+        if tape_request.first_files_on_disk is None:
+            tape_request.first_files_on_disk = datetime.datetime.utcnow()
+            tape_request.save()
+        # update the restore_disk - the space is now used rather than reserved
+        restored_bytes = sum(f.size for f in files)
+        self.target_disk.add_used(restored_bytes)
+        release_space(tape_request, self.target_disk, restored_bytes)
+        if self.slot.pk in retrieval_metrics:
+            retrieval_metrics[self.slot.pk].add_restored(len(files), restored_bytes)
+        # credit the other requests waiting for these files
+        credit_waiting_requests(tape_request, [f.pk for f in files])
+        # modify the restored files in elastic search - sent by flush_location_updates
+        LocationUpdate.enqueue([f.logical_path for f in files], LocationUpdate.ON_DISK)
+        return len(files)
+
+
+def link_restored_file(f, local_restored_path):
+    """Create a symbolic link from the restored file in the restore area to the original logical path of the file in
+    the archive.
+
+    :param TapeFile f: the restored file
+    :param string local_restored_path: the path the file has been restored to
+    :return: whether the link was created
+    :rtype: boolean
+    """
+    try:
+        # if it is a link
+        #    if the file doesn't exist then unlink and relink
+        #    if the file does exist then raise except
+        if os.path.islink(f.logical_path):
+            if os.path.exists(f.logical_path):
+                raise Exception(
+                    "File exists and is not a link".format(f.logical_path)
+                )
+            else:
+                os.unlink(f.logical_path)
+                os.symlink(local_restored_path, f.logical_path)
+        else:
+            os.symlink(local_restored_path, f.logical_path)
+    except:
+        print("Could not create symlink from {} to {}".format(f.logical_path, local_restored_path))
+        return False
+    return True
+
+
+def process_log_lines(lines, slot, target_disk, retrieved_to_file_map, batch=None):
+    """Process lines from the ``sd_get`` log for a slot.  For each report of a restored file a symbolic link is
+    created from its place in the restore area (*RestoreDisk* ``target_disk``) to the original logical_file_path
+    location in the archive, and the file is added to the ``RestoredFileBatch``.  The batch is flushed whenever it
+    is due.  If no batch is given then the files are committed before returning.
+
+    :param lines: lines read from the log file
+    :param integer slot: slot number
+    :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
+    :param retrieved_to_file_map: Mapping of spot filepaths to logical file paths, created by ``create_retrieve_listing``
+    :param RestoredFileBatch batch: the batch to add the restored files to
+    :return: the number of files restored
+    :rtype: integer
+    """
+    flush = batch is None
+    if flush:
+        batch = RestoredFileBatch(slot, target_disk)
+
+    files_restored = 0
+    for line in lines:
+        # look for line with right pattern to know its finished
+        m = RESTORED_PATTERN.search(line)
+        if m:
+            restored_archive_file_path = m.groups()[0]
+            local_restored_path = m.groups()[1]
+            # move the retrieved file back to archive area.
+            f = retrieved_to_file_map[restored_archive_file_path]
+            # link file to final archive location
+            if link_restored_file(f, local_restored_path):
+                batch.add(f)
+                files_restored += 1
+                if batch.due():
+                    batch.flush()
+    if flush:
+        batch.flush()
+    return files_restored
+
+
 def wait_sd_get(p, slot, log_file_name, target_disk, retrieved_to_file_map):
     """
-    Wait for the ``sd_get`` process for a slot to finish.  The function monitors the log file (``log_file_name``)
-    for reports of file restores from StorageD (carried out by ``sd_get``.  When a restored file is found, a symbolic
-    link is created from its place in the restore area (*RestoreDisk* ``target_disk``) to the original logical_file_path
-    location in the archive.
+    Wait for the ``sd_get`` process for a slot to finish.  The function follows the log file (``log_file_name``)
+    with a ``LogFollower`` for reports of file restores from StorageD (carried out by ``sd_get``), and processes the
+    new lines with ``process_log_lines`` as soon as they are written.  The restored files are committed in batches
+    (``RestoredFileBatch``).
 
     :param integer p: process id of the instance of ``sd_get``
     :param integer slot: slot number
     :param string log_file_name: name of log file to append to
     :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
     :param retrieved_to_file_map: Mapping of spot filepaths to logical file paths, created by ``create_retrieve_listing``
+    :return: the number of files restored
+    :rtype: integer
+    """
+    return wait_sd_gets(slot, [(p, log_file_name, target_disk, retrieved_to_file_map)])
+
+
+def wait_sd_gets(slot, sd_gets, lease=None):
+    """
+    Wait for all of the ``sd_get`` processes for a slot to finish, when the request is split across restore disks,
+    following the logs of all the processes at once.  See ``wait_sd_get``.  If the lease on the slot is lost, the
+    ``sd_get`` processes are stopped and ``LeaseLost`` is raised, as the request may have been restarted by another
+    process.
+
+    :param integer slot: slot number
+    :param sd_gets: list of (process, log file name, target disk, retrieved_to_file_map) for each ``sd_get``
+    :param Lease lease: the lease on the slot, if it is held
+    :return: the number of files restored
+    :rtype: integer
     """
-    # setup log file to read
     files_retrieved = 0
-    log_file = None
-    ended = False
-
-    while True:
-        # sleep first, to allow process to start
-        time.sleep(10)
-        # see if process has ended
-        if p.poll() is not None:
-            ended = True
-
-        # see is logfile is available yet. if not then wait a second and try again.
-        if log_file is None:
-            if os.path.exists(log_file_name):
-                log_file = open(log_file_name)
-            else:
+    watches = [
+        (p, LogFollower(log_file_name), RestoredFileBatch(slot, target_disk), target_disk, retrieved_to_file_map)
+        for p, log_file_name, target_disk, retrieved_to_file_map in sd_gets
+    ]
+    try:
+        while len(watches) > 0:
+            if lease is not None and lease.lost.is_set():
+                print("Lost lease on slot {}, stopping sd_get".format(slot.pk))
+                for w in watches:
+                    w[0].terminate()
+                lease.check()
+            for watch in list(watches):
+                p, follower, batch, target_disk, retrieved_to_file_map = watch
+                # see if process has ended - the log is read once more after it has, to get the last lines
+                ended = p.poll() is not None
+                lines = follower.read_lines(final=ended)
+                if len(lines) > 0:
+                    files_retrieved += process_log_lines(lines, slot, target_disk, retrieved_to_file_map, batch)
                 if ended:
-                    break
-                time.sleep(1)
-                continue
-
-        # check the log file for reports of file restores...
-        lines = log_file.readlines()
-        # keep a list of restored filenames
-        restored_files = []
-
-        for line in lines:
-            # look for line with right pattern to know its finished
-            if TEST_VERSION:
-                m = re.search('Copying file: (.*) to (.*)', line)
-            else:
-                m = re.search('Saving (.*) into local file (.*)', line)
-            if m:
-                restored_archive_file_path = m.groups()[0]
-                local_restored_path = m.groups()[1]
-                files_retrieved += 1
-                # move the retrieved file back to archive area.
-                f = retrieved_to_file_map[restored_archive_file_path]
-                # link file to final archive location
-                try:
-                    # if it is a link
-                    #    if the file doesn't exist then unlink and relink
-                    #    if the file does exist then raise except
-                    if os.path.islink(f.logical_path):
-                        if os.path.exists(f.logical_path):
-                            raise Exception(
-                                "File exists and is not a link".format(f.logical_path)
-                            )
-                        else:
-                            os.unlink(f.logical_path)
-                            os.symlink(local_restored_path, f.logical_path)
-                    else:
-                        os.symlink(local_restored_path, f.logical_path)
-                except:
-                    print("Could not create symlink from {} to {}".format(f.logical_path, local_restored_path))
-                else:
-                    # set the first files on disk if not already set
-                    if slot.tape_request.first_files_on_disk is None:
-                        slot.tape_request.first_files_on_disk = datetime.datetime.utcnow()
-                    f.stage = TapeFile.RESTORED
-                    f.save()
-                # update the restore_disk
-                target_disk.update()
-                # add the filename to the restored filenames
-                restored_files.append(f.logical_path)
-        # modify the restored files in elastic search
-        try:
-            if len(restored_files) > 0:
-                update_file_location(path_list=restored_files, location="on_disk")
-        except Exception as e:
-            print("Failed updating Elastic Search Index ",)
-            print(e, restored_files)
-        log_file.close()
-        log_file = None
+                    watches.remove(watch)
+                    follower.close()
+                    batch.flush()
+                elif batch.due():
+                    batch.flush()
+            if len(watches) > 0:
+                # wake up in time to flush the batches
+                flush_times = [w[2].time_to_flush() for w in watches if w[2].time_to_flush() is not None]
+                wait_any([w[1] for w in watches], min(flush_times) if flush_times else None)
+    finally:
+        for p, follower, batch, target_disk, retrieved_to_file_map in watches:
+            follower.close()
+            batch.flush()
+    return files_retrieved
 
-        # checking to see if the process ended before we searched the log file
-        if ended:
-            break
 
 def complete_request(slot):
     """Tidy up slot after a completed request.  This involves setting dates for the storaged_request_end
@@ -356,6 +977,7 @@ def complete_request(slot):
     slot.tape_request.storaged_request_end = datetime.datetime.utcnow()
     slot.tape_request.last_files_on_disk = datetime.datetime.utcnow()
     slot.tape_request.save()
+    release_space(slot.tape_request)
     # reset slot
     slot.pid = None
     slot.host_ip = None
@@ -363,89 +985,234 @@ def complete_request(slot):
     slot.save()
 
 
-def start_retrieval(slot):
-    """Function to run the storage-D retrieve for a tape request.
-    This function takes a slot with an attached tape request, creates a working directory for the retrival listing,
-    log file and retrieved data. It starts an sd_get command as a subprocess and monitors its progress by monitoring
-    the log file and polling to see if the process is completed.
+def release_slot(slot):
+    """Free the slot after a batch of files in the request has been retrieved, but other files in the request are
+    still to be retrieved.  The request stays active and is put back into a slot by ``load_slots``.
 
-    :param integer slot: slot number to strat the request in
+       :param integer slot: slot number
+    """
+    print("Released request {} from slot {} with files still to retrieve".format(
+        slot.tape_request, slot.pk)
+    )
+    release_space(slot.tape_request)
+    slot.pid = None
+    slot.host_ip = None
+    slot.tape_request = None
+    slot.save()
+
+
+def prepare_retrieval(slot):
+    """Prepare the retrieval for the request in a slot.  The restore disk(s) are chosen, the retrieve listing for
+    each restore disk is created and the start email is sent.  If there is nothing to retrieve then the slot is
+    completed or released.
+
+    :param integer slot: slot number
+    :return: list of the target disk, the name of the retrieve listing and the mapping between the retrieve listing
+        and the TapeFiles (see ``create_retrieve_listing``), for each restore disk, or None if there is nothing to
+        retrieve
+    :rtype: List[Tuple(RestoreDisk, string, Dictionary[string:TapeFile])]
     """
 
     # don't call this if slot not filled or already started.
     assert slot.tape_request is not None, "ERROR: Can only call watch_sd_get with a full slot"
-
-    # files to retrieve
-    files = slot.tape_request.files.filter(stage=TapeFile.ONTAPE)
+    prepare_started = time.time()
 
     # if no files need retrieving then just mark up as if finished
-    if len(files) == 0:
+    if not slot.tape_request.files.filter(stage=TapeFile.ONTAPE).exists():
+        # unless the files are being restored by another request, in which case wait for them
+        if slot.tape_request.files.filter(stage=TapeFile.RESTORING).exists():
+            release_slot(slot)
+            return None
         slot.tape_request.storaged_request_start = datetime.datetime.utcnow()
         complete_request(slot)
-        return False
+        return None
+
+    # get the files to retrieve on this run - if none of them can be retrieved then give the slot to other requests
+    files = get_retrieve_batch(slot)
+    if len(files) == 0:
+        print("No files in request {} can be retrieved".format(slot.tape_request))
+        release_slot(slot)
+        return None
 
-    # get the next free restore disk
-    target_disk = get_restore_disk(slot)
-    # error check - no room on the disk returns None
-    if target_disk is None:
+    # get the restore disk(s) for the files to retrieve
+    partitions = get_restore_partitions(slot, files)
+    # error check - no room on the disks returns no partitions
+    if len(partitions) == 0:
         print("ERROR: No RestoreDisks exist with enough space to hold the request")
-        return False
+        return None
 
-    # create the retrieve listing file and get the mapping between the retrieve listing and the spot filename
-    file_listing_filename, retrieved_to_file_map = create_retrieve_listing(slot, target_disk)
+    retrievals = []
+    for target_disk, files in partitions:
+        # create the retrieve listing file and get the mapping between the retrieve listing and the spot filename
+        file_listing_filename, retrieved_to_file_map = create_retrieve_listing(slot, target_disk, files)
+        if len(retrieved_to_file_map) == 0:
+            release_space(slot.tape_request, target_disk)
+            continue
+        # only the files claimed are retrieved now - reduce the reservation to their size
+        reserve_space(slot.tape_request, target_disk, sum(f.size for f in retrieved_to_file_map.values()))
+        retrievals.append((target_disk, file_listing_filename, retrieved_to_file_map))
 
     # check whether any files actually need to be downloaded
-    if len(retrieved_to_file_map) != 0:
+    if len(retrievals) == 0:
+        # Deactivate request and make slot available to others
+        slot.tape_request.save()
+        slot.tape_request = None
+        slot.save()
+        return None
 
-        print("  Start request for %s on slot %s" % (slot.tape_request, slot.pk))
-        # send start notification email if no files retrieved
-        if slot.tape_request.files.filter(stage=TapeFile.RESTORED).count() == 0:
-            send_start_email(slot)
+    print("  Start request for %s on slot %s" % (slot.tape_request, slot.pk))
+    if len(retrievals) > 1:
+        print("  Request split across restore disks: {}".format(", ".join(str(r[0]) for r in retrievals)))
+    # send start notification email if no files retrieved
+    if slot.tape_request.files.filter(stage=TapeFile.RESTORED).count() == 0:
+        send_start_email(slot)
 
-        # start the sd_get_process
-        p, log_file_name = start_sd_get(slot, file_listing_filename, target_disk)
+    retrieval_metrics[slot.pk] = RetrievalMetrics(slot, prepare_started, retrievals)
+    return retrievals
 
-        wait_sd_get(p, slot, log_file_name, target_disk, retrieved_to_file_map)
 
-        # request ended - send ended email if there are no files in the request left ONTAPE or RESTORING
-        if slot.tape_request.files.filter(Q(stage=TapeFile.ONTAPE) | Q(stage=TapeFile.RESTORING)).count() == 0:
-            send_end_email(slot)
+def finish_retrieval(slot):
+    """Finish the request in a slot after ``sd_get`` has ended.  The slot is completed if all the files in the
+    request are on disk, released if files are still to be retrieved by later runs, or redone if files from this run
+    were not retrieved.
+
+    :param integer slot: slot number
+    """
+    metrics = retrieval_metrics.pop(slot.pk, None)
+    if metrics is not None:
+        metrics.end_sd_gets()
+
+    # request ended - send ended email if there are no files in the request left ONTAPE or RESTORING
+    if slot.tape_request.files.filter(Q(stage=TapeFile.ONTAPE) | Q(stage=TapeFile.RESTORING)).count() == 0:
+        send_end_email(slot)
 
-        # if got all the files then mark slot as empty
-        if slot.tape_request.files.filter(stage=TapeFile.RESTORING).count() == 0:
+    # if got all the files then mark slot as empty
+    if own_restoring_files(slot.tape_request).count() == 0:
+        reset_retries(slot.tape_request)
+        if slot.tape_request.files.filter(Q(stage=TapeFile.ONTAPE) | Q(stage=TapeFile.RESTORING)).count() == 0:
             complete_request(slot)
+            outcome = RetrievalMetric.COMPLETE
         else:
-            print("Request finished on StorageD, but all files in request not retrieved yet")
-            redo_request(slot)          # mark the request to reattempt later
-        return True
+            # files on other tapes, or being restored by other requests, are still to come - give the slot
+            # up so that the request is rescheduled along with the other requests
+            release_slot(slot)
+            outcome = RetrievalMetric.RELEASED
     else:
-        # Deactivate request and make slot available to others
-        slot.tape_request.save()
-        slot.tape_request = None
-        slot.save()
+        print("Request finished on StorageD, but all files in request not retrieved yet")
+        # the files resumed by redo_request were restored by this retrieval, so are counted in its metrics
+        if metrics is not None:
+            retrieval_metrics[slot.pk] = metrics
+        redo_request(slot)          # mark the request to reattempt later
+        retrieval_metrics.pop(slot.pk, None)
+        outcome = RetrievalMetric.REDO
+
+    if metrics is not None:
+        metrics.save(outcome)
+
+
+def start_retrieval(slot, lease=None):
+    """Function to run the storage-D retrieve for a tape request.
+    This function takes a slot with an attached tape request, creates a working directory for the retrival listing,
+    log file and retrieved data (``prepare_retrieval``). It starts an sd_get command as a subprocess for each restore
+    disk the files are retrieved to, and monitors their progress by monitoring the log files and polling to see if
+    the processes are completed (``wait_sd_gets``), then finishes the request (``finish_retrieval``).  The slot
+    records the process id of the last sd_get started.
+
+    :param integer slot: slot number to strat the request in
+    :param Lease lease: the lease on the slot, if it is held
+    """
+    with profile_phase("prepare_retrieval"):
+        retrievals = prepare_retrieval(slot)
+    if retrievals is None:
         return False
 
+    # start the sd_get_process for each restore disk
+    sd_gets = []
+    with profile_phase("sd_get"):
+        for target_disk, file_listing_filename, retrieved_to_file_map in retrievals:
+            p, log_file_name = start_sd_get(slot, file_listing_filename, target_disk)
+            sd_gets.append((p, log_file_name, target_disk, retrieved_to_file_map))
+
+        wait_sd_gets(slot, sd_gets, lease)
+
+    with profile_phase("finish_retrieval"):
+        finish_retrieval(slot)
+    return True
+
+
+def resume_restoring_files(slot):
+    """Link the files that the failed retrieval for the request in the slot had already restored, so that they are
+    not retrieved again.  A file has been restored if it is on its restore disk with the size of the TapeFile - a
+    partly written file is retrieved again.
+
+    :param integer slot: slot number
+    :return: the number of files linked
+    :rtype: integer
+    """
+    batches = {}
+    for f in own_restoring_files(slot.tape_request).select_related("restore_disk"):
+        if f.restore_disk is None:
+            continue
+        try:
+            to_retrieve, spot_name = retrieve_path(f)
+        except TapeFileException:
+            continue
+        local_restored_path = restored_file_path(f.restore_disk, to_retrieve)
+        if not os.path.isfile(local_restored_path) or os.path.getsize(local_restored_path) != f.size:
+            continue
+        if link_restored_file(f, local_restored_path):
+            if f.restore_disk_id not in batches:
+                batches[f.restore_disk_id] = RestoredFileBatch(slot, f.restore_disk)
+            batches[f.restore_disk_id].add(f)
+    return sum(batch.flush() for batch in batches.values())
+
+
+def schedule_retry(tape_request):
+    """Record a failed retrieval of the request, and set the time before which it is not put into a slot again.
+    The delay doubles with each failure in a row, from ``RETRY_BACKOFF_BASE`` up to ``RETRY_BACKOFF_MAX`` seconds.
+
+    :param TapeRequest tape_request: the request
+    """
+    tape_request.retry_count += 1
+    delay = min(RETRY_BACKOFF_BASE * 2 ** (tape_request.retry_count - 1), RETRY_BACKOFF_MAX)
+    tape_request.retry_after = timezone.now() + datetime.timedelta(seconds=delay)
+    print("Retrying request {} after {}s (attempt {})".format(tape_request.pk, delay, tape_request.retry_count))
+
+
+def reset_retries(tape_request):
+    """Clear the failed retrievals of the request, after a successful retrieval."""
+    if tape_request.retry_count != 0 or tape_request.retry_after is not None:
+        tape_request.retry_count = 0
+        tape_request.retry_after = None
+        TapeRequest.objects.filter(pk=tape_request.pk).update(retry_count=0, retry_after=None)
+
 
 def redo_request(slot):
-    """Reset a tape request so that it will be restarted.  This is used for requests with files that are stuck
-       in the RESTORING stage.
+    """Resume a tape request that has failed, so that only the files that were not retrieved are retrieved again.
+    This is used for requests with files that are stuck in the RESTORING stage.
 
-       - Mark all files with stage RESTORING as ONTAPE (i.e. reset them to previous state)
-       - Reset all the information in the request so that it is marked as not started
+       - Link and mark as RESTORED the files that had been restored before the failure (``resume_restoring_files``)
+       - Mark the other files with stage RESTORING by this request as ONTAPE (i.e. reset them to previous state)
+       - Back off before retrying the request (``schedule_retry``)
 
        :param integer slot: slot number to redo the request for
     """
     print("Redoing request {} on slot {}".format(
         slot.tape_request, slot.pk)
     )
-    # mark unrestored files as on tape
-    for f in slot.tape_request.files.filter(stage=TapeFile.RESTORING):
-        f.stage = TapeFile.ONTAPE
-        f.save()
-    # mark tape request as not started
-    slot.tape_request.storaged_request_start = None
+    n_resumed = resume_restoring_files(slot)
+    if n_resumed > 0:
+        print("  Resumed {} files already restored".format(n_resumed))
+    # mark unrestored files as on tape - only the files this request is restoring, files being restored by
+    # other requests are left with those requests
+    TapeFile.objects.filter(
+        pk__in=list(own_restoring_files(slot.tape_request).values_list("pk", flat=True))
+    ).update(stage=TapeFile.ONTAPE, restoring_request=None, last_updated=timezone.now())
+    # the request keeps its start time, as the files already restored are kept
     slot.tape_request.storaged_request_end = None
+    schedule_retry(slot.tape_request)
     slot.tape_request.save()
+    release_space(slot.tape_request)
     # reset slot
     slot.pid = None
     slot.host_ip = None
@@ -457,33 +1224,52 @@ def check_happy(slot):
     """Check the progress of the requests in each slot.  Several scenarios are accounted for:
 
        - The request hasn't started yet (do nothing)
+       - The lease on the slot is held by a running retrieval, on any host (do nothing)
        - The request is stuck in the RESTORING phase (restart the request via ``redo_requests``)
-       - This script has been run from a different host (do nothing)
+       - The retrieval was started from a different host, and its lease has expired or been released (restart
+         the request via ``redo_requests``)
+       - The retrieval was started from a different host without a lease (do nothing)
        - The ``sd_get`` process is still running (do nothing)
        - The ``sd_get`` process is not running but the request has started (restart the request via ``redo_requests``)
 
        :param integer slot: slot number to check
        """
     print("Checking slot %s" % slot)
+    with profile_phase("check_happy"):
+        _check_happy(slot)
+
+
+def _check_happy(slot):
     if slot.tape_request.storaged_request_start is None:
         # no need to tidy up an unstarted process
         print("No need to correct: not started yet.")
         return
 
+    # check whether the retrieval is still running - the lease is renewed while it is running
+    lease = ProcessLease.objects.filter(name=slot_lease_name(slot)).first()
+    if lease is not None and lease.expires is not None and lease.expires >= timezone.now():
+        print("No need to correct: retrieval lease held by {}.".format(lease))
+        return
+
     # look for files stuck in RESTORING state
     if slot.pid is None or slot.host_ip is None:
         start_time = slot.tape_request.storaged_request_start.replace(tzinfo=utc)
-        if start_time < datetime.datetime.now(utc) + datetime.timedelta(seconds=120):
+        if start_time + datetime.timedelta(seconds=120) < datetime.datetime.now(utc):
             # no port or host ip and not started
             print("Reset request: pid or host not set and not started for 120s.")
             redo_request(slot)
             return
         else:
-            # wait for rest after 20 seconds
-            print("No need to correct: pid or host not sec, but less than 20s old.")
+            # wait for reset after 120 seconds
+            print("No need to correct: pid or host not set, but less than 120s old.")
             return
 
     if slot.host_ip != socket.gethostbyname(socket.gethostname()):
+        if lease is not None:
+            # the retrieval on the other host has finished or died without clearing the slot
+            print("Reset request: retrieval lease on other host expired.")
+            redo_request(slot)
+            return
         # can't reset from different machine
         print("No need to correct: Not on right host.")
         return
@@ -497,60 +1283,111 @@ def check_happy(slot):
         redo_request(slot)
         return
 
-def run():
+def slot_lease_name(slot):
+    """Name of the lease held while retrieving the request in a slot."""
+    return "slot-%s" % slot.pk
+
+
+def retrieve_slot(slot):
+    """Run the retrieval for the request in a slot (``start_retrieval``), while holding the lease on the slot.
+    The lease stops the slot being retrieved by more than one process, on any host.
+
+    :param integer slot: slot number to start the request in
+    :return: whether a retrieval was run
+    :rtype: boolean
+    """
+    with Lease(slot_lease_name(slot)) as lease:
+        if not lease.held:
+            print("  Slot %s is being retrieved by another process" % slot.pk)
+            return False
+        # the slot may have been started or emptied by another process before the lease was acquired
+        slot.refresh_from_db()
+        if slot.tape_request is None or slot.pid is not None:
+            return False
+        try:
+            return start_retrieval(slot, lease)
+        except LeaseLost:
+            # the request is left to the process that took over the slot
+            print("  Stopped retrieval for slot %s: lease lost" % slot.pk)
+            return True
+
+
+def acquire_retrieval_lease(heartbeat=True):
+    """Acquire one of the ``MAX_RETRIEVALS`` retrieval leases of this host.  These limit the number of retrievals
+       running on a host at once, whether from the cron runs of this script, the scheduler or
+       ``retrieve_files_async``.
+
+       :param boolean heartbeat: whether to renew the lease in a heartbeat thread (see ``Lease``)
+       :return: the lease, or None if all of them are held
+       :rtype: Lease
+    """
+    for i in range(MAX_RETRIEVALS):
+        lease = Lease("retrieve_files-{}-{}".format(socket.gethostname(), i), heartbeat=heartbeat)
+        if lease.acquire():
+            return lease
+    return None
+
+
+@profiled("retrieve_files")
+def run(*args):
     """ Entry point for the Django script run via ``./manage.py retrieve_files``
 
         The algorithm / order to run the above functions is
+          - acquire one of the ``MAX_RETRIEVALS`` retrieval leases for this host
+
           - **for each** slot:
 
             - **if** no request in the slot **then** continue to next slot
 
+            - load the storage paths, if not already loaded (``TapeFile.load_storage_paths``)
+
             - **if** request already active in the slot **then** check the progress of the request (``check_happy``)
 
             - **if** there is a new request in the slot **then**
 
-              - load the storage paths (``TapeFile.load_storage_paths``)
-
-              - start the retrieval of the file(s) in the request and create an active request in this slot (``start_retrieval``)
+              - start the retrieval of the file(s) in the request and create an active request in this slot, while
+                holding the lease on the slot (``retrieve_slot``)
 
+        :Script arguments:
+            * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
     """
 
-    # First of all check if the process is running - if it is then don't start running again
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "retrieve_files" in l and not "/bin/sh" in l:
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > MAX_RETRIEVALS+1:   # this process counts as one process_requests processx
+    # First of all check how many retrievals are running on this host - if there are already MAX_RETRIEVALS
+    # then don't start another
+    retrieval_lease = acquire_retrieval_lease()
+    if retrieval_lease is None:
         print("Process already running {} transfers, exiting".format(MAX_RETRIEVALS))
         sys.exit()
 
-    # flag whether storage paths are loaded
-    spaths_loaded = False
-
-    print("Start retrieval runs for a slot")
-
-    # load storage paths to do path translation to from logical to storage paths.
-    if not spaths_loaded:
-        print("Load storage paths")
-        TapeFile.load_storage_paths()
-        spaths_loaded = True
-
-    for slot in StorageDSlot.objects.all():
-        if slot.tape_request is None:
-            print("  No request for slot %s" % slot.pk)
-            continue
-        elif slot.pid is not None:
-            print("  Request for %s already active on slot %s" % (slot.tape_request, slot.pk))
-            check_happy(slot)
-            continue
-        else:
-            print("  Process slot %s" % slot.pk)
-            if start_retrieval(slot):
-               break
+    try:
+        # flag whether storage paths are loaded
+        spaths_loaded = False
+
+        print("Start retrieval runs for a slot")
+
+        with phase_timer("retrieve_files"):
+            for slot in StorageDSlot.objects.all():
+                if slot.tape_request is None:
+                    print("  No request for slot %s" % slot.pk)
+                    continue
+
+                # load storage paths to do path translation to from logical to storage paths.  These are only
+                # loaded when there is a request, so that a run with nothing to do does not fetch them.
+                if not spaths_loaded:
+                    print("Load storage paths")
+                    with profile_phase("load_storage_paths"):
+                        TapeFile.load_storage_paths()
+                    spaths_loaded = True
+
+                if slot.pid is not None:
+                    print("  Request for %s already active on slot %s" % (slot.tape_request, slot.pk))
+                    check_happy(slot)
+                    continue
+                else:
+                    print("  Process slot %s" % slot.pk)
+                    if retrieve_slot(slot):
+                       break
+    finally:
+        retrieval_lease.release()
 
     print("End retrieval run.")
@@ -0,0 +1,337 @@
+""" Retrieve the requests in all of the storage-D slots from a single process, using asyncio.
+
+ ``retrieve_files`` runs one sd_get per process and blocks until it has finished, so running ``MAX_RETRIEVALS``
+ retrievals needs ``MAX_RETRIEVALS`` Django processes, each with its own database connection.  This script starts
+ and watches the sd_get processes for up to ``ASYNC_MAX_RETRIEVALS`` slots at once from one event loop.  The logs of
+ the sd_get processes are followed concurrently and the restored files are processed as they appear.  Each
+ retrieval holds one of the per-host retrieval leases of ``retrieve_files``, so the retrievals of this script, the
+ cron ``retrieve_files`` and ``nla_scheduler`` together never exceed ``MAX_RETRIEVALS`` on a host.
+
+ The database work is done by the functions in ``retrieve_files`` (``prepare_retrieval``, ``process_log_lines``,
+ ``finish_retrieval`` etc.).  These are run with ``sync_to_async`` in a single thread, so the process only uses one
+ database connection however many slots it is retrieving.  The leases are renewed from the event loop rather than
+ by a heartbeat thread for each lease.  If the lease on a slot is lost, its sd_get is stopped and the retrieval is
+ not finished, as the slot may have been taken by another process.
+
+ Sending SIGTERM or SIGINT stops the retriever: no new retrievals are started, and the tasks watching the running
+ retrievals are cancelled, committing the files restored so far and releasing the leases on their slots.  The
+ sd_get processes themselves are not killed - they are left to finish, and their slots are picked up by
+ ``check_happy`` when the retriever, or ``retrieve_files``, is next run.
+
+ This is designed to be used via the django-extensions runscript command, instead of the cron entries for
+ ``retrieve_files``:
+
+ ``$ python manage.py runscript retrieve_files_async``
+"""
+
+from nla_control.models import *
+from nla_site.settings import *
+from nla_control.leases import Lease, LeaseLost, LEASE_DURATION
+from nla_control.log_follower import LogFollower
+from nla_control.scripts import retrieve_files
+from nla_control.profiling import profile_phase, profiled
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+import asyncio
+import signal
+import socket
+import subprocess
+import sys
+import traceback
+
+# maximum number of slots to retrieve at once from the one process
+ASYNC_MAX_RETRIEVALS = getattr(settings, "ASYNC_MAX_RETRIEVALS", MAX_RETRIEVALS)
+# interval, in seconds, between checking the slots for new requests
+ASYNC_SLOT_POLL = getattr(settings, "ASYNC_SLOT_POLL", 10)
+# longest interval, in seconds, between checks that the sd_get processes are still running.  The logs are read as
+# soon as they change (see ``nla_control.log_follower``).
+ASYNC_LOG_POLL = getattr(settings, "ASYNC_LOG_POLL", 1)
+
+
+def db(func):
+    """Wrap a synchronous function that uses the database so that it can be awaited.  All of the wrapped functions
+    are run in the same thread, and so share one database connection."""
+    return sync_to_async(func, thread_sensitive=True)
+
+
+def get_slots():
+    """Get the slots, with their requests, and close the database connection if it has gone stale."""
+    close_old_connections()
+    return list(StorageDSlot.objects.all().select_related("tape_request"))
+
+
+def acquire_slot(slot, lease):
+    """Acquire the lease on the slot and check that the slot still has a request that has not started.
+
+    :param integer slot: slot number
+    :param Lease lease: the lease on the slot
+    :return: whether the slot can be retrieved
+    :rtype: boolean
+    """
+    if not lease.acquire():
+        print("  Slot %s is being retrieved by another process" % slot.pk)
+        return False
+    # the slot may have been started or emptied by another process before the lease was acquired
+    slot.refresh_from_db()
+    if slot.tape_request is None or slot.pid is not None:
+        lease.release()
+        return False
+    return True
+
+
+def renew_leases(leases):
+    """Renew the leases held for the slots being retrieved.  A lease that cannot be renewed is marked as lost, which
+    stops the watch of the slot's sd_get.
+
+    :param leases: the leases to renew
+    """
+    for lease in leases:
+        lease.renew()
+
+
+class AsyncRetriever(object):
+    """Start and watch the sd_get processes for the slots, up to ``max_retrievals`` at once.
+
+       :var asyncio.Event stop_event: set to stop starting new retrievals
+       :var dict retrievals: the task running for each slot, keyed by slot pk
+       :var dict leases: the lease held for each slot, keyed by slot pk
+       :var dict retrieval_leases: the retrieval lease of this host held for each slot, keyed by slot pk
+    """
+
+    def __init__(self, max_retrievals=ASYNC_MAX_RETRIEVALS, slot_poll=ASYNC_SLOT_POLL, log_poll=ASYNC_LOG_POLL):
+        self.max_retrievals = max_retrievals
+        self.slot_poll = slot_poll
+        self.log_poll = log_poll
+        self.stop_event = None
+        self.retrievals = {}
+        self.leases = {}
+        self.retrieval_leases = {}
+
+    def stop(self):
+        """Stop starting new retrievals.  Used as the signal handler for SIGTERM and SIGINT."""
+        print("Stopping retriever")
+        self.stop_event.set()
+
+    async def fill_slots(self):
+        """Check the slots, and start a retrieval task for each slot with a request that has not started, up to
+        ``max_retrievals`` at once, and while one of the retrieval leases of this host is free.  Slots with an sd_get
+        running that is not watched by this process are checked with ``check_happy``."""
+        retrieval_leases_free = True
+        for slot in await db(get_slots)():
+            if slot.tape_request is None or slot.pk in self.retrievals:
+                continue
+            elif slot.pid is not None:
+                await db(retrieve_files.check_happy)(slot)
+            elif len(self.retrievals) < self.max_retrievals and retrieval_leases_free:
+                retrieval_lease = await db(retrieve_files.acquire_retrieval_lease)(heartbeat=False)
+                if retrieval_lease is None:
+                    print("  Already running {} transfers on this host".format(MAX_RETRIEVALS))
+                    retrieval_leases_free = False
+                    continue
+                lease = Lease(retrieve_files.slot_lease_name(slot), heartbeat=False)
+                if await db(acquire_slot)(slot, lease):
+                    print("  Process slot %s" % slot.pk)
+                    self.leases[slot.pk] = lease
+                    self.retrieval_leases[slot.pk] = retrieval_lease
+                    self.retrievals[slot.pk] = asyncio.ensure_future(
+                        self.retrieve_slot(slot, lease, retrieval_lease)
+                    )
+                else:
+                    await db(retrieval_lease.release)()
+
+    async def retrieve_slot(self, slot, lease, retrieval_lease=None):
+        """Run the retrieval for the request in a slot: prepare the retrieval, start sd_get for each restore disk,
+        process the restored files as they appear in the logs and finish the request when the sd_gets have ended.
+        If the lease on the slot is lost the sd_gets are stopped and the request is not finished.
+
+        :param integer slot: slot number
+        :param Lease lease: the lease held on the slot
+        :param Lease retrieval_lease: the retrieval lease of this host taken for the retrieval, released at the end
+        """
+        try:
+            retrievals = await db(retrieve_files.prepare_retrieval)(slot)
+            if retrievals is None:
+                return
+
+            # start an sd_get for each restore disk the request is retrieved to, and watch them all
+            watches = []
+            for target_disk, file_listing_filename, retrieved_to_file_map in retrievals:
+                sd_get_cmd, log_file_name = await db(retrieve_files.sd_get_command)(
+                    slot, file_listing_filename, target_disk
+                )
+                # sd_get is started with Popen, rather than asyncio, so that it is not killed if the retriever stops
+                p = subprocess.Popen(sd_get_cmd)
+                print("Starting retrieval of file listing : {}".format(file_listing_filename))
+                await db(retrieve_files.record_sd_get)(slot, p.pid)
+                watches.append(
+                    self.watch_sd_get(p, slot, log_file_name, target_disk, retrieved_to_file_map, lease)
+                )
+
+            # wait for all of the watches to end, even if one fails, so that no sd_get is left unwatched
+            for result in await asyncio.gather(*watches, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    raise result
+            await db(retrieve_files.finish_retrieval)(slot)
+        except LeaseLost:
+            print("Lost lease on slot {}, not finishing the retrieval".format(slot.pk))
+        except Exception:
+            print("Retrieval failed for slot {}".format(slot.pk))
+            traceback.print_exc()
+        finally:
+            # the lease is released even if the task is cancelled while releasing it, and the slot is only
+            # forgotten once the lease has been released, so that it is not renewed or retrieved again meanwhile
+            try:
+                await asyncio.shield(db(lease.release)())
+                if retrieval_lease is not None:
+                    await asyncio.shield(db(retrieval_lease.release)())
+            finally:
+                del self.leases[slot.pk]
+                self.retrieval_leases.pop(slot.pk, None)
+                del self.retrievals[slot.pk]
+
+    async def wait_for_log(self, follower, timeout=None):
+        """Wait for the log being followed to change, for at most ``log_poll`` seconds.  The inotify file descriptor
+        of the follower is added to the event loop, so that waiting does not block the other retrievals.
+
+        :param LogFollower follower: the follower of the sd_get log
+        :param float timeout: wait for less than ``log_poll`` seconds
+        """
+        if timeout is None or timeout > self.log_poll:
+            timeout = self.log_poll
+        fd = follower.fileno()
+        if fd is None:
+            await asyncio.sleep(min(follower.poll_interval, timeout))
+            return
+        loop = asyncio.get_event_loop()
+        changed = loop.create_future()
+        loop.add_reader(fd, lambda: changed.done() or changed.set_result(True))
+        try:
+            await asyncio.wait_for(changed, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+        follower.inotify.drain()
+
+    async def watch_sd_get(self, p, slot, log_file_name, target_disk, retrieved_to_file_map, lease=None):
+        """Follow the log of the sd_get process for a slot until the process has ended, processing the new lines
+        with ``process_log_lines`` as they are written.  If the lease on the slot is lost, the sd_get process is
+        stopped and ``LeaseLost`` is raised, as the request may have been restarted by another process.
+
+        :param subprocess.Popen p: the sd_get process
+        :param integer slot: slot number
+        :param string log_file_name: name of the sd_get log file
+        :param RestoreDisk target_disk: *RestoreDisk* object containing the mountpoint where files will be written to
+        :param retrieved_to_file_map: Mapping of spot filepaths to TapeFiles, created by ``create_retrieve_listing``
+        :param Lease lease: the lease on the slot, if it is held
+        """
+        follower = LogFollower(log_file_name)
+        batch = retrieve_files.RestoredFileBatch(slot, target_disk)
+        try:
+            while True:
+                if lease is not None and lease.lost.is_set():
+                    print("Lost lease on slot {}, stopping sd_get".format(slot.pk))
+                    p.terminate()
+                    lease.check()
+                # the log is read once more after the process has ended, to get the last lines
+                ended = p.poll() is not None
+                lines = follower.read_lines(final=ended)
+                if len(lines) > 0:
+                    await db(retrieve_files.process_log_lines)(
+                        lines, slot, target_disk, retrieved_to_file_map, batch
+                    )
+                if ended:
+                    break
+                if batch.due():
+                    await db(batch.flush)()
+                await self.wait_for_log(follower, batch.time_to_flush())
+        finally:
+            follower.close()
+            await self.flush_batch(slot, batch)
+
+    async def flush_batch(self, slot, batch):
+        """Commit the files in a batch, when the watch of an sd_get ends.  The flush is shielded, so that cancelling
+        the watch does not interrupt the files being committed, and an error is reported rather than hiding the
+        reason the watch ended.
+
+        :param integer slot: slot number
+        :param RestoredFileBatch batch: the batch of restored files
+        """
+        try:
+            await asyncio.shield(db(batch.flush)())
+        except Exception:
+            print("Could not commit the files restored for slot {}".format(slot.pk))
+            traceback.print_exc()
+
+    async def run(self):
+        """Fill the slots and renew the leases every ``slot_poll`` seconds until stopped."""
+        self.stop_event = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+
+        last_renew = loop.time()
+        while not self.stop_event.is_set():
+            try:
+                await self.fill_slots()
+                # renew the leases three times per duration so that they don't expire while sd_get is running
+                if loop.time() - last_renew > LEASE_DURATION / 3.0:
+                    await db(renew_leases)(list(self.leases.values()) + list(self.retrieval_leases.values()))
+                    last_renew = loop.time()
+            except Exception:
+                print("Checking slots failed")
+                traceback.print_exc()
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), min(self.slot_poll, LEASE_DURATION / 3.0))
+            except asyncio.TimeoutError:
+                pass
+
+        # stop watching the slots that are still retrieving, which releases their leases - the sd_gets are left to
+        # finish and check_happy will pick them up
+        for slot_pk in list(self.retrievals.keys()):
+            self.retrievals[slot_pk].cancel()
+        if len(self.retrievals) > 0:
+            await asyncio.wait(list(self.retrievals.values()))
+        print("Retriever stopped")
+
+
+@profiled("retrieve_files_async")
+def run(*args):
+    """ Entry point for the Django script run via ``./manage.py runscript retrieve_files_async``
+
+        The algorithm is
+          - acquire the lease of the retriever on this host, so that only one retriever runs on a host
+
+          - load the storage paths (``TapeFile.load_storage_paths``)
+
+          - **every** ``ASYNC_SLOT_POLL`` seconds, until stopped:
+
+            - **for each** slot with a request that has not started, up to ``ASYNC_MAX_RETRIEVALS``:
+
+              - acquire one of the retrieval leases of this host (``retrieve_files.acquire_retrieval_lease``) and
+                the lease on the slot, and start a task that runs ``prepare_retrieval``, starts sd_get, tails its
+                log with ``process_log_lines`` and calls ``finish_retrieval``
+
+            - **for each** slot with an sd_get that is not watched by this process, ``check_happy``
+
+            - renew the leases held for the slots being retrieved
+
+        :Script arguments:
+            * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+    """
+    retriever_lease = Lease("retrieve_files_async-{}".format(socket.gethostname()))
+    if not retriever_lease.acquire():
+        print("Retriever already running on this host, exiting")
+        sys.exit()
+
+    try:
+        print("Load storage paths")
+        with profile_phase("load_storage_paths"):
+            TapeFile.load_storage_paths()
+        print("Starting retriever")
+        asyncio.run(AsyncRetriever().run())
+    finally:
+        retriever_lease.release()
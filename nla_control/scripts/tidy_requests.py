@@ -10,14 +10,15 @@
 
 # SJP 2016-02-09
 
-from nla_control.models import TapeFile, TapeRequest
+from nla_control.models import TapeFile, TapeRequest, LocationUpdate
 import datetime
 import sys
 from pytz import utc
 from nla_site.settings import *
-from nla_control.scripts.process_requests import update_requests
-from fbi_core import update_file_location
-import subprocess
+from nla_control.scripts.process_requests import update_requests, add_request_files
+from nla_control.leases import Lease
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profile_phase, profiled
 
 __author__ = 'sjp23'
 
@@ -75,11 +76,8 @@ def tidy_requests():
         for i in range(0, int(n_rf/n_per_batch+1)):
             batch_files = request_files[i*n_per_batch:(i+1)*n_per_batch]
             print("Processing {}/{}".format(i*len(batch_files), n_rf))
-            present_tape_files = TapeFile.objects.filter(logical_path__in=batch_files)
-            if len(present_tape_files) != 0:
-                pf = list(present_tape_files.all())
-                tr.files.add(*pf)
-                tr.save()
+            present_tape_files = TapeFile.objects.filter(logical_path__in=batch_files).values_list("id", flat=True)
+            add_request_files([(tr.id, f_id) for f_id in present_tape_files])
 
     # list of restore disks used - cache them so that they only need to be updated once
     restore_disks = []
@@ -161,13 +159,8 @@ def tidy_requests():
             removed_files.append(f.logical_path)
 
         print("Setting status of files in Elastic Search to not on disk")
-        try:
-            # Open connection to index and update files
-            if len(removed_files) > 0:
-                update_file_location(path_list=removed_files, location="on_tape")
-        except Exception as e:
-            print("Failed updating Elastic Search Index ",)
-            print(e, removed_files)
+        # the updates are sent to the index by flush_location_updates
+        LocationUpdate.enqueue(removed_files, LocationUpdate.ON_TAPE)
 
         print("Remove request %s" % tr)
         tr.delete()
@@ -177,25 +170,24 @@ def tidy_requests():
         rd.update()
 
 
-def run():
-    """Entry point for the Django script run via ``./manage.py runscript``"""
+@profiled("tidy_requests")
+def run(*args):
+    """Entry point for the Django script run via ``./manage.py runscript``
+
+       :Script arguments:
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
+    """
     # First of all check if the process is running - if it is then don't start running again
     print("Starting tidy_requests")
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "tidy_requests" in l and not "/bin/sh" in l:
-                print(l)
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:
-        print("Process already running, exiting")
-        sys.exit()
-
-    # otherwise run
-    update_requests()
-    tidy_requests()
+    with Lease("tidy_requests") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit()
+
+        # otherwise run
+        with phase_timer("tidy_requests"):
+            with profile_phase("update_requests"):
+                update_requests()
+            with profile_phase("tidy_requests"):
+                tidy_requests()
     print("Finished tidy_requests")
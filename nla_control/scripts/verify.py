@@ -3,16 +3,24 @@ __author__ = 'sjp23'
 # verify files on storage-D
 
 from nla_control.models import TapeFile, TapeRequest, Quota, TapeFileException
-import glob
 import pytz
 import os
 import datetime
 import sys
-import subprocess
 from nla_site.settings import *
+from nla_control.scripts.process_requests import add_request_files
+from nla_control.leases import Lease
+from nla_control.checksum_index import ChecksumIndex
+from nla_control.metrics import phase_timer
+from nla_control.profiling import profile_phase, profiled
 
-# load storage paths to do path translation to from logical to storage paths.
-TapeFile.load_storage_paths()
+from django.conf import settings
+from django.db.models import F, TextField, Value
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+# number of UNVERIFIED files read, and committed once verified, at once
+VERIFY_CHUNK_SIZE = getattr(settings, "VERIFY_CHUNK_SIZE", 2000)
 
 def _run_test():
     files = TapeFile.objects.filter(stage=TapeFile.UNVERIFIED)
@@ -27,6 +35,7 @@ def _run_test():
         f.verified = datetime.datetime.now()
         f.save()
 
+@profiled("verify")
 def run(*args):
 
     """Entry point for the Django script run via ./manage.py in the Django project directory
@@ -36,6 +45,7 @@ def run(*args):
 
        :Script arguments:
            * *verify_now* -- set the retention time to be now
+           * *profile*, *profile=cprofile*, *slow_sql=<seconds>* -- profile the run (see ``nla_control.profiling``)
 
        **Purpose**:
                     Script to check from a list of files which files have associated check
@@ -52,25 +62,144 @@ def run(*args):
                       is the value we will use to reference any files.
 
                       Now check to see if the file in the list has a check sum in
-                      the associated checksum files. Output and appropriate
-                      message with each of the filenames.
+                      the associated checksum files, using the index of the checksum
+                      files (``nla_control.checksum_index``), which reads each file
+                      once. Output and appropriate message with each of the filenames.
         """
 
     # First of all check if the process is running - if it is then don't start running again
-    try:
-        lines = subprocess.check_output(["ps", "-f", "-u", "badc"]).decode("utf-8").split("\n")
-        n_processes = 0
-        for l in lines:
-            if "verify" in l and not "/bin/sh" in l:
-                print(l)
-                n_processes += 1
-    except:
-        n_processes = 1
-
-    if n_processes > 1:
-        print("Process already running, exiting")
-        sys.exit()
+    with Lease("verify") as lease:
+        if not lease.held:
+            print("Process already running, exiting")
+            sys.exit()
+
+        # don't fetch the storage paths if there is nothing to verify
+        if not TapeFile.objects.filter(stage=TapeFile.UNVERIFIED).exists():
+            print("No UNVERIFIED files")
+            return
+
+        # load storage paths to do path translation to from logical to storage paths.
+        with profile_phase("load_storage_paths"):
+            TapeFile.load_storage_paths()
+
+        if "verify_now" in args:
+            verify_now = True
+        else:
+            verify_now = False
+
+        with phase_timer("verify"):
+            verify_files(verify_now, lease)
+
+
+def file_chunks(files, chunk_size=VERIFY_CHUNK_SIZE):
+    """Read the TapeFiles of a queryset in chunks, in order of their id.  Only one chunk is held in memory, and the
+       files can be updated as they are read, as each chunk is a separate query starting after the last file read.
+
+       :param files: the TapeFile queryset
+       :param integer chunk_size: the number of files in each chunk
+       :return: generator of lists of TapeFiles
+    """
+    last_pk = None
+    while True:
+        chunk = files.order_by("pk")
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if len(chunk) == 0:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def make_verify_request(label, verify_now=False):
+    """Make a tape file request so all verified files belong to a request.  This request belongs to the _VERIFY
+       quota, and holds the files on disk until its retention time, when ``tidy_requests`` removes them.
+
+       :param string label: the label of the request
+       :param boolean verify_now: set the retention time of the request to be now
+       :rtype: TapeRequest
+    """
+    quota = Quota.objects.filter(user="_VERIFY").first()
+    if quota is None:
+        quota = Quota(user="_VERIFY", size=10000000000000, notes="System quota for requests from tidying.")
+        quota.save()
+
+    now = datetime.datetime.now(pytz.utc)
+    if verify_now:
+        retention = now
+    else:
+        retention = now + datetime.timedelta(days=20)
+    tape_request = TapeRequest(quota=quota, retention=retention, storaged_request_start=now, storaged_request_end=now,
+                               first_files_on_disk=now, last_files_on_disk=now, label=label)
+    tape_request.save()
+    return tape_request
+
+
+class VerifiedFiles(object):
+    """The files verified by a run of ``verify`` or ``quick_verify``, which are committed a chunk at a time by
+    ``checkpoint``.  A run that stops part way through keeps the files committed at the last checkpoint.
+
+    :var TapeRequest tape_request: the request the verified files are added to
+    :var files: the verified TapeFiles that have not yet been committed
+    :var integer n_verified: the number of files committed
+    """
 
+    def __init__(self, tape_request):
+        self.tape_request = tape_request
+        self.files = []
+        self.n_verified = 0
+
+    def add(self, f):
+        """Add a verified TapeFile."""
+        self.files.append(f)
+
+    def checkpoint(self):
+        """Commit the verified files: mark them all as ONDISK, add them to the files of the request and append their
+        paths to the ``request_files`` of the request, in a few queries for the whole chunk.
+
+        :return: the number of files committed
+        :rtype: integer
+        """
+        if len(self.files) == 0:
+            return 0
+        files = self.files
+        self.files = []
+
+        now = timezone.now()
+        # the files are all set to the same values, so this is an update of the files by id rather than a
+        # bulk_update.  update does not set auto_now fields.
+        file_ids = [f.pk for f in files]
+        for i in range(0, len(file_ids), 1000):
+            TapeFile.objects.filter(pk__in=file_ids[i:i + 1000]).update(
+                stage=TapeFile.ONDISK, verified=now, last_updated=now
+            )
+        add_request_files([(self.tape_request.pk, f_id) for f_id in file_ids])
+        # append to the request files in the database, rather than saving the whole of the growing list each time
+        TapeRequest.objects.filter(pk=self.tape_request.pk).update(request_files=Concat(
+            F("request_files"), Value("".join(f.logical_path + "\n" for f in files)), output_field=TextField()
+        ))
+        self.n_verified += len(files)
+        return len(files)
+
+    def finish(self):
+        """Commit the last of the verified files, and delete the request if no files were verified.
+
+        :return: the number of files verified
+        :rtype: integer
+        """
+        self.checkpoint()
+        if self.n_verified == 0:
+            self.tape_request.delete()
+        return self.n_verified
+
+
+def verify_files(verify_now=False, lease=None):
+    """Verify the UNVERIFIED files against the checksum logs in ``CHKSUMSDIR``, as described in ``run``.  This is
+       called by ``run`` and by the ``nla_scheduler`` daemon.
+
+       :param boolean verify_now: set the retention time of the verify request to be now
+       :param Lease lease: the verify lease - the files are not verified any further if it is lost
+    """
     files = TapeFile.objects.filter(stage=TapeFile.UNVERIFIED)
     n_files = files.count()
     print("Number of UNVERIFIED files: {}".format(n_files))
@@ -79,39 +208,18 @@ def run(*args):
     #LIMIT = 100000
     #files = files[n_files-LIMIT:]
 
-    if "verify_now" in args:
-        verify_now = True
-    else:
-        verify_now = False
-
     # HISTORY: Inception 20151103 BC
 
     # create CHKSUMDIR if not exist
     if not os.path.exists(CHKSUMSDIR):
         os.makedirs(CHKSUMSDIR)
 
-    # make a tape file request so all verified files belong to a request. This request
-    # belongs to the _VERIFY quota.
-    quota = Quota.objects.filter(user="_VERIFY")
-    if len(quota) == 0:
-        quota = Quota(user="_VERIFY", size=10000000000000, notes="System quota for requests from tidying.")
-        quota.save()
-    else:
-        quota = quota[0]
-
-    now = datetime.datetime.now(pytz.utc)
-    if verify_now:
-        retention = now
-    else:
-        retention = now + datetime.timedelta(days=20)
-    tape_request = TapeRequest(quota=quota, retention=retention, storaged_request_start=now, storaged_request_end=now,
-                               first_files_on_disk=now, last_files_on_disk=now, label="FROM VERIFY PROCESS")
-    tape_request.save()
+    # make a tape file request so all verified files belong to a request
+    verified = VerifiedFiles(make_verify_request("FROM VERIFY PROCESS", verify_now))
 
     # Now check to see if the files exist in any of the associated
     # check sum listings held in directory CHKSUMSDIR
     #
-    num_verified_files = 0
 
     # missing restore log files (for spots)
     missing_log_files = []
@@ -119,78 +227,65 @@ def run(*args):
     # log files with errors
     error_log_files = []
 
-    # files not found
-    files_not_found = []
-    for f in files:
-        try:
-            spot_logical_path, spot_name = f.spotname()
-        except TapeFileException:
-            # sometimes it's not finding the spotname!
-            print("Spotname not found for file: {}".format(f))
-            continue
-        
-        file_path = f._logical_path
-        if TEST_VERSION:
-            to_find = file_path     # test version verification is just calculate insitu
-            to_find_rel = to_find
-        else:
-            to_find = file_path.replace(spot_logical_path, "/datacentre/restorecache/archive/%s" % spot_name)
-            # also check for a relative path
-            to_find_rel = file_path.replace(spot_logical_path, "%s" % spot_name)
-
-        # find all log files
-        restore_log_search = CHKSUMSDIR + "/%s.chksums.*" % spot_name
-        restore_log_files = glob.glob(restore_log_search)
-
-        # if there are no log files then go to next file
-        if len(restore_log_files) == 0:
-            if not((restore_log_search, spot_name) in missing_log_files):
-                missing_log_files.append((restore_log_search, spot_name))
-            continue
-
-        # A problem here is that there may be more than one restore_log file for each file_set
-        # due to the verify process restarting
-        # To account for this we do the following:
-        # 1. sort the restore log files that match the glob pattern on the date embedded in their filename
-        # 2. step through the log files, most recent first
-        # 3. If we find the file then we exit is already verified then we exit
-        restore_log_files.sort()
-        file_found = False
-
-        for restore_log in restore_log_files:
-            # look for file in restore checksums logs
-            for line in open(restore_log):
-                # get the checksum and filename
-                strip_line = line.strip().split()
-                if len(strip_line) < 2:
-                    if not((restore_log, spot_name) in error_log_files):
-                        error_log_files.append((restore_log, spot_name))
-                    continue
-                checksum = strip_line[0]
-                filename = strip_line[1]
-                # if the filename matches the required filename
-                if (filename == to_find) or (filename == to_find_rel):
-                    # set stage to ONDISK, set verification date
-                    f.stage = TapeFile.ONDISK
-                    f.verified = now
-                    f.save()
-                    # add the request files to the tape request
-                    tape_request.request_files += f._logical_path + "\n"
-                    # increment the number of verified files and indicate that the file is found
-                    num_verified_files += 1
-                    file_found = True
-                if file_found:
-                    break
-            if file_found:
-                break
-        if not file_found:
-            files_not_found.append(to_find)
+    # number of files not found
+    n_not_found = 0
+
+    # index of the checksum logs
+    index = ChecksumIndex(CHKSUMSDIR)
+    # read the files a chunk at a time, committing the files verified in each chunk
+    for chunk in file_chunks(files):
+        if lease is not None:
+            lease.check()
+        # files not found - printed after each chunk so that they are not all held in memory
+        files_not_found = []
+        for f in chunk:
+            try:
+                spot_logical_path, spot_name = f.spotname()
+            except TapeFileException:
+                # sometimes it's not finding the spotname!
+                print("Spotname not found for file: {}".format(f))
+                continue
+
+            file_path = f._logical_path
+            if TEST_VERSION:
+                to_find = file_path     # test version verification is just calculate insitu
+                to_find_rel = to_find
+            else:
+                to_find = file_path.replace(spot_logical_path, "/datacentre/restorecache/archive/%s" % spot_name)
+                # also check for a relative path
+                to_find_rel = file_path.replace(spot_logical_path, "%s" % spot_name)
+
+            # add any new lines in the checksum logs of the spot to the index - this reads each log once per run
+            if index.update(spot_name) == 0:
+                restore_log_search = CHKSUMSDIR + "/%s.chksums.*" % spot_name
+                if not((restore_log_search, spot_name) in missing_log_files):
+                    missing_log_files.append((restore_log_search, spot_name))
+                continue
+
+            # look for the file in the checksum logs of the spot.  There may be more than one log for each spot,
+            # due to the verify process restarting, and the file is verified if it is in any of them.
+            if index.contains(spot_name, to_find, to_find_rel):
+                # set stage to ONDISK, set verification date and add to the tape request, at the checkpoint
+                verified.add(f)
+            else:
+                files_not_found.append(to_find)
+
+        verified.checkpoint()
+        print("Verified {} of {} files".format(verified.n_verified, n_files))
+        if len(files_not_found) > 0:
+            print("Files not found in any log file")
+            for to_find in files_not_found:
+                print("    {}".format(to_find))
+            n_not_found += len(files_not_found)
+
+    # logs with lines that could not be read
+    for spot_name in index.spot_names():
+        for restore_log in index.error_logs(spot_name):
+            error_log_files.append((restore_log, spot_name))
+    index.close()
 
     # if no files don't keep the tape request
-    if num_verified_files == 0:
-        tape_request.delete()
-    else:
-        tape_request.save()
+    verified.finish()
 
     # print the errors:
     if len(missing_log_files) > 0:
@@ -204,8 +299,6 @@ def run(*args):
         for ef in error_log_files:
             print("    {}".format(ef))
 
-    if len(files_not_found) > 0:
+    if n_not_found > 0:
         print ()
-        print ("Files not found in any log file")
-        for f in files_not_found:
-            print("    {}".format(f))
+        print ("{} files not found in any log file".format(n_not_found))
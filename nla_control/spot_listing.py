@@ -0,0 +1,270 @@
+""" Listings of the files in each spot on StorageD, from ``sd_ls``, shared by all of the NLA scripts.
+
+ Listing a spot with ``sd_ls`` is slow, so the listings are cached, both in memory and on disk in
+ ``SPOT_LISTING_CACHE_DIR``, for ``SPOT_LISTING_TTL`` seconds.  The on disk cache is shared between processes and
+ runs of the scripts.  Each spot is stored as a gzipped, tab separated file of the columns of ``SpotFile``.  Many
+ spots can be listed at once with ``prefetch``, which runs up to ``SPOT_LISTING_WORKERS`` ``sd_ls`` in parallel.
+
+ Usage::
+
+     from nla_control.spot_listing import spot_listings
+
+     spot_listings.prefetch(spot_names)
+     contents = spot_listings.get(spot_name)
+     if contents is not None and basename in contents:
+         print(contents[basename].status)
+"""
+
+from django.conf import settings
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# command to run sd_ls, the spot name and options are added to the end.  The test version uses the emulator.
+if getattr(settings, "TEST_VERSION", False):
+    SD_LS_CMD = getattr(settings, "SD_LS_CMD", [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin", "sd_ls_emulator")
+    ])
+else:
+    SD_LS_CMD = getattr(settings, "SD_LS_CMD", ["/usr/bin/python3", "/usr/bin/sd_ls"])
+# directory to store the spot listings in, and how long, in seconds, they are kept before listing the spot again
+SPOT_LISTING_CACHE_DIR = getattr(
+    settings, "SPOT_LISTING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nla_spot_listings")
+)
+SPOT_LISTING_TTL = getattr(settings, "SPOT_LISTING_TTL", 3600)
+# a file missing from a listing older than this, in seconds, may have been added to the spot since it was listed, so
+# ``contains(..., relist=True)`` lists the spot again
+SPOT_LISTING_RELIST_AGE = getattr(settings, "SPOT_LISTING_RELIST_AGE", 60)
+# number of sd_ls to run at once when prefetching the listings of many spots
+SPOT_LISTING_WORKERS = getattr(settings, "SPOT_LISTING_WORKERS", 8)
+# columns of the ``sd_ls -L file`` output - the status, size and file name are the columns the NLA has always read
+SD_LS_COLUMNS = 11
+SD_LS_STATUS_COLUMN = getattr(settings, "SD_LS_STATUS_COLUMN", 2)
+SD_LS_SIZE_COLUMN = getattr(settings, "SD_LS_SIZE_COLUMN", 3)
+SD_LS_NAME_COLUMN = getattr(settings, "SD_LS_NAME_COLUMN", 10)
+# columns of the tape volume and the position on the tape of each file, used to retrieve the files of a request
+# tape by tape.  These are not set by default, as they have not been confirmed against the output of sd_ls: without
+# them the volume and position are None and the files are grouped by spot.  The sd_ls emulator writes them in
+# columns 4 and 5.
+SD_LS_VOLUME_COLUMN = getattr(settings, "SD_LS_VOLUME_COLUMN", None)
+SD_LS_POSITION_COLUMN = getattr(settings, "SD_LS_POSITION_COLUMN", None)
+
+# A file in a spot: the file name on StorageD, its size in bytes, its status (e.g. TAPED), the tape volume it is on
+# and its position on the tape (None if the columns are not set)
+SpotFile = namedtuple("SpotFile", ["file_name", "size", "status", "volume", "position"])
+
+
+def optional_column(fields, column):
+    if column is None:
+        return None
+    return fields[column]
+
+
+def parse_sd_ls(output):
+    """Parse the output of ``sd_ls -L file``.  Lines without the expected number of columns, or without a size,
+       e.g. headers and messages, are skipped.
+
+       :param string output: the output of sd_ls
+       :return: dictionary of the basename of each file to its SpotFile
+       :rtype: Dictionary[string:SpotFile]
+    """
+    contents = {}
+    for out_item in output.split("\n"):
+        out_file = out_item.split()
+        if len(out_file) != SD_LS_COLUMNS:
+            continue
+        try:
+            size = int(out_file[SD_LS_SIZE_COLUMN])
+        except ValueError:
+            continue
+        file_name = out_file[SD_LS_NAME_COLUMN]
+        contents[os.path.basename(file_name)] = SpotFile(
+            file_name, size, out_file[SD_LS_STATUS_COLUMN],
+            optional_column(out_file, SD_LS_VOLUME_COLUMN), optional_column(out_file, SD_LS_POSITION_COLUMN)
+        )
+    return contents
+
+
+def run_sd_ls(spot_name):
+    """List a spot with sd_ls.
+
+       :param string spot_name: name of the spot
+       :return: the listing of the spot, or None if sd_ls failed
+       :rtype: Dictionary[string:SpotFile]
+    """
+    sd_cmd = list(SD_LS_CMD) + ["-s", spot_name, "-L", "file"]
+    try:
+        output = subprocess.check_output(sd_cmd).decode("utf-8")
+    except (subprocess.CalledProcessError, OSError) as e:
+        print("Failed to list spot {}: {}".format(spot_name, e))
+        return None
+    return parse_sd_ls(output)
+
+
+class SpotListingCache(object):
+    """Cache of the spot listings, in memory and on disk.
+
+       :var string cache_dir: directory the listings are stored in
+       :var integer ttl: number of seconds a listing is kept
+       :var integer relist_age: number of seconds after which a listing missing a file is listed again
+    """
+
+    def __init__(self, cache_dir=SPOT_LISTING_CACHE_DIR, ttl=SPOT_LISTING_TTL, list_spot=run_sd_ls,
+                 relist_age=SPOT_LISTING_RELIST_AGE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.relist_age = relist_age
+        self.list_spot = list_spot
+        # spot name: (time listed, listing)
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _path(self, spot_name):
+        return os.path.join(self.cache_dir, "{}.tsv.gz".format(spot_name))
+
+    def _load(self, spot_name):
+        # load the listing from disk, if it is there and has not expired
+        path = self._path(spot_name)
+        try:
+            listed = os.path.getmtime(path)
+            if time.time() - listed > self.ttl:
+                return None
+            contents = {}
+            with gzip.open(path, "rt") as fh:
+                for line in fh:
+                    file_name, size, status, volume, position = line.rstrip("\n").split("\t")
+                    contents[os.path.basename(file_name)] = SpotFile(
+                        file_name, int(size), status, volume or None, position or None
+                    )
+        except (OSError, ValueError):
+            return None
+        return listed, contents
+
+    def _save(self, spot_name, contents):
+        # write to a temporary file and rename it, so that other processes never read a partly written listing
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".{}.".format(spot_name))
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt") as fh:
+                for sf in contents.values():
+                    fh.write("\t".join([
+                        sf.file_name, str(sf.size), sf.status, sf.volume or "", sf.position or ""
+                    ]) + "\n")
+            os.replace(tmp_path, self._path(spot_name))
+        except OSError as e:
+            print("Could not save listing of spot {}: {}".format(spot_name, e))
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _store(self, spot_name, entry):
+        # the expired listings are dropped when a listing is added, so a long run over many spots only holds the
+        # listings made in the last ``ttl`` seconds
+        now = time.time()
+        with self._lock:
+            for s in [s for s, (listed, contents) in self._listings.items() if now - listed > self.ttl]:
+                del self._listings[s]
+            self._listings[spot_name] = entry
+
+    def _fresh(self, spot_name):
+        with self._lock:
+            entry = self._listings.get(spot_name)
+        if entry is not None and time.time() - entry[0] <= self.ttl:
+            return entry[1]
+        entry = self._load(spot_name)
+        if entry is not None:
+            self._store(spot_name, entry)
+            return entry[1]
+        return None
+
+    def get(self, spot_name):
+        """Get the listing of the spot, listing it with sd_ls if it is not cached or has expired.  A failed listing
+           is not cached, so that it is tried again next time.
+
+           :param string spot_name: name of the spot
+           :return: dictionary of the basename of each file to its SpotFile, or None if the spot could not be listed
+           :rtype: Dictionary[string:SpotFile]
+        """
+        contents = self._fresh(spot_name)
+        if contents is not None:
+            return contents
+        contents = self.list_spot(spot_name)
+        if contents is None:
+            return None
+        self._store(spot_name, (time.time(), contents))
+        self._save(spot_name, contents)
+        return contents
+
+    def put(self, spot_name, contents):
+        """Add a listing of a spot to the memory cache, e.g. one made from the database rather than sd_ls.
+
+           :param string spot_name: name of the spot
+           :param contents: dictionary of the basename of each file to its SpotFile
+        """
+        self._store(spot_name, (time.time(), contents))
+
+    def contains(self, spot_name, basename, relist=False):
+        """Whether the spot listing contains the file.
+
+           :param string spot_name: name of the spot
+           :param string basename: basename of the file
+           :param boolean relist: if the file is not in a listing older than ``relist_age`` seconds, list the spot
+               again before deciding, as the file may have been added to the spot since it was listed.  The spot is
+               listed again at most once every ``relist_age`` seconds, however many files are missing from it.
+           :return: True or False, or None if the spot could not be listed
+        """
+        contents = self.get(spot_name)
+        if contents is None:
+            return None
+        if basename not in contents and relist:
+            with self._lock:
+                entry = self._listings.get(spot_name)
+            if entry is None or time.time() - entry[0] > self.relist_age:
+                print("File {} not in the listing of spot {}, listing the spot again".format(basename, spot_name))
+                self.invalidate(spot_name)
+                contents = self.get(spot_name)
+                if contents is None:
+                    return None
+        return basename in contents
+
+    def prefetch(self, spot_names, workers=SPOT_LISTING_WORKERS):
+        """List the spots that are not cached, running up to ``workers`` sd_ls at once.
+
+           :param spot_names: names of the spots
+        """
+        to_list = [s for s in set(spot_names) if self._fresh(s) is None]
+        if len(to_list) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(to_list)), 1)) as executor:
+            list(executor.map(self.get, to_list))
+
+    def invalidate(self, spot_name=None):
+        """Remove the listing of a spot, or of all the spots, from the cache, so that it is listed again.  Used when
+           files have been added to a spot.
+
+           :param string spot_name: name of the spot, or None for all spots
+        """
+        with self._lock:
+            if spot_name is None:
+                spot_names = list(self._listings.keys())
+                self._listings.clear()
+            else:
+                spot_names = [spot_name]
+                self._listings.pop(spot_name, None)
+        if spot_name is None and os.path.isdir(self.cache_dir):
+            spot_names = [f[:-len(".tsv.gz")] for f in os.listdir(self.cache_dir) if f.endswith(".tsv.gz")]
+        for s in spot_names:
+            try:
+                os.unlink(self._path(s))
+            except FileNotFoundError:
+                pass
+
+
+# the cache shared by the scripts in a process
+spot_listings = SpotListingCache()
@@ -1,10 +1,42 @@
 
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import asyncio
+import contextlib
+import datetime
+import io
+import json
 import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
 
 # Create your tests here.
 
-from models import Quota
+from nla_control import profiling, spot_listing
+from nla_control.checksum_index import ChecksumIndex
+from nla_control.leases import Lease, LeaseLost
+from nla_control.log_follower import LogFollower
+from nla_control.models import (LocationUpdate, PhaseTiming, ProcessLease, Quota, RestoreDisk, RestoreDiskReservation,
+                                RetrievalMetric, StorageDSlot, TapeFile, TapeFileException, TapeRequest)
+from nla_control.scripts.process_requests import adjust_slots, load_slots, update_requests
+from nla_control.scripts import (benchmark, fix_problems, flush_location_updates, move_files_to_nla, nla_scheduler,
+                                 process_requests, quick_tidy, quick_verify, retrieve_files, retrieve_files_async,
+                                 verify)
+from nla_control.spot_listing import SpotFile, SpotListingCache, parse_sd_ls, spot_listings
 
 
 class SimpleTest(TestCase):
@@ -20,10 +52,256 @@ class SimpleTest(TestCase):
             item.delete()
 
     def test_up(self):
-        resp = self.client.get('/nla_control/quota/_TEST/requests')
+        resp = self.client.get('/nla_control/api/v1/quota/_TEST')
         self.assertEqual(resp.status_code, 200)
 
 
+
+# Query-count and wall time budgets for the API views and the script phases: (maximum queries, maximum seconds).
+# The query budgets must hold whatever the number of rows, so each is checked with a small and a larger data set.
+BUDGETS = {
+    "request_list": (3, 2.0),
+    "request_detail": (3, 2.0),
+    "quota": (3, 2.0),
+    "files": (2, 2.0),
+    "metrics": (8, 2.0),
+    "update_requests": (12, 5.0),
+    "load_slots": (4, 5.0),
+}
+
+# maximum number of seconds to import the scripts run by cron, after Django is set up
+IMPORT_BUDGET = 2.0
+
+
+class QueryBudget(object):
+    """Count the queries run, and the time taken, inside a ``with`` block."""
+
+    def __init__(self):
+        self.context = CaptureQueriesContext(connection)
+        self.seconds = None
+
+    def __enter__(self):
+        self.context.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.context.__exit__(*exc_info)
+
+    @property
+    def queries(self):
+        return len(self.context.captured_queries)
+
+
+class BudgetTestCase(TestCase):
+    """Base class for the tests of the budgets in ``BUDGETS``."""
+
+    def assertWithinBudget(self, name, func, *args, **kwargs):
+        """Run ``func`` and fail if it runs more queries, or takes longer, than the budget ``name``.
+
+           :return: the number of queries run
+        """
+        max_queries, max_seconds = BUDGETS[name]
+        with QueryBudget() as budget:
+            func(*args, **kwargs)
+        if budget.queries > max_queries:
+            self.fail("{} ran {} queries, over its budget of {}:\n{}".format(
+                name, budget.queries, max_queries,
+                "\n".join(q["sql"] for q in budget.context.captured_queries)
+            ))
+        self.assertLessEqual(budget.seconds, max_seconds,
+                             "{} took {:.2f}s, over its budget of {}s".format(name, budget.seconds, max_seconds))
+        return budget.queries
+
+    def make_requests(self, n_requests, n_files=5):
+        """Make ``n_requests`` listing requests, each for ``n_files`` files on tape, for ``n_requests`` users."""
+        retention = timezone.now() + datetime.timedelta(days=20)
+        start = TapeFile.objects.count()
+        files = TapeFile.objects.bulk_create([
+            TapeFile(logical_path="/badc/budget/file{:06d}.dat".format(start + i), size=1000, stage=TapeFile.ONTAPE)
+            for i in range(n_requests * n_files)
+        ])
+        requests = []
+        for r in range(n_requests):
+            quota = Quota.objects.create(user="budget{}".format(Quota.objects.count()), size=10**12)
+            request_files = files[r * n_files:(r + 1) * n_files]
+            requests.append(TapeRequest.objects.create(
+                quota=quota, retention=retention, label="budget",
+                request_files="\n".join(f.logical_path for f in request_files)
+            ))
+        return requests
+
+
+class ViewBudgetTest(BudgetTestCase):
+    """The API views run a fixed number of queries however many requests and files there are."""
+
+    def check_view(self, name, path):
+        """Check the view with 3 requests, then with 30 more, and check that the number of queries is the same."""
+        queries = []
+        for n_requests in (3, 30):
+            self.make_requests(n_requests)
+            TapeRequest.objects.update(files_updated=None)
+            update_requests()
+            cache.clear()
+            queries.append(self.assertWithinBudget(name, self.get_ok, path() if callable(path) else path))
+        self.assertEqual(queries[0], queries[1], "{} queries grow with the number of rows".format(name))
+
+    def get_ok(self, path):
+        resp = self.client.get(path)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_request_list(self):
+        self.check_view("request_list", "/nla_control/api/v1/requests")
+
+    def test_request_detail(self):
+        self.check_view("request_detail",
+                        lambda: "/nla_control/api/v1/requests/{}".format(TapeRequest.objects.last().pk))
+
+    def test_quota(self):
+        def path():
+            # the quota of a user with all of the requests
+            quota = Quota.objects.first()
+            TapeRequest.objects.update(quota=quota)
+            return "/nla_control/api/v1/quota/{}".format(quota.user)
+        self.check_view("quota", path)
+
+    def test_files(self):
+        self.check_view("files", "/nla_control/api/v1/files?match=budget&stages=T")
+
+    def test_metrics(self):
+        self.check_view("metrics", "/metrics")
+
+
+class MetricsViewTest(TestCase):
+    """The metrics views report the retrievals and the state of the NLA."""
+
+    def add_retrieval(self, slot, sd_get_seconds, bytes_retrieved, days_ago=0, **kwargs):
+        return RetrievalMetric.objects.create(
+            slot=slot, started=timezone.now() - datetime.timedelta(days=days_ago, minutes=10),
+            sd_get_seconds=sd_get_seconds, bytes_retrieved=bytes_retrieved, **kwargs
+        )
+
+    def get_json(self, path):
+        resp = self.client.get(path)
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.content)
+
+    def test_retrieval_histograms(self):
+        self.add_retrieval(1, 5, 100 * 2**20, outcome=RetrievalMetric.COMPLETE, sd_gets=1, files_requested=10)
+        self.add_retrieval(1, 50, 2**30, outcome=RetrievalMetric.COMPLETE, sd_gets=2, files_requested=400)
+        self.add_retrieval(2, 500, 2**30, outcome=RetrievalMetric.REDO, retry_count=1)
+        self.add_retrieval(2, None, 0, outcome=RetrievalMetric.RELEASED)
+        # older than the period reported on
+        self.add_retrieval(1, 5, 2**20, days_ago=10)
+
+        data = self.get_json("/nla_control/api/v1/metrics/retrievals")
+        self.assertEqual(data["retrievals"], 4)
+        self.assertEqual(data["outcomes"], {"complete": 2, "redo": 1, "released": 1})
+        self.assertEqual(data["retries"], 1)
+        self.assertEqual(data["bytes_retrieved"], 2 * 2**30 + 100 * 2**20)
+
+        # the buckets are cumulative and the retrieval without an sd_get is left out
+        sd_get = data["histograms"]["sd_get_seconds"]
+        self.assertEqual(sd_get["count"], 3)
+        self.assertEqual(sd_get["sum"], 555)
+        self.assertEqual((sd_get["min"], sd_get["p50"], sd_get["max"]), (5, 50, 500))
+        self.assertEqual([(b["le"], b["count"]) for b in sd_get["buckets"][:6]],
+                         [(1, 0), (10, 1), (60, 2), (300, 2), (900, 3), (1800, 3)])
+        self.assertEqual(sd_get["buckets"][-1], {"le": "+Inf", "count": 3})
+
+        # 20, 20.48 and 2.048 MiB/s
+        throughput = {b["le"]: b["count"] for b in data["histograms"]["throughput"]["buckets"]}
+        self.assertEqual(throughput[2**20], 0)
+        self.assertEqual(throughput[10 * 2**20], 1)
+        self.assertEqual(throughput[50 * 2**20], 3)
+        files = {b["le"]: b["count"] for b in data["histograms"]["files_per_sd_get"]["buckets"]}
+        self.assertEqual((files[1], files[10], files[100], files[1000]), (0, 1, 1, 2))
+
+        # a slot on its own
+        data = self.get_json("/nla_control/api/v1/metrics/retrievals?slot=2&days=30")
+        self.assertEqual(data["retrievals"], 2)
+        self.assertEqual(list(data["slots"]), ["2"])
+        self.assertEqual(data["histograms"]["sd_get_seconds"]["buckets"][-1]["count"], 1)
+
+        resp = self.client.get("/nla_control/api/v1/metrics/retrievals?days=week")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_prometheus_format(self):
+        retention = timezone.now() + datetime.timedelta(days=20)
+        quota = Quota.objects.create(user='odd"user\\name', size=10**12)
+        request = TapeRequest.objects.create(quota=quota, retention=retention, active_request=True,
+                                             storaged_request_start=timezone.now())
+        StorageDSlot.objects.create(tape_request=request, pid=1234)
+        StorageDSlot.objects.create()
+        RestoreDisk.objects.create(mountpoint="/tmp/nla_test_restore", allocated_bytes=10**9)
+        TapeFile.objects.create(logical_path="/badc/metrics/file.dat", size=1000, stage=TapeFile.ONTAPE)
+        PhaseTiming.record("process_requests", 1.5)
+        PhaseTiming.record("process_requests", 0.25, failed=True)
+        cache.clear()
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = resp.content.decode("utf-8")
+        self.assertTrue(text.endswith("\n"))
+
+        # each metric has its HELP and TYPE, then samples of that metric with valid labels and float values
+        label = r'[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\["\\n])*"'
+        sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(' + label + '(?:,' + label + r')*)\})? (\S+)$')
+        types_seen = {}
+        samples = {}
+        current = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                current = line.split(" ")[2]
+                self.assertNotIn(current, types_seen, "{} is repeated".format(current))
+            elif line.startswith("# TYPE "):
+                name, metric_type = line.split(" ")[2:]
+                self.assertEqual(name, current)
+                self.assertIn(metric_type, ("gauge", "counter"))
+                types_seen[name] = metric_type
+            else:
+                match = sample.match(line)
+                self.assertIsNotNone(match, "not a valid sample: {!r}".format(line))
+                self.assertEqual(match.group(1), current)
+                samples[(match.group(1), match.group(2))] = float(match.group(3))
+        for name, metric_type in types_seen.items():
+            if metric_type == "counter":
+                self.assertTrue(name.endswith("_total"), name)
+
+        self.assertEqual(samples[("nla_slots", None)], 2)
+        self.assertEqual(samples[("nla_requests_active", r'user="odd\"user\\name"')], 1)
+        self.assertEqual(samples[("nla_phase_runs_total", 'phase="process_requests"')], 2)
+        self.assertEqual(samples[("nla_phase_failures_total", 'phase="process_requests"')], 1)
+        self.assertEqual(samples[("nla_files", 'stage="on_tape"')], 1)
+
+
+class PhaseBudgetTest(BudgetTestCase):
+    """The script phases run a fixed number of queries however many requests and files there are."""
+
+    def check_phase(self, name, func, prepare=None):
+        queries = []
+        for n_requests in (3, 30):
+            self.make_requests(n_requests)
+            if prepare is not None:
+                prepare()
+            queries.append(self.assertWithinBudget(name, func))
+        self.assertEqual(queries[0], queries[1], "{} queries grow with the number of rows".format(name))
+
+    def test_update_requests(self):
+        def prepare():
+            TapeRequest.objects.update(files_updated=None)
+        self.check_phase("update_requests", update_requests, prepare)
+
+    def test_load_slots(self):
+        def prepare():
+            update_requests()
+            adjust_slots()
+            StorageDSlot.objects.update(tape_request=None)
+        self.check_phase("load_slots", load_slots, prepare)
+
+
 #Add to primary tape archive
 #Initiate daily?
 #for each file on disk in filesets marked for archive on tape:
@@ -90,3 +368,1469 @@ class SimpleTest(TestCase):
 #Admin goes to web interface and changes quotas.
 
 
+
+
+class ProfilingTest(BudgetTestCase):
+    """The profiling mode of the scripts counts the queries of each phase and logs the slow ones."""
+
+    def test_profile_phases(self):
+        self.make_requests(3)
+
+        @profiling.profiled("test")
+        def run(*args):
+            self.assertEqual(args, ("other",))
+            with profiling.profile_phase("update_requests"):
+                update_requests()
+            with profiling.profile_phase("load_slots"):
+                adjust_slots()
+                load_slots()
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), QueryBudget() as budget:
+            run("profile", "slow_sql=0", "other")
+        output = out.getvalue()
+        self.assertIsNone(profiling._profiler)
+        self.assertIn("Profile of test:", output)
+        # every query is slow, and logged with the line of the NLA code that ran it
+        self.assertEqual(output.count("Slow SQL"), budget.queries)
+        self.assertIn("nla_control/scripts/process_requests.py", output)
+        total = [line.split() for line in output.splitlines() if line.strip().startswith("total")][0]
+        self.assertEqual(int(total[3]), budget.queries)
+
+        # the profiling is off without the profile argument
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            run("other")
+        self.assertNotIn("Profile of", out.getvalue())
+
+
+# imports the scripts in a fresh interpreter and reports the time taken, the heavy modules loaded and the queries run
+IMPORT_CHECK = """
+import json, sys, time
+import django
+django.setup()
+from django.db import connection
+queries = []
+connection.execute_wrappers.append(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args))
+start = time.perf_counter()
+from nla_control.scripts import (process_requests, tidy_requests, retrieve_files, verify, flush_location_updates,
+                                 nla_scheduler)
+seconds = time.perf_counter() - start
+print(json.dumps({
+    "seconds": seconds,
+    "modules": [m for m in ("requests", "fbi_core", "elasticsearch") if m in sys.modules],
+    "queries": queries,
+}))
+"""
+
+
+class ImportTest(TestCase):
+    """Importing the scripts is quick and has no side effects, so a cron run with nothing to do is quick."""
+
+    def test_import_scripts(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "nla_site.settings"))
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_CHECK], env=env)
+        result = json.loads(output.decode("utf-8").strip().split("\n")[-1])
+        self.assertEqual(result["modules"], [], "heavy modules loaded when importing the scripts")
+        self.assertEqual(result["queries"], [], "queries run when importing the scripts")
+        self.assertLessEqual(result["seconds"], IMPORT_BUDGET,
+                             "importing the scripts took {:.2f}s, over its budget of {}s".format(
+                                 result["seconds"], IMPORT_BUDGET))
+
+
+
+class BenchmarkTest(TestCase):
+    """The benchmark flags the phases that are slower, or run more queries, than the baseline results."""
+
+    @staticmethod
+    def results(**phases):
+        return {"phases": {name: {"seconds": seconds, "queries": queries}
+                           for name, (seconds, queries) in phases.items()}}
+
+    def compare(self, results, baseline):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return benchmark.compare_results(results, baseline, threshold=1.2, min_seconds=0.5)
+
+    def test_compare_results(self):
+        baseline = self.results(same=(2.0, 10), slower=(2.0, 10), queries=(2.0, 10), small=(0.1, 10),
+                                faster=(2.0, 10))
+        results = self.results(same=(2.1, 10), slower=(3.0, 10), queries=(2.0, 13), small=(0.4, 10),
+                               faster=(1.0, 5), new=(9.0, 100))
+        # a small change in time is noise, and a phase not in the baseline can't be compared
+        self.assertEqual(self.compare(results, baseline), ["slower", "queries"])
+        self.assertEqual(self.compare(baseline, baseline), [])
+
+    def test_previous_results(self):
+        results_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, results_dir)
+        catalogue = {"files": 10}
+        for name, data in (("20260101T000000-a.json", {"catalogue": catalogue, "database": connection.vendor}),
+                           ("20260102T000000-b.json", {"catalogue": catalogue, "database": connection.vendor}),
+                           ("20260103T000000-c.json", {"catalogue": {"files": 20}, "database": connection.vendor}),
+                           ("20260104T000000-d.json", {"catalogue": catalogue, "database": "other"})):
+            with open(os.path.join(results_dir, name), "w") as fh:
+                json.dump(data, fh)
+        with open(os.path.join(results_dir, "20260105T000000-e.json"), "w") as fh:
+            fh.write("not json")
+        # the latest results for the same catalogue and database
+        path, _ = benchmark.previous_results(results_dir, catalogue)
+        self.assertEqual(os.path.basename(path), "20260102T000000-b.json")
+        self.assertIsNone(benchmark.previous_results(results_dir, {"files": 30}))
+
+
+@override_settings(CEDA_DOWNLOAD_CONF="http://nla.test/download_conf",
+                   STORAGE_PATHS_URL="http://nla.test/storage_paths")
+class StoragePathsTest(TestCase):
+    """The storage paths are replaced in one step, so the retrievals running in other threads of the scheduler never
+    see them empty or partly loaded."""
+
+    def setUp(self):
+        self.old = ({"/badc/old": "spot-old"}, ["/badc/old"], {"spot-old": "/datacentre/old"})
+        for name, value in zip(("fileset_logical_path_map", "fileset_logical_paths", "fileset_storage_path_map"),
+                               self.old):
+            patcher = mock.patch.object(TapeFile, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pages = {
+            "http://nla.test/download_conf": "spot-a /badc/a\nspot-ab /badc/a/b\n",
+            "http://nla.test/storage_paths": "/datacentre/a spot-a\n/datacentre/ab spot-ab\n",
+        }
+
+    def current(self):
+        return (TapeFile.fileset_logical_path_map, TapeFile.fileset_logical_paths, TapeFile.fileset_storage_path_map)
+
+    def get(self, url):
+        # the old mappings are in place until all of the pages have been read
+        self.assertEqual(self.current(), self.old)
+        if url not in self.pages:
+            return mock.Mock(status_code=404)
+        return mock.Mock(status_code=200, text=self.pages[url])
+
+    def test_load_storage_paths(self):
+        with mock.patch("requests.get", side_effect=self.get):
+            TapeFile.load_storage_paths()
+        self.assertEqual(self.current(), (
+            {"/badc/a": "spot-a", "/badc/a/b": "spot-ab"}, ["/badc/a/b", "/badc/a"],
+            {"spot-a": "/datacentre/a", "spot-ab": "/datacentre/ab"},
+        ))
+
+    def test_load_fails(self):
+        del self.pages["http://nla.test/storage_paths"]
+        with mock.patch("requests.get", side_effect=self.get):
+            with self.assertRaises(TapeFileException):
+                TapeFile.load_storage_paths()
+        self.assertEqual(self.current(), self.old)
+
+class ChecksumIndexTest(TestCase):
+    """The checksum index reads each checksum log once, and follows appended, rewritten and removed logs."""
+
+    def setUp(self):
+        self.chksums_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.chksums_dir)
+
+    def write_log(self, name, text, mode="w"):
+        with open(os.path.join(self.chksums_dir, name), mode) as fh:
+            fh.write(text)
+
+    def index(self):
+        index = ChecksumIndex(self.chksums_dir)
+        self.addCleanup(index.close)
+        return index
+
+    def test_index(self):
+        self.assertEqual(self.index().update("spot1"), 0)
+        self.write_log("spot1.chksums.1", "aaa /archive/spot1/a.nc\nbad\n")
+        # a line that is still being written is not read until it is complete
+        self.write_log("spot1.chksums.2", "bbb /archive/spot1/b.nc\nccc /archive/sp")
+        self.write_log("spot2.chksums.1", "ddd /archive/spot2/d.nc\n")
+
+        index = self.index()
+        self.assertEqual(index.update("spot1"), 2)
+        self.assertTrue(index.contains("spot1", "/archive/spot1/a.nc"))
+        self.assertTrue(index.contains("spot1", "spot1/b.nc", "/archive/spot1/b.nc"))
+        self.assertFalse(index.contains("spot1", "/archive/spot1/c.nc"))
+        self.assertFalse(index.contains("spot1", "/archive/spot2/d.nc"))
+        self.assertEqual(index.error_logs("spot1"), [os.path.join(self.chksums_dir, "spot1.chksums.1")])
+
+        # the next run only reads the end of the appended log
+        self.write_log("spot1.chksums.2", "ot1/c.nc\n", "a")
+        index = self.index()
+        with open(os.path.join(self.chksums_dir, "spot1.chksums.2")) as fh:
+            size = len(fh.read())
+        index.update("spot1")
+        offsets = dict(index._connect("spot1").execute("SELECT name, offset FROM logs"))
+        self.assertEqual(offsets[os.path.join(self.chksums_dir, "spot1.chksums.2")], size)
+        self.assertTrue(index.contains("spot1", "/archive/spot1/c.nc"))
+        self.assertEqual(len(index.error_logs("spot1")), 1)
+
+        # rewritten and removed logs are removed from the index
+        os.unlink(os.path.join(self.chksums_dir, "spot1.chksums.1"))
+        self.write_log("spot1.chksums.2", "eee /archive/spot1/e.nc\n")
+        index = self.index()
+        index.update("spot1")
+        self.assertFalse(index.contains("spot1", "/archive/spot1/a.nc"))
+        self.assertFalse(index.contains("spot1", "/archive/spot1/b.nc"))
+        self.assertTrue(index.contains("spot1", "/archive/spot1/e.nc"))
+        self.assertEqual(index.error_logs("spot1"), [])
+
+    def test_max_connections(self):
+        for n in range(5):
+            self.write_log("spot{}.chksums.1".format(n), "aaa /archive/spot{}/a.nc\n".format(n))
+        index = ChecksumIndex(self.chksums_dir, max_connections=2)
+        self.addCleanup(index.close)
+        for n in range(5):
+            self.assertEqual(index.update("spot{}".format(n)), 1)
+            self.assertLessEqual(len(index._connections), 2)
+        self.assertEqual(list(index._connections), ["spot3", "spot4"])
+        # a spot whose database was closed is opened again, and is not read again
+        self.assertTrue(index.contains("spot0", "/archive/spot0/a.nc"))
+        self.assertEqual(list(index._connections), ["spot4", "spot0"])
+        self.assertEqual(index.spot_names(), ["spot0", "spot1", "spot2", "spot3", "spot4"])
+        self.assertEqual(index.error_logs("spot1"), [])
+
+
+class VerifyTest(TestCase):
+    """verify commits the verified files a chunk at a time, in a fixed number of queries per chunk."""
+
+    def setUp(self):
+        chksums_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, chksums_dir)
+        self.log = os.path.join(chksums_dir, "spotv.chksums.1")
+        old_chksumsdir = verify.CHKSUMSDIR
+        verify.CHKSUMSDIR = chksums_dir
+        self.addCleanup(setattr, verify, "CHKSUMSDIR", old_chksumsdir)
+        Quota.objects.create(user="_VERIFY", size=10**13)
+        # the storage paths, as loaded by TapeFile.load_storage_paths
+        for name, value in (("fileset_logical_path_map", {"/badc/vtest": "spotv"}),
+                            ("fileset_logical_paths", ["/badc/vtest"])):
+            if hasattr(TapeFile, name):
+                self.addCleanup(setattr, TapeFile, name, getattr(TapeFile, name))
+            else:
+                self.addCleanup(delattr, TapeFile, name)
+            setattr(TapeFile, name, value)
+
+    def make_files(self, n_files):
+        """Make ``n_files`` UNVERIFIED files, with every other file in the checksum log."""
+        start = TapeFile.objects.count()
+        paths = ["/badc/vtest/file{:06d}.dat".format(start + i) for i in range(n_files)]
+        TapeFile.objects.bulk_create([TapeFile(logical_path=p, size=1000, stage=TapeFile.UNVERIFIED) for p in paths])
+        with open(self.log, "a") as fh:
+            for p in paths[::2]:
+                # the paths checked by the test version and by the real version
+                fh.write("0123 {}\n0123 {}\n".format(p, p.replace("/badc/vtest", "spotv")))
+        return paths
+
+    def test_verify_files(self):
+        queries = []
+        for n_files in (10, 100):
+            paths = self.make_files(n_files)
+            with contextlib.redirect_stdout(io.StringIO()), QueryBudget() as budget:
+                verify.verify_files()
+            queries.append(budget.queries)
+
+            tape_request = TapeRequest.objects.filter(label="FROM VERIFY PROCESS").latest("pk")
+            verified = set(TapeFile.objects.filter(stage=TapeFile.ONDISK, verified__isnull=False)
+                           .values_list("logical_path", flat=True))
+            self.assertTrue(set(paths[::2]) <= verified)
+            self.assertFalse(set(paths[1::2]) & verified)
+            self.assertEqual(tape_request.request_files.split(), paths[::2])
+            self.assertEqual(set(tape_request.files.values_list("logical_path", flat=True)), set(paths[::2]))
+        self.assertEqual(queries[0], queries[1], "verify queries grow with the number of files")
+
+
+class UpdateRequestsTest(TestCase):
+    """update_requests adds the files that have arrived since the last run to the requests, and marks the requests
+    as active while they have files still to retrieve."""
+
+    def setUp(self):
+        quota = Quota.objects.create(user="update", size=10**12)
+        retention = timezone.now() + datetime.timedelta(days=20)
+        self.listing = TapeRequest.objects.create(
+            quota=quota, retention=retention, request_files="/badc/upd/a.dat\n/badc/upd/b.dat"
+        )
+        self.pattern = TapeRequest.objects.create(quota=quota, retention=retention, request_patterns="/badc/upd/")
+
+    def make_file(self, name, stage=TapeFile.ONTAPE):
+        return TapeFile.objects.create(logical_path="/badc/upd/" + name, size=1000, stage=stage)
+
+    def update(self):
+        """Run update_requests, returning the number of files it reported adding to each request."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            update_requests()
+        added = {}
+        for line in output.getvalue().splitlines():
+            match = re.search(r"Request ID (\d+) user \S+ adding (\d+) new files", line)
+            if match:
+                added[int(match.group(1))] = int(match.group(2))
+        return added
+
+    def request_files(self, tape_request):
+        return sorted(os.path.basename(p) for p in tape_request.files.values_list("logical_path", flat=True))
+
+    def active(self):
+        return dict(TapeRequest.objects.values_list("pk", "active_request"))
+
+    def test_incremental(self):
+        a = self.make_file("a.dat")
+        # the first run matches against all of the files
+        self.assertEqual(self.update(), {self.listing.pk: 1, self.pattern.pk: 1})
+        self.assertFalse(TapeRequest.objects.filter(files_updated__isnull=True).exists())
+
+        # the next run only matches the new file, although a.dat is still in the overlap window
+        self.make_file("b.dat")
+        self.make_file("c.dat")
+        self.assertEqual(self.update(), {self.listing.pk: 1, self.pattern.pk: 2})
+        self.assertEqual(self.request_files(self.listing), ["a.dat", "b.dat"])
+        self.assertEqual(self.request_files(self.pattern), ["a.dat", "b.dat", "c.dat"])
+        self.assertEqual(self.active(), {self.listing.pk: True, self.pattern.pk: True})
+
+        # nothing new
+        self.assertEqual(self.update(), {})
+        self.assertEqual(TapeRequest.files.through.objects.count(), 5)
+
+        # the requests are inactive once the files are on disk, and active again if a file goes back on tape
+        for f in TapeFile.objects.all():
+            f.stage = TapeFile.RESTORED
+            f.save()
+        self.update()
+        self.assertEqual(self.active(), {self.listing.pk: False, self.pattern.pk: False})
+        c = TapeFile.objects.get(logical_path="/badc/upd/c.dat")
+        c.stage = TapeFile.ONTAPE
+        c.save()
+        self.assertEqual(self.update(), {})
+        self.assertEqual(self.active(), {self.listing.pk: False, self.pattern.pk: True})
+
+
+    def expected_files(self, tape_request, stages=(TapeFile.ONTAPE, TapeFile.RESTORING)):
+        """The files matched by a request, found one request at a time as update_requests used to."""
+        if tape_request.request_files != "":
+            query = Q(logical_path__in=tape_request.request_files.split())
+        else:
+            query = Q(logical_path__contains=tape_request.request_patterns)
+        return sorted(os.path.basename(p) for p in
+                      TapeFile.objects.filter(query & Q(stage__in=stages)).values_list("logical_path", flat=True))
+
+    def test_bulk_match(self):
+        # the files matched in bulk are the same as matching each request against the files in the right stages
+        self.make_file("a.dat")
+        self.make_file("b.dat", TapeFile.RESTORING)
+        self.make_file("c.dat", TapeFile.ONDISK)
+        self.make_file("d.dat", TapeFile.UNVERIFIED)
+        verify_request = TapeRequest.objects.create(
+            quota=Quota.objects.create(user="_VERIFY", size=10**12), retention=timezone.now(),
+            request_files="/badc/upd/c.dat\n/badc/upd/d.dat"
+        )
+        self.update()
+        self.make_file("e.dat")
+        self.update()
+        self.assertEqual(self.request_files(self.listing), self.expected_files(self.listing))
+        self.assertEqual(self.request_files(self.pattern), self.expected_files(self.pattern))
+        self.assertEqual(self.request_files(self.pattern), ["a.dat", "b.dat", "e.dat"])
+        self.assertEqual(self.request_files(verify_request), ["d.dat"])
+
+    def test_match_updated_tape_files(self):
+        self.listing.files_updated = timezone.now()
+        self.pattern.files_updated = self.listing.files_updated
+        before = self.listing.files_updated - datetime.timedelta(seconds=process_requests.UPDATE_REQUESTS_OVERLAP + 1)
+        updated_files = [
+            (1, "/badc/upd/a.dat", TapeFile.ONTAPE, self.listing.files_updated),
+            (2, "/badc/upd/b.dat", TapeFile.UNVERIFIED, self.listing.files_updated),
+            (3, "/badc/upd/x.dat", TapeFile.ONTAPE, self.listing.files_updated),
+            # updated before the overlap window of the last run
+            (4, "/badc/upd/b.dat", TapeFile.ONTAPE, before),
+        ]
+        stages = process_requests.REQUEST_STAGES
+        self.assertEqual(process_requests.match_updated_tape_files(self.listing, updated_files, stages), [1])
+        self.assertEqual(process_requests.match_updated_tape_files(self.pattern, updated_files, stages), [1, 3])
+
+    def test_add_request_files_twice(self):
+        files = [self.make_file("a.dat"), self.make_file("b.dat")]
+        pairs = [(self.listing.pk, f.pk) for f in files] + [(self.pattern.pk, files[0].pk)]
+        process_requests.add_request_files(pairs)
+        process_requests.add_request_files(pairs)
+        self.assertEqual(sorted(TapeRequest.files.through.objects.values_list("taperequest_id", "tapefile_id")),
+                         sorted(pairs))
+
+class LoadSlotsTest(TestCase):
+    """load_slots shares the free slots between the users, and only loads requests with files left on tape."""
+
+    def setUp(self):
+        self.slots = [StorageDSlot.objects.create() for i in range(3)]
+        old_max = process_requests.MAX_SLOTS_PER_USER
+        process_requests.MAX_SLOTS_PER_USER = 2
+        self.addCleanup(setattr, process_requests, "MAX_SLOTS_PER_USER", old_max)
+
+    def make_request(self, user, n_files=2, stage=TapeFile.ONTAPE, hours_ago=0):
+        quota = Quota.objects.get_or_create(user=user, defaults={"size": 10**12})[0]
+        start = TapeFile.objects.count()
+        files = TapeFile.objects.bulk_create([
+            TapeFile(logical_path="/badc/slots/file{:06d}.dat".format(start + i), size=1000, stage=stage)
+            for i in range(n_files)
+        ])
+        tape_request = TapeRequest.objects.create(
+            quota=quota, retention=timezone.now() + datetime.timedelta(days=20), active_request=True,
+            request_files="\n".join(f.logical_path for f in files)
+        )
+        # request_date is set when the request is made
+        TapeRequest.objects.filter(pk=tape_request.pk).update(
+            request_date=timezone.now() - datetime.timedelta(hours=hours_ago)
+        )
+        tape_request.files.add(*files)
+        return tape_request
+
+    def slotted_users(self):
+        return sorted(
+            StorageDSlot.objects.filter(tape_request__isnull=False).values_list("tape_request__quota__user", flat=True)
+        )
+
+    def test_fair_share(self):
+        # the older requests of user a do not take all of the slots from user b's newer request
+        for i in range(3):
+            self.make_request("a", hours_ago=10 - i)
+        self.make_request("b")
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_slots()
+        self.assertEqual(self.slotted_users(), ["a", "a", "b"])
+
+    def test_max_slots_per_user(self):
+        for i in range(3):
+            self.make_request("a")
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_slots()
+        self.assertEqual(self.slotted_users(), ["a", "a"])
+
+    def test_no_files_on_tape(self):
+        # the files of the first request are being restored by another request, so it needs no slot
+        restoring = self.make_request("a", stage=TapeFile.RESTORING, hours_ago=10)
+        on_tape = self.make_request("b")
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_slots()
+        slotted = set(StorageDSlot.objects.values_list("tape_request", flat=True))
+        self.assertNotIn(restoring.pk, slotted)
+        self.assertIn(on_tape.pk, slotted)
+
+    def test_slots_saved(self):
+        # a slot holding an inactive request is emptied and refilled, and the changes are saved to the database
+        finished = self.make_request("a")
+        TapeRequest.objects.filter(pk=finished.pk).update(active_request=False)
+        StorageDSlot.objects.filter(pk=self.slots[0].pk).update(tape_request=finished)
+        waiting = self.make_request("b")
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_slots()
+        self.assertEqual(StorageDSlot.objects.get(pk=self.slots[0].pk).tape_request_id, waiting.pk)
+        self.assertEqual(StorageDSlot.objects.filter(tape_request__isnull=False).count(), 1)
+
+
+class CoalesceTest(TestCase):
+    """Requests that share files retrieve each file once, and the other requests are credited when it is restored."""
+
+    def setUp(self):
+        self.disk = RestoreDisk.objects.create(mountpoint="/tmp/nla_test_restore", allocated_bytes=10**9)
+        quota = Quota.objects.create(user="coalesce", size=10**12)
+        self.files = TapeFile.objects.bulk_create([
+            TapeFile(logical_path="/badc/coalesce/file{}.dat".format(i), size=1000, stage=TapeFile.ONTAPE)
+            for i in range(3)
+        ])
+        retention = timezone.now() + datetime.timedelta(days=20)
+        self.first = TapeRequest.objects.create(quota=quota, retention=retention, active_request=True)
+        self.first.files.add(*self.files[:2])
+        self.second = TapeRequest.objects.create(quota=quota, retention=retention, active_request=True,
+                                                 notify_on_first_file="a@b.c", notify_on_last_file="a@b.c")
+        self.second.files.add(*self.files[1:])
+
+    def restore(self, tape_request, files):
+        TapeFile.objects.filter(pk__in=[f.pk for f in files]).update(
+            stage=TapeFile.RESTORED, restoring_request=None
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            retrieve_files.credit_waiting_requests(tape_request, [f.pk for f in files])
+
+    def test_shared_files(self):
+        file_ids = [f.pk for f in self.files]
+        self.assertEqual(retrieve_files.claim_files(self.first, self.disk, file_ids[:2]), set(file_ids[:2]))
+        # the shared file is left with the first request
+        self.assertEqual(retrieve_files.claim_files(self.second, self.disk, file_ids[1:]), {file_ids[2]})
+
+        # the shared file is restored by the first request: the second request has started but not finished
+        self.restore(self.first, self.files[:2])
+        self.second.refresh_from_db()
+        self.assertIsNotNone(self.second.first_files_on_disk)
+        self.assertTrue(self.second.active_request)
+        self.assertEqual([m.subject for m in mail.outbox],
+                         ["[NLA] - Tape request {} has started".format(self.second.pk)])
+
+        # crediting more files to a request that has started runs one query, after the update of the files, and
+        # sends no email
+        with QueryBudget() as budget:
+            self.restore(self.first, self.files[:1])
+        self.assertEqual(budget.queries, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # the second request's own file is restored - it is completed when a retrieval credits it
+        TapeFile.objects.filter(pk=file_ids[2]).update(stage=TapeFile.RESTORED)
+        self.restore(self.first, self.files[1:2])
+        self.second.refresh_from_db()
+        self.assertFalse(self.second.active_request)
+        self.assertIsNotNone(self.second.last_files_on_disk)
+        self.assertIsNotNone(self.second.storaged_request_end)
+        self.assertEqual(mail.outbox[-1].subject, "[NLA] - Tape request {} has finished".format(self.second.pk))
+
+
+class SchedulerTest(TestCase):
+    """The scheduler runs each phase under its lease, and shares the retrieval leases of a host with cron."""
+
+    def setUp(self):
+        self.scheduler = nla_scheduler.Scheduler(intervals={"stub": 60})
+        self.leases = []
+        self.addCleanup(self.release_leases)
+
+    def release_leases(self):
+        for lease in self.leases:
+            lease.release()
+
+    def hold(self, name):
+        lease = Lease(name)
+        self.assertTrue(lease.acquire())
+        self.leases.append(lease)
+        return lease
+
+    def run_phase(self, name):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.scheduler.run_phase(name)
+
+    def test_run_phase(self):
+        calls = []
+        self.scheduler.phases["stub"] = lambda lease: calls.append(lease.name)
+        self.run_phase("stub")
+        self.assertEqual(calls, ["stub"])
+        self.assertIn("stub", self.scheduler.last_run)
+        self.assertEqual(PhaseTiming.objects.get(name="stub").runs, 1)
+
+        # the phase does not run while its lease is held elsewhere
+        self.hold("stub")
+        self.run_phase("stub")
+        self.assertEqual(calls, ["stub"])
+
+    def test_run_phase_failure(self):
+        def fail(lease):
+            raise RuntimeError("phase failed")
+        self.scheduler.phases["stub"] = fail
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.run_phase("stub")
+        self.assertIn("stub", self.scheduler.last_run)
+        self.assertEqual(PhaseTiming.objects.get(name="stub").failures, 1)
+
+    def test_retrieve_files_leases(self):
+        quota = Quota.objects.create(user="scheduler", size=10**12)
+        retention = timezone.now() + datetime.timedelta(days=20)
+        for i in range(3):
+            StorageDSlot.objects.create(tape_request=TapeRequest.objects.create(quota=quota, retention=retention))
+        # a cron run of retrieve_files holds one of the retrieval leases of this host
+        self.hold("retrieve_files-{}-0".format(socket.gethostname()))
+
+        started = []
+        finish = threading.Event()
+
+        def retrieve_slot(slot, retrieval_lease):
+            started.append(retrieval_lease.name)
+            self.leases.append(retrieval_lease)
+            finish.wait(10)
+
+        self.scheduler.retrieve_slot = retrieve_slot
+        with mock.patch.object(retrieve_files, "MAX_RETRIEVALS", 2):
+            self.run_phase("retrieve_files")
+        finish.set()
+        for t in self.scheduler.retrievals.values():
+            t.join(10)
+        # there is only one retrieval lease left for the scheduler
+        self.assertEqual(started, ["retrieve_files-{}-1".format(socket.gethostname())])
+
+    def test_retrieve_slot_releases_lease(self):
+        lease = retrieve_files.acquire_retrieval_lease()
+        slot = StorageDSlot.objects.create()
+        with mock.patch.object(retrieve_files, "retrieve_slot", side_effect=RuntimeError("sd_get failed")), \
+                mock.patch.object(nla_scheduler, "connection"), \
+                contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.scheduler.retrieve_slot(slot, lease)
+        self.assertFalse(lease.held)
+        # the lease is free for the next retrieval
+        self.leases.append(retrieve_files.acquire_retrieval_lease())
+        self.assertEqual(self.leases[-1].name, lease.name)
+
+
+class LeaseTest(TestCase):
+    """Leases are held by one holder at a time, and a holder finds out when its lease has been lost."""
+
+    def expire(self, name):
+        ProcessLease.objects.filter(name=name).update(expires=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_acquire(self):
+        first = Lease("test", heartbeat=False)
+        second = Lease("test", heartbeat=False)
+        self.assertTrue(first.acquire())
+        self.assertTrue(ProcessLease.is_held("test"))
+        self.assertFalse(second.acquire())
+        self.assertFalse(second.held)
+        # the holder can acquire its lease again
+        self.assertTrue(first.acquire())
+        first.release()
+        self.assertFalse(ProcessLease.is_held("test"))
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_expiry(self):
+        first = Lease("test", heartbeat=False)
+        first.acquire()
+        self.expire("test")
+        self.assertFalse(ProcessLease.is_held("test"))
+        # the expired lease is taken by another holder
+        second = Lease("test", heartbeat=False)
+        self.assertTrue(second.acquire())
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(first.renew())
+        self.assertTrue(first.lost.is_set())
+        self.assertRaises(LeaseLost, first.check)
+        # releasing the lost lease leaves it with the new holder
+        first.release()
+        self.assertTrue(ProcessLease.is_held("test"))
+        second.check()
+        second.release()
+
+    def test_heartbeat(self):
+        lease = Lease("test", duration=0.3)
+        with mock.patch.object(ProcessLease, "renew", return_value=True) as renew:
+            lease.acquire()
+            time.sleep(0.5)
+            lease.release()
+        self.assertGreaterEqual(renew.call_count, 2)
+        self.assertFalse(lease.lost.is_set())
+
+    def test_heartbeat_lost(self):
+        lease = Lease("test", duration=0.3)
+        with mock.patch.object(ProcessLease, "renew", return_value=False), \
+                contextlib.redirect_stdout(io.StringIO()):
+            lease.acquire()
+            self.assertTrue(lease.lost.wait(5))
+        self.assertFalse(lease.held)
+        self.assertRaises(LeaseLost, lease.check)
+        lease.release()
+
+    def test_heartbeat_errors(self):
+        # the heartbeat keeps trying after a failed renewal, until the lease has expired
+        lease = Lease("test", duration=0.3)
+        with mock.patch.object(ProcessLease, "renew", side_effect=RuntimeError("database gone")) as renew, \
+                contextlib.redirect_stdout(io.StringIO()):
+            lease.acquire()
+            self.assertTrue(lease.lost.wait(5))
+        self.assertGreaterEqual(renew.call_count, 3)
+        lease.release()
+
+    def test_scripts_exit_while_running(self):
+        # the cron scripts do not start while another copy, on any host, holds their lease
+        for name, script in (("quick_tidy", quick_tidy), ("move_files_to_nla", move_files_to_nla)):
+            with Lease(name, heartbeat=False), contextlib.redirect_stdout(io.StringIO()):
+                with mock.patch.object(script, "profile_phase") as profile_phase, self.assertRaises(SystemExit):
+                    script.run()
+            profile_phase.assert_not_called()
+
+    def test_lost_lease_stops_sd_get(self):
+        slot = StorageDSlot.objects.create()
+        disk = RestoreDisk.objects.create(mountpoint="/tmp/nla_test_restore", allocated_bytes=10**9)
+        lease = Lease(retrieve_files.slot_lease_name(slot), heartbeat=False)
+        lease.acquire()
+        lease.lost.set()
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        log_file_name = os.path.join(log_dir, "sd_get.log")
+        open(log_file_name, "w").close()
+        p = subprocess.Popen(["sleep", "30"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertRaises(LeaseLost, retrieve_files.wait_sd_gets, slot, [(p, log_file_name, disk, {})], lease)
+        self.assertIsNotNone(p.wait(5))
+
+
+
+class AsyncRetrieverTest(TransactionTestCase):
+    """The async retriever runs the sd_gets with the StorageD emulator and commits the files as they are restored.
+       The database functions are run in the thread of ``sync_to_async``, so the test data has to be committed."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        spot_path = os.path.join(root, "archive", "spot0")
+        tape_dir = os.path.join(root, "tape")
+        for d in (spot_path, tape_dir, os.path.join(root, "restore")):
+            os.makedirs(d)
+        for patcher in (
+            mock.patch.object(TapeFile, "fileset_logical_paths", [spot_path], create=True),
+            mock.patch.object(TapeFile, "fileset_logical_path_map", {spot_path: "spot0-async"}, create=True),
+            mock.patch.object(retrieve_files, "TEST_VERSION", True),
+            mock.patch.dict(os.environ, {"SD_EMULATOR_TAPE_DIR": tape_dir, "SD_EMULATOR_TIME_SCALE": "0",
+                                         "SD_EMULATOR_STATE_DIR": os.path.join(root, "state")}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.files = []
+        listing = {}
+        for i in range(3):
+            name = "file{}.dat".format(i)
+            with open(os.path.join(tape_dir, name), "w") as fh:
+                fh.write("data {}\n".format(i))
+            self.files.append(TapeFile.objects.create(logical_path=os.path.join(spot_path, name), size=7,
+                                                      stage=TapeFile.ONTAPE))
+            listing[name] = SpotFile("/archive/spot0-async/" + name, 7, "TAPED", "V00001", str(i))
+        spot_listings.put("spot0-async", listing)
+        self.addCleanup(spot_listings.invalidate, "spot0-async")
+
+        RestoreDisk.objects.create(mountpoint=os.path.join(root, "restore"), allocated_bytes=10**9)
+        quota = Quota.objects.create(user="async", size=10**12)
+        tape_request = TapeRequest.objects.create(quota=quota, retention=timezone.now() + datetime.timedelta(days=20),
+                                                  active_request=True)
+        tape_request.files.add(*self.files)
+        self.slot = StorageDSlot.objects.create(tape_request=tape_request)
+        self.lease = Lease(retrieve_files.slot_lease_name(self.slot), heartbeat=False)
+        self.assertTrue(self.lease.acquire())
+        self.retriever = retrieve_files_async.AsyncRetriever(log_poll=0.1)
+
+    async def start(self, slot):
+        self.retriever.leases[slot.pk] = self.lease
+        task = asyncio.ensure_future(self.retriever.retrieve_slot(slot, self.lease))
+        self.retriever.retrievals[slot.pk] = task
+        return task
+
+    async def retrieve(self, slot):
+        await (await self.start(slot))
+
+    def test_retrieve_slot(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(self.retrieve(self.slot))
+        for f in self.files:
+            f.refresh_from_db()
+            self.assertEqual(f.stage, TapeFile.RESTORED)
+            self.assertTrue(os.path.islink(f.logical_path))
+        self.slot.refresh_from_db()
+        self.assertIsNone(self.slot.tape_request)
+        # the lease is released and the slot forgotten
+        self.assertFalse(self.lease.held)
+        self.assertEqual(self.retriever.leases, {})
+        self.assertEqual(self.retriever.retrievals, {})
+
+    def test_cancel(self):
+        # stopping the retriever cancels the watch of the sd_get, which releases the lease and leaves sd_get running
+        pids = []
+        record_sd_get = retrieve_files.record_sd_get
+
+        def record(slot, pid):
+            record_sd_get(slot, pid)
+            pids.append(pid)
+
+        async def cancel(slot):
+            task = await self.start(slot)
+            while len(pids) == 0:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.wait([task])
+
+        # the emulated tape takes 30 seconds to mount
+        with mock.patch.dict(os.environ, {"SD_EMULATOR_TIME_SCALE": "1", "SD_EMULATOR_MOUNT_LATENCY": "30"}), \
+                mock.patch.object(retrieve_files, "record_sd_get", side_effect=record), \
+                contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(cancel(self.slot))
+        self.addCleanup(os.kill, pids[0], signal.SIGKILL)
+        self.assertTrue(os.path.exists("/proc/{}".format(pids[0])))
+        self.assertFalse(self.lease.held)
+        self.assertEqual(self.retriever.leases, {})
+        self.assertEqual(self.retriever.retrievals, {})
+        # the sd_get is recorded on the slot for check_happy
+        self.slot.refresh_from_db()
+        self.assertEqual(self.slot.pid, pids[0])
+
+    def test_lost_lease(self):
+        # another process takes the slot while sd_get is running: the sd_get is stopped and the request not finished
+        pids = []
+        record_sd_get = retrieve_files.record_sd_get
+
+        def record(slot, pid):
+            record_sd_get(slot, pid)
+            pids.append(pid)
+
+        async def lose_lease(slot):
+            task = await self.start(slot)
+            while len(pids) == 0:
+                await asyncio.sleep(0.01)
+            await retrieve_files_async.db(lambda: ProcessLease.objects.filter(name=self.lease.name).update(
+                holder="another process"
+            ))()
+            await retrieve_files_async.db(retrieve_files_async.renew_leases)([self.lease])
+            await asyncio.wait_for(task, 10)
+
+        with mock.patch.dict(os.environ, {"SD_EMULATOR_TIME_SCALE": "1", "SD_EMULATOR_MOUNT_LATENCY": "30"}), \
+                mock.patch.object(retrieve_files, "record_sd_get", side_effect=record), \
+                mock.patch.object(retrieve_files, "finish_retrieval") as finish_retrieval, \
+                contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(lose_lease(self.slot))
+        # the sd_get has been stopped, rather than left to mount the tape
+        for i in range(50):
+            if os.waitpid(pids[0], os.WNOHANG)[0] == pids[0]:
+                break
+            time.sleep(0.1)
+        else:
+            os.kill(pids[0], signal.SIGKILL)
+            self.fail("sd_get was not stopped")
+        finish_retrieval.assert_not_called()
+        self.assertTrue(self.lease.lost.is_set())
+        self.assertEqual(self.retriever.leases, {})
+        self.assertEqual(self.retriever.retrievals, {})
+        # the slot and its files are left for the process that now holds the slot
+        self.slot.refresh_from_db()
+        self.assertIsNotNone(self.slot.tape_request_id)
+        self.assertFalse(TapeFile.objects.filter(stage=TapeFile.RESTORED).exists())
+
+    def test_retrieval_leases(self):
+        # the retrievals started by the retriever share the retrieval leases of the host with the other scripts
+        self.lease.release()
+        started = []
+
+        def retrieve_slot(slot, lease, retrieval_lease):
+            started.append(retrieval_lease.name)
+            return asyncio.sleep(0)
+
+        held = [retrieve_files.acquire_retrieval_lease(heartbeat=False) for i in range(retrieve_files.MAX_RETRIEVALS)]
+        self.assertIsNone(retrieve_files.acquire_retrieval_lease(heartbeat=False))
+        with mock.patch.object(self.retriever, "retrieve_slot", retrieve_slot), \
+                contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(self.retriever.fill_slots())
+            self.assertEqual(started, [])
+            held[0].release()
+            asyncio.run(self.retriever.fill_slots())
+        self.assertEqual(started, [held[0].name])
+        self.assertEqual(self.retriever.retrieval_leases[self.slot.pk].name, held[0].name)
+
+
+class LogFollowerTest(TestCase):
+    """The log follower returns each complete line of the log once, as it is written."""
+
+    def setUp(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.path = os.path.join(log_dir, "sd_get.log")
+
+    def write(self, text, mode="a"):
+        with open(self.path, mode) as fh:
+            fh.write(text)
+
+    def follow(self, **kwargs):
+        follower = LogFollower(self.path, **kwargs)
+        self.addCleanup(follower.close)
+        return follower
+
+    def test_partial_lines(self):
+        self.write("first\nsec")
+        follower = self.follow()
+        self.assertEqual(follower.read_lines(), ["first"])
+        self.assertEqual(follower.read_lines(), [])
+        self.write("ond\nthird\n")
+        self.assertEqual(follower.read_lines(), ["second", "third"])
+        self.assertEqual(follower.offset, os.path.getsize(self.path))
+
+    def test_final(self):
+        follower = self.follow()
+        self.write("first\nlast, not terminated")
+        self.assertEqual(follower.read_lines(), ["first"])
+        # once the writer has ended the unterminated line is returned too
+        self.assertEqual(follower.read_lines(final=True), ["last, not terminated"])
+        self.assertEqual(follower.read_lines(final=True), [])
+
+    def test_log_created_later(self):
+        # the follower polls until the log is created, then watches only the log
+        follower = self.follow()
+        self.assertIsNone(follower.fileno())
+        self.assertEqual(follower.read_lines(), [])
+        self.write("first\n")
+        self.assertEqual(follower.read_lines(), ["first"])
+        if follower.inotify is not None:
+            self.assertIsNotNone(follower.fileno())
+            # writing another file in the directory does not wake the follower
+            with open(os.path.join(os.path.dirname(self.path), "restored.dat"), "w") as fh:
+                fh.write("data")
+            self.assertFalse(follower.inotify.wait(0))
+            self.write("second\n")
+            self.assertTrue(follower.inotify.wait(1))
+            self.assertEqual(follower.read_lines(), ["second"])
+
+    def test_log_kept_open(self):
+        self.write("first\n")
+        follower = self.follow()
+        log_file = follower.log_file
+        follower.read_lines()
+        self.write("second\n")
+        self.assertEqual(follower.read_lines(), ["second"])
+        self.assertIs(follower.log_file, log_file)
+
+    def test_truncated_and_replaced(self):
+        self.write("first\n")
+        follower = self.follow(use_inotify=False)
+        self.assertEqual(follower.read_lines(), ["first"])
+        self.write("new\n", mode="w")
+        self.assertEqual(follower.read_lines(), ["new"])
+        os.unlink(self.path)
+        self.write("replaced\n")
+        self.assertEqual(follower.read_lines(), ["replaced"])
+
+
+class RestoredFileBatchTest(TestCase):
+    """A batch of restored files is committed with a fixed number of queries, updating the files, the restore disk,
+       the reservation on it and the location update outbox."""
+
+    def setUp(self):
+        self.disk = RestoreDisk.objects.create(mountpoint="/tmp/nla_test_restore", allocated_bytes=10**9,
+                                               used_bytes=500)
+        self.quota = Quota.objects.create(user="batch", size=10**12)
+        self.tape_request = TapeRequest.objects.create(quota=self.quota, active_request=True,
+                                                       retention=timezone.now() + datetime.timedelta(days=20))
+        self.files = TapeFile.objects.bulk_create([
+            TapeFile(logical_path="/badc/batch/file{}.dat".format(i), size=1000 * (i + 1), stage=TapeFile.RESTORING,
+                     restoring_request=self.tape_request, restore_disk=self.disk)
+            for i in range(3)
+        ])
+        self.tape_request.files.add(*self.files)
+        self.slot = StorageDSlot.objects.create(tape_request=self.tape_request)
+        retrieve_files.reserve_space(self.tape_request, self.disk, 6000)
+
+    def test_flush(self):
+        used_quota = self.quota.used(timezone.now())
+        before = timezone.now()
+        batch = retrieve_files.RestoredFileBatch(self.slot, self.disk, max_files=2, max_wait=60)
+        self.assertIsNone(batch.time_to_flush())
+        batch.add(self.files[0])
+        self.assertFalse(batch.due())
+        batch.add(self.files[1])
+        self.assertTrue(batch.due())
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(batch.flush(), 2)
+        self.assertEqual(batch.files, [])
+
+        for f in self.files[:2]:
+            f.refresh_from_db()
+            self.assertEqual(f.stage, TapeFile.RESTORED)
+            self.assertIsNone(f.restoring_request)
+            self.assertGreaterEqual(f.last_updated, before)
+        self.files[2].refresh_from_db()
+        self.assertEqual(self.files[2].stage, TapeFile.RESTORING)
+
+        # the restored bytes move from the reservation to the used space of the disk
+        self.disk.refresh_from_db()
+        self.assertEqual(self.disk.used_bytes, 3500)
+        self.assertEqual(RestoreDiskReservation.objects.get(tape_request=self.tape_request).reserved_bytes, 3000)
+        # the quota counts the files of the request whatever their stage
+        self.assertEqual(self.quota.used(timezone.now()), used_quota)
+
+        self.tape_request.refresh_from_db()
+        self.assertIsNotNone(self.tape_request.first_files_on_disk)
+        self.assertEqual(
+            sorted(LocationUpdate.objects.filter(sent__isnull=True).values_list("logical_path", "location")),
+            [(f.logical_path, LocationUpdate.ON_DISK) for f in self.files[:2]]
+        )
+
+    def test_flush_empty(self):
+        batch = retrieve_files.RestoredFileBatch(self.slot, self.disk)
+        with QueryBudget() as budget:
+            self.assertEqual(batch.flush(), 0)
+        self.assertEqual(budget.queries, 0)
+
+
+class RestoreDiskTest(TestCase):
+    """Space on the restore disks is reserved for each retrieval, so that retrievals cannot overcommit a disk."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.disks = [
+            RestoreDisk.objects.create(mountpoint=os.path.join(root, "restore{}".format(i)), allocated_bytes=10000)
+            for i in range(2)
+        ]
+        self.quota = Quota.objects.create(user="disks", size=10**12)
+
+    def make_slot(self):
+        tape_request = TapeRequest.objects.create(quota=self.quota, active_request=True,
+                                                  retention=timezone.now() + datetime.timedelta(days=20))
+        return StorageDSlot.objects.create(tape_request=tape_request)
+
+    def reserved(self, slot):
+        return dict(RestoreDiskReservation.objects.filter(tape_request=slot.tape_request).values_list(
+            "restore_disk", "reserved_bytes"
+        ))
+
+    def test_reserve_and_release(self):
+        slot = self.make_slot()
+        retrieve_files.reserve_space(slot.tape_request, self.disks[0], 6000)
+        self.assertEqual(self.disks[0].free_bytes(), 4000)
+        # reserving again sets the reservation, rather than adding to it
+        retrieve_files.reserve_space(slot.tape_request, self.disks[0], 5000)
+        self.assertEqual(self.disks[0].free_bytes(), 5000)
+        retrieve_files.release_space(slot.tape_request, self.disks[0], 2000)
+        self.assertEqual(self.reserved(slot), {self.disks[0].pk: 3000})
+        # releasing more than is reserved leaves nothing reserved
+        retrieve_files.release_space(slot.tape_request, self.disks[0], 5000)
+        self.assertEqual(self.reserved(slot), {self.disks[0].pk: 0})
+        retrieve_files.release_space(slot.tape_request)
+        self.assertEqual(self.reserved(slot), {})
+
+    def test_overlapping_retrievals(self):
+        # each disk can only hold one of the retrievals, once the space for the first is reserved
+        slots = [self.make_slot() for i in range(3)]
+        chosen = [retrieve_files.get_restore_disk(slot, 6000) for slot in slots]
+        self.assertEqual(sorted(d.pk for d in chosen[:2]), sorted(d.pk for d in self.disks))
+        self.assertIsNone(chosen[2])
+        self.assertEqual(self.reserved(slots[2]), {})
+        for disk in self.disks:
+            self.assertEqual(disk.free_bytes(), 4000)
+
+    def test_release_on_failure(self):
+        slot = self.make_slot()
+        f = TapeFile.objects.create(logical_path="/badc/disks/file.dat", size=6000, stage=TapeFile.RESTORING,
+                                    restoring_request=slot.tape_request)
+        slot.tape_request.files.add(f)
+        slot.tape_request.storaged_request_start = timezone.now()
+        slot.tape_request.save()
+        target_disk = retrieve_files.get_restore_disk(slot, 6000)
+        self.assertEqual(self.reserved(slot), {target_disk.pk: 6000})
+        # the failed retrieval is redone later - its space is given back now
+        with contextlib.redirect_stdout(io.StringIO()):
+            retrieve_files.redo_request(slot)
+        self.assertEqual(RestoreDiskReservation.objects.count(), 0)
+        self.assertEqual(target_disk.free_bytes(), 10000)
+
+    def test_empty_request(self):
+        # a request with no files to retrieve gets a disk that is not full, and reserves nothing
+        self.disks[0].add_used(10000)
+        slot = self.make_slot()
+        self.assertEqual(retrieve_files.get_restore_disk(slot, 0).pk, self.disks[1].pk)
+        self.assertEqual(self.reserved(slot), {})
+        self.disks[1].add_used(10000)
+        self.assertIsNone(retrieve_files.get_restore_disk(slot, 0))
+
+    def partition(self, slot, sizes):
+        files = [TapeFile(logical_path="/badc/disks/file{}.dat".format(i), size=size) for i, size in enumerate(sizes)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            partitions = retrieve_files.get_restore_partitions(slot, files)
+        return [(disk.pk, [files.index(f) for f in part_files]) for disk, part_files in partitions]
+
+    def test_split_across_disks(self):
+        # no one disk has room for both files, so they are split in order across the disks, most free space first
+        self.disks[0].add_used(1000)
+        slot = self.make_slot()
+        self.assertEqual(self.partition(slot, [6000, 5000]), [(self.disks[1].pk, [0]), (self.disks[0].pk, [1])])
+        self.assertEqual(self.reserved(slot), {self.disks[1].pk: 6000, self.disks[0].pk: 5000})
+
+        # with 4000 bytes free on each disk, the files that do not fit on any disk are left for a later run
+        slot = self.make_slot()
+        self.assertEqual(self.partition(slot, [3000, 3000, 3000]), [(self.disks[0].pk, [0]), (self.disks[1].pk, [1])])
+        self.assertEqual(self.reserved(slot), {self.disks[1].pk: 3000, self.disks[0].pk: 3000})
+
+    def test_split_does_not_fit(self):
+        slot = self.make_slot()
+        # a file bigger than the free space of every disk
+        self.assertEqual(self.partition(slot, [12000]), [])
+        self.assertEqual(self.reserved(slot), {})
+        # or splitting is turned off
+        with mock.patch.object(retrieve_files, "RESTORE_SPLIT_REQUESTS", False):
+            self.assertEqual(self.partition(slot, [6000, 6000]), [])
+        self.assertEqual(self.reserved(slot), {})
+
+
+class RetryTest(TestCase):
+    """A failed retrieval keeps the files it restored, and the request is retried after a growing delay."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        spot_path = os.path.join(root, "archive", "spot0")
+        os.makedirs(spot_path)
+        for patcher in (
+            mock.patch.object(TapeFile, "fileset_logical_paths", [spot_path], create=True),
+            mock.patch.object(TapeFile, "fileset_logical_path_map", {spot_path: "spot0-retry"}, create=True),
+            mock.patch.object(retrieve_files, "TEST_VERSION", True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.disk = RestoreDisk.objects.create(mountpoint=os.path.join(root, "restore"), allocated_bytes=10**9)
+        os.makedirs(self.disk.mountpoint)
+        quota = Quota.objects.create(user="retry", size=10**12)
+        self.start = timezone.now() - datetime.timedelta(hours=1)
+        self.tape_request = TapeRequest.objects.create(quota=quota, active_request=True,
+                                                       storaged_request_start=self.start,
+                                                       retention=timezone.now() + datetime.timedelta(days=20))
+        self.files = TapeFile.objects.bulk_create([
+            TapeFile(logical_path=os.path.join(spot_path, "file{}.dat".format(i)), size=10, stage=TapeFile.RESTORING,
+                     restoring_request=self.tape_request, restore_disk=self.disk)
+            for i in range(2)
+        ])
+        self.tape_request.files.add(*self.files)
+        self.slot = StorageDSlot.objects.create(tape_request=self.tape_request)
+        # the first file was restored before the retrieval failed, the second was only partly written
+        for f, data in zip(self.files, ("0123456789", "01234")):
+            with open(os.path.join(self.disk.mountpoint, os.path.basename(f.logical_path)), "w") as fh:
+                fh.write(data)
+
+    def test_resume_restoring_files(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(retrieve_files.resume_restoring_files(self.slot), 1)
+        restored, partial = self.files
+        restored.refresh_from_db()
+        partial.refresh_from_db()
+        self.assertEqual(restored.stage, TapeFile.RESTORED)
+        self.assertTrue(os.path.islink(restored.logical_path))
+        self.assertEqual(partial.stage, TapeFile.RESTORING)
+        self.assertFalse(os.path.lexists(partial.logical_path))
+
+    def test_redo_request(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            retrieve_files.redo_request(self.slot)
+        stages = dict(TapeFile.objects.values_list("pk", "stage"))
+        self.assertEqual([stages[f.pk] for f in self.files], [TapeFile.RESTORED, TapeFile.ONTAPE])
+        self.tape_request.refresh_from_db()
+        # the request keeps its start time, as the file already restored is kept
+        self.assertEqual(self.tape_request.storaged_request_start, self.start)
+        self.assertIsNone(self.tape_request.storaged_request_end)
+        self.assertEqual(self.tape_request.retry_count, 1)
+        self.assertIsNotNone(self.tape_request.retry_after)
+        self.slot.refresh_from_db()
+        self.assertIsNone(self.slot.tape_request)
+
+    def test_schedule_retry(self):
+        now = timezone.now()
+        delays = []
+        with mock.patch.object(retrieve_files, "RETRY_BACKOFF_BASE", 60), \
+                mock.patch.object(retrieve_files, "RETRY_BACKOFF_MAX", 600), \
+                mock.patch.object(retrieve_files.timezone, "now", return_value=now), \
+                contextlib.redirect_stdout(io.StringIO()):
+            for i in range(6):
+                retrieve_files.schedule_retry(self.tape_request)
+                delays.append((self.tape_request.retry_after - now).total_seconds())
+        self.assertEqual(delays, [60, 120, 240, 480, 600, 600])
+        self.assertEqual(self.tape_request.retry_count, 6)
+        retrieve_files.reset_retries(self.tape_request)
+        self.assertEqual(self.tape_request.retry_count, 0)
+        self.assertIsNone(self.tape_request.retry_after)
+
+    def check_happy(self, started_seconds_ago):
+        TapeFile.objects.update(stage=TapeFile.ONTAPE)
+        TapeRequest.objects.filter(pk=self.tape_request.pk).update(
+            storaged_request_start=timezone.now() - datetime.timedelta(seconds=started_seconds_ago)
+        )
+        slot = StorageDSlot.objects.select_related("tape_request").get(pk=self.slot.pk)
+        with contextlib.redirect_stdout(io.StringIO()):
+            retrieve_files.check_happy(slot)
+        slot.refresh_from_db()
+        return slot.tape_request
+
+    def test_check_happy_without_pid(self):
+        # a retrieval that started without recording its sd_get is only reset once it is 120s old
+        self.assertIsNotNone(self.check_happy(60))
+        self.assertIsNone(self.check_happy(180))
+
+
+
+class RetrieveBatchTest(TestCase):
+    """Each run of sd_get retrieves one chunk of the files of one spot and tape volume, in on-tape order, skipping the
+    groups with no files in the listing of their spot."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.spots = {"/badc/a": "spot-a", "/badc/b": "spot-b"}
+        for patcher in (
+            mock.patch.object(TapeFile, "fileset_logical_paths", list(self.spots), create=True),
+            mock.patch.object(TapeFile, "fileset_logical_path_map", self.spots, create=True),
+            mock.patch.object(retrieve_files, "TEST_VERSION", True),
+            mock.patch.object(retrieve_files, "CHECK_SPOT_LISTING", True),
+            mock.patch.object(retrieve_files, "RETRIEVE_BY_LOCALITY", True),
+            mock.patch.object(retrieve_files, "spot_listings", SpotListingCache(
+                cache_dir=os.path.join(root, "listings"), list_spot=self.list_spot
+            )),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.disk = RestoreDisk.objects.create(mountpoint=os.path.join(root, "restore"), allocated_bytes=10**9)
+        quota = Quota.objects.create(user="batch", size=10**12)
+        tape_request = TapeRequest.objects.create(quota=quota, active_request=True,
+                                                  retention=timezone.now() + datetime.timedelta(days=20))
+        # (path, size, volume, position on the tape)
+        self.tape = [
+            ("/badc/a/big1.dat", 1000, "V1", "5"),
+            ("/badc/a/big2.dat", 1000, "V1", "2"),
+            ("/badc/a/mid.dat", 500, "V2", "1"),
+            ("/badc/b/small.dat", 10, None, None),
+        ]
+        self.files = {
+            os.path.basename(f.logical_path): f for f in TapeFile.objects.bulk_create([
+                TapeFile(logical_path=path, size=size, stage=TapeFile.ONTAPE) for path, size, v, p in self.tape
+            ])
+        }
+        tape_request.files.add(*self.files.values())
+        self.slot = StorageDSlot.objects.create(tape_request=tape_request)
+        self.addCleanup(retrieve_files.retrieval_metrics.pop, self.slot.pk, None)
+
+    def list_spot(self, spot_name):
+        return {
+            os.path.basename(path): SpotFile("/archive/{}/{}".format(spot_name, os.path.basename(path)), size,
+                                             "TAPED", volume, position)
+            for path, size, volume, position in self.tape if self.spots[os.path.dirname(path)] == spot_name
+        }
+
+    def names(self, files):
+        return [os.path.basename(f.logical_path) for f in files]
+
+    def test_locality_groups(self):
+        groups = retrieve_files.get_locality_groups(TapeFile.objects.all())
+        # largest group first, each in on-tape order
+        self.assertEqual([self.names(g) for g in groups], [["big2.dat", "big1.dat"], ["mid.dat"], ["small.dat"]])
+
+    def test_retrieve_batch(self):
+        self.assertEqual(self.names(retrieve_files.get_retrieve_batch(self.slot)), ["big2.dat", "big1.dat"])
+        with mock.patch.object(retrieve_files, "RETRIEVE_BY_LOCALITY", False):
+            self.assertEqual(self.names(retrieve_files.get_retrieve_batch(self.slot)),
+                             ["big1.dat", "big2.dat", "mid.dat", "small.dat"])
+
+    def test_chunks(self):
+        # each run retrieves at most RETRIEVE_CHUNK_FILES files and RETRIEVE_CHUNK_BYTES bytes, and the next run
+        # carries on with the files left on tape
+        runs = []
+        with mock.patch.object(retrieve_files, "RETRIEVE_BY_LOCALITY", False), \
+                mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_FILES", 2), \
+                mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_BYTES", 1500), \
+                contextlib.redirect_stdout(io.StringIO()):
+            while TapeFile.objects.filter(stage=TapeFile.ONTAPE).exists():
+                retrieve_files.prepare_retrieval(self.slot)
+                restoring = TapeFile.objects.filter(stage=TapeFile.RESTORING)
+                runs.append(self.names(restoring.order_by("logical_path")))
+                restoring.update(stage=TapeFile.RESTORED)
+        self.assertEqual(runs, [["big1.dat"], ["big2.dat", "mid.dat"], ["small.dat"]])
+
+    def test_chunk_limits(self):
+        files = [TapeFile(logical_path="/badc/a/f{}.dat".format(i), size=size)
+                 for i, size in enumerate([400, 400, 400, 3000])]
+        with mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_FILES", 2), \
+                mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_BYTES", 1000):
+            self.assertEqual(retrieve_files.get_retrieve_chunk(files), files[:2])
+            self.assertEqual(retrieve_files.get_retrieve_chunk(files[2:]), files[2:3])
+            # a file bigger than the byte limit is retrieved on its own
+            self.assertEqual(retrieve_files.get_retrieve_chunk(files[3:]), files[3:])
+        with mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_FILES", None), \
+                mock.patch.object(retrieve_files, "RETRIEVE_CHUNK_BYTES", 0):
+            self.assertEqual(retrieve_files.get_retrieve_chunk(files), files)
+
+    def test_unlisted_group_skipped(self):
+        # the files of spot-a are not in its listing, even when it is listed again
+        self.tape = self.tape[3:]
+        self.assertEqual(self.names(retrieve_files.get_retrieve_batch(self.slot)), ["small.dat"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            retrievals = retrieve_files.prepare_retrieval(self.slot)
+        self.assertEqual(len(retrievals), 1)
+        target_disk, listing, retrieved_to_file_map = retrievals[0]
+        self.assertEqual(list(retrieved_to_file_map), ["/badc/b/small.dat"])
+        self.assertEqual(TapeFile.objects.get(stage=TapeFile.RESTORING).logical_path, "/badc/b/small.dat")
+
+    def test_nothing_listed(self):
+        # the slot is only given up when none of the groups have any files that can be retrieved
+        self.tape = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(retrieve_files.prepare_retrieval(self.slot))
+        self.slot.refresh_from_db()
+        self.assertIsNone(self.slot.tape_request)
+        self.assertFalse(TapeFile.objects.exclude(stage=TapeFile.ONTAPE).exists())
+
+SD_LS_OUTPUT = """Listing spot spot0
+2026-10-01 12:00:00 TAPED 1024 V00001 17 1 md5 0123abcd badc /archive/spot0/a.dat
+2026-10-01 12:00:00 SYNCED 2048 V00002 3 1 md5 4567ef01 badc /archive/spot0/d/b.dat
+2026-10-01 12:00:00 TAPED unknown V00002 4 1 md5 4567ef01 badc /archive/spot0/d/c.dat
+2 files
+"""
+
+
+class SpotListingTest(TestCase):
+    """The sd_ls listings are parsed from the columns the NLA reads, and cached in memory and on disk."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.listed = []
+        self.output = SD_LS_OUTPUT
+
+    def list_spot(self, spot_name):
+        self.listed.append(spot_name)
+        if spot_name == "missing":
+            return None
+        return parse_sd_ls(self.output)
+
+    def make_cache(self):
+        return SpotListingCache(cache_dir=self.cache_dir, ttl=60, list_spot=self.list_spot, relist_age=10)
+
+    def test_parse(self):
+        # the header, the line without a size and the summary are skipped, and the volume is not read by default
+        self.assertEqual(parse_sd_ls(SD_LS_OUTPUT), {
+            "a.dat": SpotFile("/archive/spot0/a.dat", 1024, "TAPED", None, None),
+            "b.dat": SpotFile("/archive/spot0/d/b.dat", 2048, "SYNCED", None, None),
+        })
+        with mock.patch.object(spot_listing, "SD_LS_VOLUME_COLUMN", 4), \
+                mock.patch.object(spot_listing, "SD_LS_POSITION_COLUMN", 5):
+            contents = parse_sd_ls(SD_LS_OUTPUT)
+        self.assertEqual(contents["b.dat"], SpotFile("/archive/spot0/d/b.dat", 2048, "SYNCED", "V00002", "3"))
+
+    def test_parse_emulator(self):
+        tape_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tape_dir)
+        with open(os.path.join(tape_dir, "file.dat"), "w") as fh:
+            fh.write("0123456789")
+        with mock.patch.dict(os.environ, {"SD_EMULATOR_TAPE_DIR": tape_dir}):
+            output = subprocess.check_output(
+                [sys.executable, os.path.join(os.path.dirname(spot_listing.__file__), "bin", "sd_ls_emulator"),
+                 "-s", "spot0", "-L", "file"]
+            ).decode("utf-8")
+        self.assertEqual(parse_sd_ls(output),
+                         {"file.dat": SpotFile("/archive/spot0/file.dat", 10, "TAPED", None, None)})
+
+    def test_cache(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.get("spot0"), parse_sd_ls(SD_LS_OUTPUT))
+        self.assertTrue(cache.contains("spot0", "a.dat"))
+        self.assertFalse(cache.contains("spot0", "x.dat"))
+        self.assertEqual(self.listed, ["spot0"])
+        # the listing is shared through the disk with the other processes
+        self.assertEqual(self.make_cache().get("spot0"), parse_sd_ls(SD_LS_OUTPUT))
+        self.assertEqual(self.listed, ["spot0"])
+
+    def test_failed_listing(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.get("missing"))
+        self.assertIsNone(cache.contains("missing", "a.dat"))
+        self.assertEqual(self.listed, ["missing", "missing"])
+
+    def test_expiry(self):
+        cache = self.make_cache()
+        cache.get("spot0")
+        now = time.time()
+        with mock.patch.object(spot_listing.time, "time", return_value=now + 30):
+            cache.get("spot0")
+        self.assertEqual(self.listed, ["spot0"])
+        with mock.patch.object(spot_listing.time, "time", return_value=now + 61):
+            cache.get("spot0")
+        self.assertEqual(self.listed, ["spot0", "spot0"])
+        # the expired listings are dropped from memory
+        with mock.patch.object(spot_listing.time, "time", return_value=now + 122):
+            cache.get("spot1")
+        self.assertEqual(list(cache._listings), ["spot1"])
+
+    def test_relist(self):
+        cache = self.make_cache()
+        self.assertFalse(cache.contains("spot0", "new.dat", relist=True))
+        # a new listing is not listed again
+        self.assertEqual(self.listed, ["spot0"])
+        self.output += "2026-10-01 13:00:00 TAPED 10 V00003 1 1 md5 89ab badc /archive/spot0/new.dat\n"
+        now = time.time()
+        with mock.patch.object(spot_listing.time, "time", return_value=now + 30), \
+                contextlib.redirect_stdout(io.StringIO()):
+            # a file taped since the spot was listed is found once the listing is older than relist_age
+            self.assertFalse(cache.contains("spot0", "new.dat"))
+            self.assertTrue(cache.contains("spot0", "new.dat", relist=True))
+            self.assertEqual(self.listed, ["spot0", "spot0"])
+            # the spot is only listed again once for the files missing from it
+            self.assertFalse(cache.contains("spot0", "other.dat", relist=True))
+            self.assertEqual(self.listed, ["spot0", "spot0"])
+        self.assertTrue(self.make_cache().contains("spot0", "new.dat"))
+
+    def test_invalidate(self):
+        cache = self.make_cache()
+        cache.get("spot0")
+        cache.get("spot1")
+        cache.invalidate("spot0")
+        cache.get("spot0")
+        cache.get("spot1")
+        self.assertEqual(self.listed, ["spot0", "spot1", "spot0"])
+        cache.invalidate()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        cache.get("spot1")
+        self.assertEqual(self.listed, ["spot0", "spot1", "spot0", "spot1"])
+
+    def test_get_spot_contents(self):
+        with mock.patch.object(fix_problems, "spot_listings", self.make_cache()):
+            self.assertEqual(fix_problems.get_spot_contents("spot0"), parse_sd_ls(SD_LS_OUTPUT))
+            self.assertEqual(fix_problems.get_spot_contents("missing"), {})
+
+    def test_quick_verify(self):
+        # the storage paths, as loaded by TapeFile.load_storage_paths
+        for name, value in (("fileset_logical_path_map", {"/badc/qv": "spot0"}),
+                            ("fileset_logical_paths", ["/badc/qv"])):
+            patcher = mock.patch.object(TapeFile, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        paths = ["/badc/qv/a.dat", "/badc/qv/d/b.dat", "/badc/qv/c.dat", "/badc/qv/x.dat", "/badc/other/a.dat"]
+        TapeFile.objects.bulk_create([TapeFile(logical_path=p, size=1000, stage=TapeFile.UNVERIFIED) for p in paths])
+
+        with mock.patch.object(quick_verify, "spot_listings", self.make_cache()), \
+                mock.patch.object(quick_verify, "TEST_VERSION", False), \
+                contextlib.redirect_stdout(io.StringIO()):
+            quick_verify.quick_verify_files(["/badc/qv"])
+        verified = TapeFile.objects.filter(stage=TapeFile.ONDISK, verified__isnull=False)
+        self.assertEqual(set(verified.values_list("logical_path", flat=True)), {"/badc/qv/a.dat", "/badc/qv/d/b.dat"})
+        self.assertEqual(self.listed, ["spot0"])
+
+        # only one quick_verify runs at once
+        with Lease("quick_verify", heartbeat=False), contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                quick_verify.run()
+
+
+class LocationUpdateTest(TestCase):
+    """The location updates are sent to Elastic Search in order, and an old update never overwrites a newer one."""
+
+    def setUp(self):
+        # the Elastic Search index, as set by update_file_location
+        self.index = {}
+        self.fail = False
+        fbi_core = types.ModuleType("fbi_core")
+        fbi_core.update_file_location = self.update_file_location
+        patcher = mock.patch.dict(sys.modules, {"fbi_core": fbi_core})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def update_file_location(self, path_list, location):
+        if self.fail:
+            raise ConnectionError("Elastic Search unavailable")
+        for path in path_list:
+            self.index[path] = location
+
+    def flush(self, at):
+        with mock.patch.object(flush_location_updates.timezone, "now", return_value=at), \
+                contextlib.redirect_stdout(io.StringIO()):
+            return flush_location_updates.flush_location_updates()
+
+    def test_flush(self):
+        LocationUpdate.enqueue(["/badc/a", "/badc/b"], LocationUpdate.ON_DISK)
+        self.assertEqual(self.flush(timezone.now()), 2)
+        self.assertEqual(self.index, {"/badc/a": LocationUpdate.ON_DISK, "/badc/b": LocationUpdate.ON_DISK})
+        self.assertFalse(LocationUpdate.objects.filter(sent__isnull=True).exists())
+
+    def test_failed_update_superseded(self):
+        now = timezone.now()
+        LocationUpdate.enqueue(["/badc/a"], LocationUpdate.ON_DISK)
+        self.fail = True
+        self.assertEqual(self.flush(now), 0)
+        failed = LocationUpdate.objects.get()
+        self.assertEqual(failed.attempts, 1)
+        self.assertGreater(failed.next_attempt, now)
+
+        # the file goes back to tape while the first update is backing off
+        self.fail = False
+        LocationUpdate.enqueue(["/badc/a"], LocationUpdate.ON_TAPE)
+        self.assertEqual(self.flush(now), 1)
+        self.assertEqual(self.index, {"/badc/a": LocationUpdate.ON_TAPE})
+
+        # the failed update is not retried once its backoff has passed, as it was superseded
+        self.assertEqual(self.flush(now + datetime.timedelta(days=1)), 0)
+        self.assertEqual(self.index, {"/badc/a": LocationUpdate.ON_TAPE})
+        failed.refresh_from_db()
+        self.assertIsNotNone(failed.sent)
+        self.assertEqual(failed.last_error, "superseded")
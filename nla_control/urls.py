@@ -7,5 +7,6 @@ urlpatterns = (
     re_path(r'^api/v1/requests$', RequestView.as_view()),
     re_path(r'^api/v1/quota/(?P<user>\w+)$', QuotaView.as_view()),
     re_path(r'^api/v1/files$', TapeFileView.as_view()),
+    re_path(r'^api/v1/metrics/retrievals$', RetrievalMetricsView.as_view()),
     re_path(r'unverifiedspots', unverified_spots, name='unverifiedspots')
 )
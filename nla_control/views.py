@@ -1,10 +1,15 @@
 # Create your views here.
+from django.conf import settings
 from django.http import HttpResponse
 from nla_control.models import *
 from django.shortcuts import get_object_or_404
 import json
 import datetime
+import os
 from django.views.generic import View
+from django.db.models import Sum
+from django.utils import timezone
+from nla_control.metrics import get_metrics
 import requests
 
 class RequestView(View):
@@ -151,7 +156,7 @@ class RequestView(View):
         """
         # return details of a single request
         if "req_id" in kwargs:
-            req = get_object_or_404(TapeRequest, pk=kwargs["req_id"])
+            req = get_object_or_404(TapeRequest.objects.select_related("quota"), pk=kwargs["req_id"])
             data = {"id": req.pk, "quota": req.quota.user, "retention": req.retention.isoformat(),
                     "request_date": req.request_date.isoformat(),
                     "request_patterns": req.request_patterns,
@@ -169,15 +174,14 @@ class RequestView(View):
                 data["last_files_on_disk"] = req.last_files_on_disk.isoformat()
             files = []
             if req.request_patterns:
-                patt_files = TapeFile.objects.filter(logical_path__contains=req.request_patterns)
-                for f in patt_files:
-                    files.append(f.logical_path)
+                files = list(TapeFile.objects.filter(
+                    logical_path__contains=req.request_patterns
+                ).values_list("logical_path", flat=True))
             elif req.request_files:
                 for f in req.request_files.split("\n"):
                     files.append(f)
-            elif len(req.files.all()) != 0:
-                for f in req.files.all():
-                    files.append(f.logical_path)
+            else:
+                files = list(req.files.values_list("logical_path", flat=True))
 
             data["files"] = files
             return HttpResponse(json.dumps(data), content_type="application/json")
@@ -185,7 +189,7 @@ class RequestView(View):
         # list all requests if no request specified
         else:
             requests = []
-            for req in TapeRequest.objects.all():
+            for req in TapeRequest.objects.all().select_related("quota"):
                 req_data = {"id": req.pk, "quota": req.quota.user, "retention": req.retention.isoformat(),
                         "request_date": req.request_date.isoformat(),
                         "label": req.label}
@@ -216,11 +220,11 @@ class RequestView(View):
         elif "patterns" in data:
             file_reqs = TapeFile.objects.filter(logical_path__contains=data["patterns"])
         else:
-            file_reqs = []
+            file_reqs = None
 
         # can now add up the file_requests
-        for f in file_reqs:
-            total_size += f.size
+        if file_reqs is not None:
+            total_size = file_reqs.aggregate(tot_size=Sum("size"))["tot_size"] or 0
 
         # check whether this and previously requested files are greater than the user's quota
         if quota.used(datetime.datetime.now()) + total_size > quota.size:
@@ -670,8 +674,8 @@ class TapeFileView(View):
 
         # load tape file mappings if spot is true
         if spot.lower() == "true":
-            req = requests.get(CEDA_DOWNLOAD_CONF)
-            page = req.content.decode("utf-8")
+            req = requests.get(settings.CEDA_DOWNLOAD_CONF)
+            page = req.content.decode("utf-8").split("\n")
             fileset_logical_path_map = {}
 
             # make a dictionary that maps logical paths to spot names
@@ -682,17 +686,19 @@ class TapeFileView(View):
                 spot_name, logical_path = line.split()
                 fileset_logical_path_map[logical_path] = spot_name
 
-        tfiles = TapeFile.objects.filter(logical_path__contains=match, stage__in=stage_list)
+        tfiles = list(TapeFile.objects.filter(
+            logical_path__contains=match, stage__in=stage_list
+        ).values_list("logical_path", "size", "verified", "stage"))
 
         data = {"count": len(tfiles)}
         filelist = []
-        for f in tfiles:
-            if f.verified:
-                verified = f.verified.isoformat()
+        for logical_path, size, f_verified, stage in tfiles:
+            if f_verified:
+                verified = f_verified.isoformat()
             else:
                 verified = None
             if spot.lower() == "true":
-                lpath = f.logical_path
+                lpath = logical_path
                 for i in range(0,3):
                     # get the directory name
                     head, tail = os.path.split(lpath)
@@ -700,23 +706,158 @@ class TapeFileView(View):
                         spot_name = fileset_logical_path_map[head]
                         break
                     lpath = head
-                filelist.append({"path": f.logical_path, "spot-name": spot_name, "size": f.size,
-                                 "verified": verified, "stage": inverse_stage_map[f.stage]})
+                filelist.append({"path": logical_path, "spot-name": spot_name, "size": size,
+                                 "verified": verified, "stage": inverse_stage_map[stage]})
             else:
-                filelist.append({"path": f.logical_path, "size": f.size,
-                                 "verified": verified, "stage": inverse_stage_map[f.stage]})
+                filelist.append({"path": logical_path, "size": size,
+                                 "verified": verified, "stage": inverse_stage_map[stage]})
         data["files"] = filelist
 
         return HttpResponse(json.dumps(data), content_type="application/json")
 
 
+# upper bounds of the histogram buckets for the retrieval metrics
+DURATION_BUCKETS = [1, 10, 60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 24 * 3600]
+THROUGHPUT_BUCKETS = [2**20, 10 * 2**20, 50 * 2**20, 100 * 2**20, 200 * 2**20, 400 * 2**20, 2**30]
+FILES_BUCKETS = [1, 10, 100, 1000, 5000, 10000, 100000]
+BYTES_BUCKETS = [2**20, 2**30, 10 * 2**30, 100 * 2**30, 2**40, 2 * 2**40, 10 * 2**40]
+
+
+def histogram(values, buckets):
+    """Count the values in each bucket, returning the count, sum, percentiles and cumulative bucket counts (as in
+       Prometheus, the count for each bucket includes the values in the lower buckets)."""
+    values = sorted(v for v in values if v is not None)
+    counts = []
+    i = 0
+    for upper in buckets:
+        while i < len(values) and values[i] <= upper:
+            i += 1
+        counts.append({"le": upper, "count": i})
+    counts.append({"le": "+Inf", "count": len(values)})
+    data = {"count": len(values), "sum": sum(values), "buckets": counts}
+    if len(values) > 0:
+        data["min"] = values[0]
+        data["max"] = values[-1]
+        for p in (50, 90, 99):
+            data["p%d" % p] = values[min(len(values) * p // 100, len(values) - 1)]
+    return data
+
+
+class RetrievalMetricsView(View):
+    """:rest-api
+
+    Requests to resources which return the timings and throughput of the retrievals from tape, aggregated as
+    histograms.
+    """
+
+    def get(self, request, *args, **kwargs):
+        """:rest-api
+
+        .. http:get:: /nla_control/api/v1/metrics/retrievals
+
+            Get histograms of the durations, throughput and sizes of the retrievals that started in the last `days`
+            days, and the time each slot was busy.
+
+            :query integer days: (*optional*) number of days to report on, the default is 7
+            :query integer slot: (*optional*) only report on the retrievals in this slot
+
+            ..
+
+            :>json integer retrievals: the number of retrievals
+            :>json Dictionary outcomes: the number of retrievals that completed the request, released the slot with
+                files still to retrieve, or failed and are to be redone
+            :>json integer retries: the number of retrievals that were retries of failed retrievals
+            :>json integer files_retrieved: the number of files restored
+            :>json integer bytes_retrieved: the size of the files restored, in bytes
+            :>json Dictionary histograms: histograms of ``queue_seconds``, ``prepare_seconds``, ``sd_get_seconds``,
+                ``first_file_seconds``, ``finish_seconds``, ``throughput`` (bytes per second), ``files_per_sd_get``
+                and ``bytes_retrieved``.  Each contains the ``count``, ``sum``, ``min``, ``max``, ``p50``, ``p90``,
+                ``p99`` and the cumulative ``buckets``.
+            :>json Dictionary slots: for each slot, the number of retrievals, the bytes restored, the seconds it
+                was busy and the fraction of the period it was busy
+
+            :statuscode 200: request completed successfully.
+            :statuscode 400: `days` or `slot` is not an integer.
+
+            **Example request**
+
+            .. sourcecode:: http
+
+                GET /nla_control/api/v1/metrics/retrievals?days=1 HTTP/1.1
+                Host: nla.ceda.ac.uk
+                Accept: application/json
+        """
+        try:
+            days = int(request.GET.get("days", 7))
+            slot = request.GET.get("slot", None)
+            if slot is not None:
+                slot = int(slot)
+        except ValueError:
+            return HttpResponse(json.dumps({"error": "days and slot must be integers"}),
+                                content_type="application/json", status=400)
+
+        period = datetime.timedelta(days=days)
+        metrics = RetrievalMetric.objects.filter(started__gte=timezone.now() - period)
+        if slot is not None:
+            metrics = metrics.filter(slot=slot)
+        rows = list(metrics.values(
+            "slot", "outcome", "retry_count", "sd_gets", "files_requested", "files_retrieved", "bytes_retrieved",
+            "queue_seconds", "prepare_seconds", "sd_get_seconds", "first_file_seconds", "finish_seconds"
+        ))
+
+        outcomes = {}
+        slots = {}
+        for r in rows:
+            outcomes[r["outcome"]] = outcomes.get(r["outcome"], 0) + 1
+            s = slots.setdefault(r["slot"], {"retrievals": 0, "bytes_retrieved": 0, "busy_seconds": 0.0})
+            s["retrievals"] += 1
+            s["bytes_retrieved"] += r["bytes_retrieved"]
+            s["busy_seconds"] += sum(r[k] or 0 for k in ("prepare_seconds", "sd_get_seconds", "finish_seconds"))
+        for s in slots.values():
+            s["busy_fraction"] = s["busy_seconds"] / period.total_seconds()
+
+        def column(name):
+            return [r[name] for r in rows]
+
+        data = {
+            "days": days,
+            "retrievals": len(rows),
+            "outcomes": outcomes,
+            "retries": sum(1 for r in rows if r["retry_count"] > 0),
+            "files_retrieved": sum(column("files_retrieved")),
+            "bytes_retrieved": sum(column("bytes_retrieved")),
+            "histograms": {
+                "queue_seconds": histogram(column("queue_seconds"), DURATION_BUCKETS),
+                "prepare_seconds": histogram(column("prepare_seconds"), DURATION_BUCKETS),
+                "sd_get_seconds": histogram(column("sd_get_seconds"), DURATION_BUCKETS),
+                "first_file_seconds": histogram(column("first_file_seconds"), DURATION_BUCKETS),
+                "finish_seconds": histogram(column("finish_seconds"), DURATION_BUCKETS),
+                "throughput": histogram(
+                    [r["bytes_retrieved"] / r["sd_get_seconds"] for r in rows if r["sd_get_seconds"]],
+                    THROUGHPUT_BUCKETS
+                ),
+                "files_per_sd_get": histogram(
+                    [r["files_requested"] / r["sd_gets"] for r in rows if r["sd_gets"]], FILES_BUCKETS
+                ),
+                "bytes_retrieved": histogram(column("bytes_retrieved"), BYTES_BUCKETS),
+            },
+            "slots": slots,
+        }
+        return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def metrics(request):
+    """The metrics of the state of the NLA, in the Prometheus text exposition format (see ``nla_control.metrics``)"""
+    return HttpResponse(get_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 def unverified_spots(request):
     """Get a list of unverified spots, in a similar manner as the "get" method above but just returning a
        text file that can be more easily processed"""
     # get a list of unverified files
     unv_files = TapeFile.objects.filter(stage=TapeFile.UNVERIFIED)
 
-    req = requests.get(CEDA_DOWNLOAD_CONF)
+    req = requests.get(settings.CEDA_DOWNLOAD_CONF)
     page = req.text.split("\n")
     fileset_logical_path_map = {}
 
@@ -16,8 +16,10 @@ Including another URLconf
 from django.urls import re_path, include
 from django.contrib import admin
 import nla_control.urls
+import nla_control.views
 
 urlpatterns = [
     re_path(r'^admin/', admin.site.urls),
     re_path(r'^nla_control/', include(nla_control.urls)),
+    re_path(r'^metrics$', nla_control.views.metrics, name='metrics'),
 ]